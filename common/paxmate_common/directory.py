@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, max_size, ttl, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value):
+        """Sets `key` unless it is already present (and unexpired); returns whether it was set."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                return False
+            self._entries[key] = (value, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_name_from_user(user):
+    display_name = user.get("profile", {}).get("display_name", None)
+    real_name = user.get("profile", {}).get("real_name", None)
+    name = user.get("name", None)
+    return display_name or real_name or name or ""
+
+
+class UserDirectory:
+    """Resolves slack user ids to names, caching the answers in-process.
+
+    `prefetch` (run by the warm-up, off the request path) fills the cache with one paginated
+    users.list sweep. A lookup never waits for that sweep, which is paced at tier 2 and takes
+    seconds a page in a large workspace: an id missing from the cache costs one users.info call
+    (tier 4) instead. `get_client` is called for every api call so the client can be swapped out
+    (e.g. in tests).
+    """
+
+    # users.list is a tier 2 method; keep the sweep to a handful of calls
+    page_size = 200
+    max_pages = 50
+
+    def __init__(self, get_client, max_size=5000, ttl=3600, clock=time.monotonic):
+        self.get_client = get_client
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+        self.api_calls = 0
+        self._warm_until = None
+        self._prefetch_lock = threading.Lock()
+
+    @property
+    def is_warm(self):
+        return self._warm_until is not None and self._warm_until > self.clock()
+
+    def prefetch(self):
+        """Loads every user in the workspace into the cache with a users.list sweep."""
+        with self._prefetch_lock:
+            if self.is_warm:
+                return
+            cursor = None
+            n_users = 0
+            for _ in range(self.max_pages):
+                self.api_calls += 1
+                response = self.get_client().users_list(limit=self.page_size, cursor=cursor)
+                for user in response.get("members", []):
+                    self.cache.set(user["id"], get_name_from_user(user))
+                    n_users += 1
+                cursor = response.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    break
+            self._warm_until = self.clock() + self.ttl
+            logger.info(f"Prefetched {n_users} users in {self.api_calls} api calls")
+
+    def get_name(self, user_id):
+        name = self.cache.get(user_id)
+        if name is not None:
+            return name
+        self.api_calls += 1
+        user = self.get_client().users_info(user=user_id).get("user", {})
+        name = get_name_from_user(user)
+        self.cache.set(user_id, name)
+        return name
+
+    def get_names(self, user_ids):
+        return [self.get_name(user_id) for user_id in user_ids]
+
+    def stats(self):
+        return {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "api_calls": self.api_calls,
+            "size": len(self.cache),
+            "warm": self.is_warm,
+        }
+
+
+def _get_channel_metadata(channel_id, channel):
+    return {
+        "id": channel_id,
+        "name": channel.get("name", ""),
+        "is_member": channel.get("is_member", False),
+        "is_archived": channel.get("is_archived", False),
+    }
+
+
+class ChannelDirectory:
+    """Caches conversations.info results (name, membership, archived) by channel id.
+
+    Entries expire after `ttl` seconds, and `invalidate` drops one early, e.g. when slack sends a
+    channel_rename or member_joined_channel event. Events reach only the instance that handles them,
+    so other instances still rely on the ttl. `prefetch` loads every public channel at once.
+    """
+
+    # conversations.list is a tier 2 method, like users.list
+    page_size = 200
+    max_pages = 50
+
+    def __init__(self, get_client, max_size=1000, ttl=3600, clock=time.monotonic):
+        self.get_client = get_client
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, clock=clock)
+        self.api_calls = 0
+        self._warm_until = None
+        self._prefetch_lock = threading.Lock()
+
+    @property
+    def is_warm(self):
+        return self._warm_until is not None and self._warm_until > self.clock()
+
+    def prefetch(self):
+        """Loads every public channel in the workspace into the cache with a conversations.list sweep."""
+        with self._prefetch_lock:
+            if self.is_warm:
+                return
+            cursor = None
+            n_channels = 0
+            for _ in range(self.max_pages):
+                self.api_calls += 1
+                response = self.get_client().conversations_list(
+                    types="public_channel", exclude_archived=True, limit=self.page_size, cursor=cursor,
+                )
+                for channel in response.get("channels", []):
+                    self.set(_get_channel_metadata(channel["id"], channel))
+                    n_channels += 1
+                cursor = response.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    break
+            self._warm_until = self.clock() + self.ttl
+            logger.info(f"Prefetched {n_channels} channels in {self.api_calls} api calls")
+
+    def get(self, channel_id):
+        channel = self.cache.get(channel_id)
+        if channel is not None:
+            return channel
+        self.api_calls += 1
+        channel = _get_channel_metadata(channel_id, self.get_client().conversations_info(channel=channel_id).get("channel", {}))
+        self.cache.set(channel_id, channel)
+        return channel
+
+    def get_name(self, channel_id):
+        return self.get(channel_id)["name"]
+
+    def set(self, channel):
+        self.cache.set(channel["id"], channel)
+
+    def invalidate(self, channel_id):
+        self.cache.pop(channel_id)
+
+    def stats(self):
+        return {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "api_calls": self.api_calls,
+            "size": len(self.cache),
+            "warm": self.is_warm,
+        }
@@ -0,0 +1,206 @@
+import bisect
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+class Counter:
+    def __init__(self, on_update=None):
+        self.value = 0
+        self.on_update = on_update
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+        if self.on_update is not None:
+            self.on_update(amount)
+
+    def snapshot(self):
+        return {"value": self.value}
+
+
+class Histogram:
+    """Bucketed counts plus a window of recent samples for percentiles."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1024, on_update=None):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._recent = deque(maxlen=window)
+        self.on_update = on_update
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self._recent.append(value)
+        if self.on_update is not None:
+            self.on_update(value)
+
+    def percentile(self, p):
+        with self._lock:
+            recent = sorted(self._recent)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(round(p / 100 * (len(recent) - 1))))]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {("+Inf" if b == float("inf") else str(b)): n for b, n in zip(self.buckets, self.bucket_counts)},
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+class MetricsRegistry:
+    """Named, labelled counters and histograms for one process.
+
+    Every update is also queued (up to `max_pending`) until `drain` takes it, so a function can log
+    what happened during a request; see log_pending_metrics.
+    """
+
+    def __init__(self, max_pending=10000):
+        self._metrics = {}
+        self._pending = deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                kind = metric_class.__name__.lower()
+                on_update = functools.partial(self._record, name, kind, dict(labels))
+                metric = self._metrics[key] = metric_class(on_update=on_update, **kwargs)
+            return metric
+
+    def _record(self, name, kind, labels, value):
+        self._pending.append({"metric": name, "type": kind, "labels": labels, "value": value})
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets=buckets)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the seconds the block took in histogram `name`, labelled outcome=ok or outcome=error."""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.histogram(name, outcome=outcome, **labels).observe(time.perf_counter() - start)
+
+    def drain(self):
+        """Returns the updates made since the last drain, oldest first."""
+        updates = []
+        while True:
+            try:
+                updates.append(self._pending.popleft())
+            except IndexError:
+                return updates
+
+    def snapshot(self):
+        with self._lock:
+            items = list(self._metrics.items())
+        return [
+            {"name": name, "labels": dict(labels), "type": type(metric).__name__.lower(), **metric.snapshot()}
+            for (name, labels), metric in sorted(items, key=lambda item: item[0])
+        ]
+
+    def to_prometheus(self):
+        """The metrics in prometheus' text exposition format."""
+        def _labels(labels, **extra):
+            labels = {**labels, **extra}
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+        lines = []
+        typed = set()
+        for metric in self.snapshot():
+            name, labels = metric["name"], metric["labels"]
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {metric['type']}")
+            if metric["type"] == "counter":
+                lines.append(f"{name}{_labels(labels)} {metric['value']}")
+                continue
+            cumulative = 0
+            for bound, n in metric["buckets"].items():
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {metric['sum']}")
+            lines.append(f"{name}_count{_labels(labels)} {metric['count']}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+        self._pending.clear()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = MetricsRegistry()
+
+
+def render_metrics(format=None, registry=registry):
+    """Returns (body, content type) for a /metrics response: json, or prometheus text with format=prometheus."""
+    if format == "prometheus":
+        return registry.to_prometheus(), "text/plain; version=0.0.4"
+    return json.dumps(registry.snapshot()), "application/json"
+
+
+def log_pending_metrics(stream=None, registry=registry):
+    """Writes each update since the last call as a json line that Cloud Logging reads as a structured entry.
+
+    Each line carries one value (a latency, or a counter increment) plus the function's name, so
+    log-based metrics can chart distributions (e.g. p95 of backblast_parse_seconds) per region.
+    Set METRICS_LOG=0 to drop the updates instead.
+    """
+    updates = registry.drain()
+    if os.environ.get("METRICS_LOG", "1") == "0":
+        return
+    stream = stream or sys.stdout
+    function = os.environ.get("K_SERVICE") or os.environ.get("FUNCTION_NAME")
+    lines = [
+        json.dumps({"severity": "INFO", "message": f"metric {update['metric']}", "function": function, **update})
+        for update in updates
+    ]
+    if lines:
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+
+def logs_metrics(function):
+    """Decorates an entry point so the metrics updated while handling a request are logged before it returns."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            log_pending_metrics()
+    return wrapper
@@ -0,0 +1,303 @@
+import http.client
+import io
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from paxmate_common.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Requests per minute allowed by each of slack's rate limit tiers (https://api.slack.com/docs/rate-limits)
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# Tiers of the methods the functions call; other methods are treated as tier 3
+METHOD_TIERS = {
+    "users.list": 2,
+    "conversations.list": 2,
+    "conversations.info": 3,
+    "conversations.join": 3,
+    "users.info": 4,
+    "views.open": 4,
+    "views.update": 4,
+    "chat.postEphemeral": 4,
+}
+
+# chat.postMessage has its own limit of about one message per second per channel
+POST_MESSAGE_LIMIT = 60
+
+# Read-only methods, where identical concurrent calls can share one request
+COALESCED_METHODS = frozenset({"auth.test", "conversations.info", "team.info", "users.info", "users.list"})
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, and bursts of up to `capacity`.
+
+    `acquire` reserves a token and sleeps until it is due, so concurrent callers queue up behind
+    each other instead of all retrying at once. `pause` holds every caller back, e.g. for the
+    Retry-After of a 429.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep, tokens=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity if tokens is None else tokens
+        self.updated_at = clock()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how long to wait, in seconds, before using it."""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate, self.paused_until - now)
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+
+def _get_header(headers, name):
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value[0] if isinstance(value, list) else value
+    return None
+
+
+class HTTPConnectionPool:
+    """Keeps up to `max_idle` idle keep-alive connections per host for reuse.
+
+    Connections idle for longer than `idle_timeout` seconds are closed rather than reused, since
+    the server has likely dropped them. A request that fails on a reused connection because the
+    server closed it is retried once on a new connection.
+    """
+
+    def __init__(self, max_idle=10, idle_timeout=30, clock=time.monotonic):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, key, timeout, ssl_context):
+        now = self.clock()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    registry.counter("slack_http_connections_reused").inc()
+                    return connection, True
+                connection.close()
+        registry.counter("slack_http_connections_created").inc()
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _put_connection(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, self.clock()))
+                return
+        connection.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None, ssl_context=None):
+        """Returns (status, reason, headers, body) for one request."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            connection, is_reused = self._get_connection(key, timeout, ssl_context)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except ConnectionError:
+                connection.close()
+                if is_reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._put_connection(key, connection)
+            return response.status, response.reason, response.headers, data
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+
+class PooledWebClient(WebClient):
+    """A WebClient that reuses keep-alive connections instead of opening one (and a TLS session) per call.
+
+    Set pool_size=0 to use slack_sdk's urllib transport; it is also used when a proxy is configured.
+    Clients for different tokens can share connections by passing the same `http_pool`.
+
+    The pool is plugged in by overriding WebClient's private _perform_urllib_http_request_internal;
+    slackbot's tests/test_slack_client.py fails if a slack_sdk upgrade changes it.
+    """
+
+    def __init__(self, *args, pool_size=10, idle_timeout=30, http_pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if http_pool is None and pool_size > 0:
+            http_pool = HTTPConnectionPool(max_idle=pool_size, idle_timeout=idle_timeout)
+        self.http_pool = http_pool
+
+    def _perform_urllib_http_request_internal(self, url, req):
+        if self.http_pool is None or self.proxy is not None or not url.lower().startswith("http"):
+            return super()._perform_urllib_http_request_internal(url, req)
+        status, reason, headers, body = self.http_pool.request(
+            req.get_method(), url, body=req.data, headers=dict(req.header_items()), timeout=self.timeout,
+            ssl_context=self.ssl,
+        )
+        if status >= 400:
+            # Raised like urlopen does, so slack_sdk's error and retry handling applies unchanged
+            raise HTTPError(url, status, reason, headers, io.BytesIO(body))
+        if headers.get_content_type() == "application/gzip":
+            return {"status": status, "headers": headers, "body": body}
+        return {"status": status, "headers": headers, "body": body.decode(headers.get_content_charset() or "utf-8")}
+
+
+class RateLimitedWebClient(PooledWebClient):
+    """A WebClient that paces calls to slack's rate limits instead of failing on a 429.
+
+    Calls go out unpaced until slack answers one with a 429: slack allows bursts well past a tier's
+    per-minute rate, and pacing ahead of it would only slow down e.g. the concurrent name lookups of
+    a large backblast. A 429 gives that method a token bucket at its tier's rate (chat.postMessage
+    gets one per channel), starting empty and holding up to `burst_seconds` worth of calls, and
+    pauses it for the response's Retry-After; the method's calls are paced by the bucket until
+    `paced_seconds` pass without another 429. The call is retried, up to `max_retries` times, unless
+    slack asks for a wait longer than `max_retry_after` seconds. Identical concurrent calls to
+    read-only methods share one request.
+
+    Calls and throttling are counted in the metrics registry: slack_api_call_seconds (each attempt,
+    by method and outcome), slack_api_rate_limited (429s received), slack_api_throttle_wait_seconds
+    (time spent waiting for a token) and slack_api_coalesced_calls.
+
+    Calls go over pooled keep-alive connections (see PooledWebClient). Pass it to bolt as
+    App(client=...). The `client` argument bolt gives listeners is a separate, plain WebClient, so
+    calls that should be paced go through app.client.
+    """
+
+    def __init__(self, *args, tier_limits=None, burst_seconds=10, paced_seconds=60, max_retries=3,
+                 max_retry_after=30, clock=time.monotonic, sleep=time.sleep, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tier_limits = {**TIER_LIMITS, **(tier_limits or {})}
+        self.burst_seconds = burst_seconds
+        self.paced_seconds = paced_seconds
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.clock = clock
+        self.sleep = sleep
+        # (method,) or (method, channel): (bucket, time of the last 429)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _get_bucket(self, api_method, kwargs, rate_limited=False):
+        """Returns the bucket pacing this call, or None while its method hasn't had a 429 lately.
+
+        With `rate_limited`, records a 429 for the call, making its bucket if it has none.
+        """
+        if api_method == "chat.postMessage":
+            args = kwargs.get("json") or kwargs.get("data") or kwargs.get("params") or {}
+            key = (api_method, args.get("channel"))
+            per_minute = POST_MESSAGE_LIMIT
+        else:
+            key = (api_method,)
+            per_minute = self.tier_limits[METHOD_TIERS.get(api_method, 3)]
+        now = self.clock()
+        with self._buckets_lock:
+            bucket, rate_limited_at = self._buckets.get(key, (None, None))
+            if rate_limited:
+                if bucket is None:
+                    rate = per_minute / 60
+                    capacity = max(1.0, rate * self.burst_seconds)
+                    bucket = TokenBucket(rate, capacity, clock=self.clock, sleep=self.sleep, tokens=0)
+                self._buckets[key] = (bucket, now)
+            elif bucket is not None and now - rate_limited_at > self.paced_seconds:
+                del self._buckets[key]
+                bucket = None
+            return bucket
+
+    def api_call(self, api_method, **kwargs):
+        if api_method not in COALESCED_METHODS:
+            return self._paced_api_call(api_method, kwargs)
+
+        key = (api_method, json.dumps(kwargs, sort_keys=True, default=str))
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._inflight[key] = Future()
+        if not is_leader:
+            registry.counter("slack_api_coalesced_calls", method=api_method).inc()
+            return future.result()
+
+        try:
+            response = self._paced_api_call(api_method, kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _paced_api_call(self, api_method, kwargs):
+        for attempt in range(self.max_retries + 1):
+            bucket = self._get_bucket(api_method, kwargs)
+            waited = bucket.acquire() if bucket is not None else 0
+            if waited > 0:
+                registry.histogram("slack_api_throttle_wait_seconds", method=api_method).observe(waited)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                response = super().api_call(api_method, **kwargs)
+                outcome = "ok"
+                return response
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    raise
+                outcome = "rate_limited"
+                registry.counter("slack_api_rate_limited", method=api_method).inc()
+                retry_after = float(_get_header(e.response.headers, "Retry-After") or 1)
+                bucket = self._get_bucket(api_method, kwargs, rate_limited=True)
+                if attempt == self.max_retries or retry_after > self.max_retry_after:
+                    raise
+                logger.warning(f"Rate limited on {api_method} (attempt {attempt + 1}), retrying in {retry_after}s")
+                bucket.pause(retry_after)
+            finally:
+                registry.histogram("slack_api_call_seconds", method=api_method, outcome=outcome).observe(
+                    time.perf_counter() - start
+                )
@@ -0,0 +1,104 @@
+import json
+import os
+import threading
+
+
+class UnknownTeamError(KeyError):
+    pass
+
+
+class TeamConfig:
+    """Settings for one workspace served by a deployment.
+
+    Secrets can be given directly (bot_token, signing_secret) or, to keep them out of the config,
+    as the names of environment variables holding them (bot_token_env, signing_secret_env).
+    """
+
+    def __init__(self, team_id, name=None, bot_token=None, signing_secret=None, first_f_channel=None,
+                 third_f_channel=None, spreadsheet_id=None, paxmate_say_authorized_slack_ids=()):
+        self.team_id = team_id
+        self.name = name or team_id
+        self.bot_token = bot_token
+        self.signing_secret = signing_secret
+        self.first_f_channel = first_f_channel
+        self.third_f_channel = third_f_channel
+        self.spreadsheet_id = spreadsheet_id
+        if isinstance(paxmate_say_authorized_slack_ids, str):
+            paxmate_say_authorized_slack_ids = paxmate_say_authorized_slack_ids.replace(" ", "").split(",")
+        self.paxmate_say_authorized_slack_ids = list(paxmate_say_authorized_slack_ids)
+
+    @classmethod
+    def from_dict(cls, entry, environ=os.environ):
+        entry = dict(entry)
+        for field in ("bot_token", "signing_secret"):
+            env_name = entry.pop(f"{field}_env", None)
+            if env_name and not entry.get(field):
+                entry[field] = environ.get(env_name)
+        return cls(**entry)
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        """The workspace configured by a single-region deployment's own env vars."""
+        return cls(
+            team_id=environ.get("SLACK_TEAM_ID"),
+            bot_token=environ.get("SLACK_BOT_TOKEN"),
+            signing_secret=environ.get("SLACK_SIGNING_SECRET"),
+            first_f_channel=environ.get("FIRST_F_CHANNEL"),
+            third_f_channel=environ.get("THIRD_F_CHANNEL"),
+            spreadsheet_id=environ.get("SPREADSHEET_ID"),
+            paxmate_say_authorized_slack_ids=environ.get("PAXMATE_SAY_AUTHORIZED_SLACK_IDS", ""),
+        )
+
+
+def load_team_configs(environ=os.environ):
+    """Returns {team_id: TeamConfig} for a multi-workspace deployment, or {} for a single-workspace one.
+
+    Teams come from TEAMS_CONFIG (json) or the json file at TEAMS_CONFIG_PATH: either a list of
+    TeamConfig fields, or an object of them keyed by team id. The workspace in the deployment's
+    own env vars (SLACK_TEAM_ID, SLACK_BOT_TOKEN, ...) is included too, unless it is listed.
+    """
+    raw = environ.get("TEAMS_CONFIG")
+    path = environ.get("TEAMS_CONFIG_PATH")
+    if not raw and path:
+        with open(path) as f:
+            raw = f.read()
+    if not raw:
+        return {}
+
+    entries = json.loads(raw)
+    if isinstance(entries, dict):
+        entries = [{"team_id": team_id, **entry} for team_id, entry in entries.items()]
+    configs = {}
+    for entry in entries:
+        config = TeamConfig.from_dict(entry, environ)
+        configs[config.team_id] = config
+    env_config = TeamConfig.from_env(environ)
+    if env_config.team_id and env_config.team_id not in configs:
+        configs[env_config.team_id] = env_config
+    return configs
+
+
+class TeamRegistry:
+    """Builds each team's state (clients, caches) from its config on first use, and keeps it."""
+
+    def __init__(self, configs, build):
+        self.configs = configs
+        self.build = build
+        self._teams = {}
+        self._lock = threading.Lock()
+
+    def get(self, team_id):
+        with self._lock:
+            team = self._teams.get(team_id)
+            if team is None:
+                config = self.configs.get(team_id)
+                if config is None:
+                    raise UnknownTeamError(team_id)
+                team = self._teams[team_id] = self.build(config)
+            return team
+
+    def __contains__(self, team_id):
+        return team_id in self.configs
+
+    def __len__(self):
+        return len(self.configs)
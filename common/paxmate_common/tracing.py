@@ -0,0 +1,169 @@
+import contextlib
+import contextvars
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+
+# W3C trace context: version-trace_id-parent_span_id-flags
+TRACEPARENT_HEADER = "traceparent"
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current = contextvars.ContextVar("paxmate_trace_context", default=None)
+
+
+class SpanContext:
+    """The ids that link a span to its trace; what a traceparent header carries from one hop to the next."""
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def to_traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def from_traceparent(cls, value):
+        """Returns the context in a traceparent header value, or None when it isn't a valid one."""
+        match = _TRACEPARENT.match((value or "").strip().lower())
+        if match is None or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+            return None
+        return cls(match.group(1), match.group(2))
+
+
+class Span:
+    def __init__(self, name, context, parent_id, attributes):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.end_time = None
+        self.status = "ok"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_seconds": self.end_time - self.start_time if self.end_time is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class StdoutExporter:
+    """Writes each finished span as a json line that Cloud Logging reads as a structured entry."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def export(self, span):
+        stream = self.stream or sys.stdout
+        function = os.environ.get("K_SERVICE") or os.environ.get("FUNCTION_NAME")
+        stream.write(json.dumps({"severity": "INFO", "message": f"span {span.name}", "function": function,
+                                 **span.to_dict()}) + "\n")
+        stream.flush()
+
+
+class FileExporter:
+    """Appends each finished span to `path` as a json line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self._lock, open(self.path, "a") as f:
+            f.write(line)
+
+
+def build_exporter(spec):
+    """The exporter for a TRACE_EXPORTER value: "stdout", "file:/path/to/spans.jsonl", or none ("" or "none")."""
+    if not spec or spec == "none":
+        return None
+    if spec == "stdout":
+        return StdoutExporter()
+    if spec.startswith("file:"):
+        return FileExporter(spec[len("file:"):])
+    raise ValueError(f"Unknown TRACE_EXPORTER {spec!r}")
+
+
+class Tracer:
+    """Records spans and hands each finished one to `exporter`.
+
+    Ids are made and propagated even without an exporter, so a downstream hop that does export
+    still joins the upstream trace.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attributes):
+        """Times the block as a span, current for its duration, labelled status=ok or status=error.
+
+        The parent is `parent` (e.g. a context from extract()) or else the current span; with
+        neither, the span starts a new trace.
+        """
+        parent = parent or _current.get()
+        trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        span = Span(name, SpanContext(trace_id, secrets.token_hex(8)), parent.span_id if parent else None, attributes)
+        token = _current.set(span.context)
+        try:
+            yield span
+        except BaseException:
+            span.status = "error"
+            raise
+        finally:
+            _current.reset(token)
+            span.end_time = time.time()
+            if self.exporter is not None:
+                self.exporter.export(span)
+
+
+tracer = Tracer(build_exporter(os.environ.get("TRACE_EXPORTER")))
+
+
+def current_context():
+    """The context of the current span, or None outside of any span."""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def use_context(context):
+    """Makes `context` current for the block, e.g. on a worker thread handling a queued task."""
+    token = _current.set(context)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def inject(headers=None, context=None):
+    """Adds a traceparent header for `context` (default: the current span's) to `headers`, and returns them."""
+    headers = {} if headers is None else headers
+    context = context or _current.get()
+    if context is not None:
+        headers[TRACEPARENT_HEADER] = context.to_traceparent()
+    return headers
+
+
+def extract(headers):
+    """The context in a request's traceparent header, or None."""
+    if headers is None:
+        return None
+    for key, value in headers.items():
+        if key.lower() == TRACEPARENT_HEADER:
+            return SpanContext.from_traceparent(value)
+    return None
@@ -0,0 +1,26 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _run_step(step):
+    start = time.perf_counter()
+    try:
+        step()
+        status = "ok"
+    except Exception as e:
+        status = f"error: {e}"
+    return {"status": status, "seconds": round(time.perf_counter() - start, 4)}
+
+
+def run_warmup_steps(steps):
+    """Runs (name, function) warmup steps concurrently and returns each one's status and duration.
+
+    A failing step is reported rather than raised, so one unavailable dependency doesn't keep the
+    others cold.
+    """
+    steps = list(steps)
+    if not steps:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="warmup") as executor:
+        futures = [(name, executor.submit(_run_step, step)) for name, step in steps]
+        return {name: future.result() for name, future in futures}
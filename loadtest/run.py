@@ -0,0 +1,394 @@
+"""Replays recorded slack payloads against slackbot() and f3_sheets_handler, and reports latency and api calls.
+
+Both entry points are served on localhost by threaded WSGI servers, as Cloud Functions would run
+them, with stand-ins (see standins.py) for slack, Cloud Tasks, Sheets and Cockroach. Lazy listeners
+are re-posted to the slackbot (SLACKBOT_URL), and tasks are dispatched to the sheets handler over
+http, so a backblast takes the same path it does in production.
+
+Scenarios, each replaying a payload from payloads/ (view_submission: the slackbot tests' fixture) with fresh ids:
+
+- backblast_command: /backblast slash commands, which open the modal
+- pax_select: block_actions, in bursts of picks on each modal
+- view_submission: backblast submissions; reports the ack and, separately, the time until the sheets
+  handler is done with the backblast, then, from the spans of each backblast's trace, the time from
+  submit until it is visible in the channel and how long each hop on the way took
+- sheets_handler: backblast tasks posted straight to the sheets handler
+
+For each scenario: p50/p95/p99 latency, throughput, and the calls it made to each stand-in.
+
+Run from the repository root, with both functions' requirements installed:
+    python loadtest/run.py --requests 50 --concurrency 50 --slack-latency 0.05
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import http.client
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+# The slackbot's main is imported as main; the sheets handler's is loaded from its file (see _load_sheets_main)
+sys.path[:0] = [
+    HERE,
+    os.path.join(ROOT, "common"),
+    os.path.join(ROOT, "slackbot", "slackbot"),
+    os.path.join(ROOT, "sheets_task", "src"),
+]
+
+SCENARIOS = ("backblast_command", "pax_select", "view_submission", "sheets_handler")
+SIGNING_SECRET = "loadtest-signing-secret"
+PAX_PER_SUBMISSION = 12
+PICKS_PER_MODAL = 5
+# Rows of the view_submission trace breakdown, in the order a backblast passes through them
+HOPS = (
+    "  ack",
+    "  lazy listener dispatch",
+    "  backblast.parse",
+    "  backblast.enqueue",
+    "  task dispatch",
+    "  backblast.enrich",
+    "  cockroach.transaction",
+    "  sheets.append",
+    "  backblast.post",
+    "  submit to visible in channel",
+)
+
+
+def _load_payload(name, directory=os.path.join(HERE, "payloads")):
+    with open(os.path.join(directory, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Sample:
+    def __init__(self, started_at, seconds, ok):
+        self.started_at = started_at
+        self.seconds = seconds
+        self.ok = ok
+
+
+def _post(port, body, headers):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    start = time.perf_counter()
+    try:
+        connection.request("POST", "/", body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        ok = response.status < 400
+    except OSError:
+        ok = False
+    finally:
+        connection.close()
+    return Sample(start, time.perf_counter() - start, ok)
+
+
+def _signed_headers(body, content_type="application/x-www-form-urlencoded"):
+    timestamp = str(int(time.time()))
+    from slack_sdk.signature import SignatureVerifier
+    return {
+        "Content-Type": content_type,
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": SignatureVerifier(SIGNING_SECRET).generate_signature(timestamp=timestamp, body=body),
+    }
+
+
+def _replay(port, bodies, concurrency, content_type="application/x-www-form-urlencoded", sign=True):
+    def _send(body):
+        headers = _signed_headers(body, content_type) if sign else {"Content-Type": content_type}
+        return _post(port, body, headers)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(_send, bodies))
+
+
+def _interaction(payload):
+    return urllib.parse.urlencode({"payload": json.dumps(payload)})
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.run_id = uuid.uuid4().hex[:8]
+        self.pax_pool = [f"Upax{i:04d}" for i in range(args.users)]
+        self.rows = []
+
+    def start(self):
+        args = self.args
+        import standins
+        from paxmate_common import tracing
+        from standin_slack import StandInSlack
+
+        self.slack = StandInSlack(latency=args.slack_latency, n_users=args.users).start()
+        self.sheets = standins.StandInSheetsService(latency=args.sheets_latency)
+        self.slackbot_port = _free_port()
+        self.sheets_port = _free_port()
+
+        self._work_dir = tempfile.TemporaryDirectory()
+        self.spans_path = os.path.join(self._work_dir.name, "spans.jsonl")
+        database_url = args.database_url
+        if database_url is None:
+            database_url = f"sqlite:///{os.path.join(self._work_dir.name, 'cockroach.sqlite3')}?timeout=60"
+
+        os.environ.update({
+            "SLACK_BOT_TOKEN": "xoxb-loadtest",
+            "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+            "SLACK_TEAM_ID": "Tisateamid",
+            "SLACK_API_URL": self.slack.url,
+            "SLACKBOT_URL": f"http://127.0.0.1:{self.slackbot_port}/",
+            "TASK_SINK": "thread",
+            "BACKBLAST_PAYLOAD_VERSION": str(args.payload_version),
+            "COCKROACH_CONNECTION_STRING": database_url,
+            "FIRST_F_CHANNEL": "C1stf",
+            "THIRD_F_CHANNEL": "C3rdf",
+            "SPREADSHEET_ID": "loadtest",
+            "METRICS_LOG": "1" if args.verbose else "0",
+            "SHEETS_BATCH_WINDOW_SECONDS": str(args.sheets_batch_window),
+        })
+
+        # Both functions' spans, for the per-hop breakdown of view_submission
+        tracing.tracer.exporter = tracing.FileExporter(self.spans_path)
+
+        # The sheets handler builds a sheets resource on each thread that appends, and again after a failed append
+        from googleapiclient import discovery
+        discovery.build = lambda *build_args, **build_kwargs: self.sheets
+
+        import main as slackbot_main
+        self.slackbot_main = slackbot_main
+        self.sheets_main = self._load_sheets_main()
+
+        import sheets_task.db
+        self.db_calls = standins.prepare_database(sheets_task.db.get_cockroach_engine(), latency=args.db_latency)
+
+        self.tasks = standins.StandInCloudTasks(
+            f"http://127.0.0.1:{self.sheets_port}/",
+            enqueue_latency=args.enqueue_latency,
+            dispatch_latency=args.dispatch_latency,
+            max_concurrent_dispatches=args.max_concurrent_dispatches,
+        )
+        slackbot_main.task_sink = self.tasks
+
+        self._serve(self.slackbot_port, slackbot_main.slackbot)
+        self._serve(self.sheets_port, self.sheets_main.f3_sheets_handler)
+        if not args.cold:
+            self._warm_up()
+
+    def _load_sheets_main(self):
+        path = os.path.join(ROOT, "sheets_task", "src", "main.py")
+        spec = importlib.util.spec_from_file_location("sheets_main", path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["sheets_main"] = module
+        spec.loader.exec_module(module)
+        return module
+
+    def _serve(self, port, entry_point):
+        from flask import Flask, request
+        from werkzeug.serving import make_server
+
+        flask_app = Flask(entry_point.__name__)
+        # Every path, as a cloud function gets them (e.g. /healthz)
+        flask_app.add_url_rule("/", entry_point.__name__, lambda: entry_point(request), methods=["GET", "POST"])
+        flask_app.add_url_rule("/<path:path>", f"{entry_point.__name__}_path", lambda path: entry_point(request),
+                               methods=["GET", "POST"])
+        server = make_server("127.0.0.1", port, flask_app, threaded=True)
+        threading.Thread(target=server.serve_forever, name=f"serve-{entry_point.__name__}", daemon=True).start()
+
+    def _warm_up(self):
+        # As the scheduled warmup does in production: the slackbot prefetches its user and channel directories
+        for port in (self.slackbot_port, self.sheets_port):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/healthz?warm=1", timeout=self.args.timeout) as response:
+                response.read()
+
+    def _calls(self):
+        calls = {}
+        for prefix, counter in (("slack", self.slack.calls), ("", self.tasks.calls), ("", self.sheets.calls),
+                                ("", self.db_calls)):
+            for name, n in counter.snapshot().items():
+                calls[f"{prefix}.{name}" if prefix else name] = n
+        return calls
+
+    def _submission(self, i):
+        body = _load_payload("view_submission_no_ao", directory=os.path.join(ROOT, "slackbot", "tests", "payloads"))
+        pax = random.sample(self.pax_pool, PAX_PER_SUBMISSION)
+        values = body["view"]["state"]["values"]
+        values["date-ao-q"]["ao-select"]["selected_channel"] = "Cisachannelid"
+        values["date-ao-q"]["q-select"]["selected_user"] = pax[0]
+        values["pax-select"]["pax-select"]["selected_users"] = pax
+        body["user"]["id"] = pax[0]
+        body["view"]["id"] = f"V{self.run_id}{i:05d}"
+        body["view"]["hash"] = f"{time.time():.0f}.{self.run_id}"
+        return body
+
+    def backblast_command(self, n):
+        template = _load_payload("backblast_command")
+        bodies = []
+        for i in range(n):
+            command = dict(template, trigger_id=f"{self.run_id}.{i}", user_id=random.choice(self.pax_pool))
+            bodies.append(urllib.parse.urlencode(command))
+        return {"backblast_command": _replay(self.slackbot_port, bodies, self.args.concurrency)}
+
+    def pax_select(self, n):
+        template = _load_payload("pax_select")
+        bodies = []
+        for modal in range(max(1, n // PICKS_PER_MODAL)):
+            view_id = f"V{self.run_id}pick{modal:04d}"
+            pax = random.sample(self.pax_pool, PICKS_PER_MODAL)
+            for pick in range(1, PICKS_PER_MODAL + 1):
+                action = copy.deepcopy(template)
+                action["view"]["id"] = view_id
+                action["actions"][0]["selected_users"] = pax[:pick]
+                action["actions"][0]["action_ts"] = f"{time.time():.6f}"
+                bodies.append(_interaction(action))
+        return {"pax_select": _replay(self.slackbot_port, bodies, self.args.concurrency)}
+
+    def view_submission(self, n):
+        submissions = [self._submission(i) for i in range(n)]
+        acks = _replay(self.slackbot_port, [_interaction(body) for body in submissions], self.args.concurrency)
+
+        backblast_ids = [self.slackbot_main._get_backblast_id(body) for body in submissions]
+        deadline = time.time() + self.args.timeout
+        while time.time() < deadline and not all(backblast_id in self.tasks.completed for backblast_id in backblast_ids):
+            time.sleep(0.05)
+        end_to_end = []
+        for ack, backblast_id in zip(acks, backblast_ids):
+            completed_at = self.tasks.completed.get(backblast_id)
+            ok = completed_at is not None
+            end_to_end.append(Sample(ack.started_at, (completed_at or time.perf_counter()) - ack.started_at, ok))
+        return {
+            "view_submission (ack)": acks,
+            "view_submission (stored and posted)": end_to_end,
+            **self._hops(set(backblast_ids)),
+        }
+
+    def _hops(self, backblast_ids):
+        """Per-hop samples from the traces of these backblasts: each one's spans, from the ack to the last post."""
+        traces = {}
+        with open(self.spans_path) as f:
+            for span in map(json.loads, f):
+                traces.setdefault(span["trace_id"], []).append(span)
+
+        hops = {name: [] for name in HOPS}
+        for spans in traces.values():
+            by_name = {}
+            for span in sorted(spans, key=lambda span: span["start_time"]):
+                by_name.setdefault(span["name"], []).append(span)
+            process = by_name.get("backblast.process", [{}])[0]
+            if process.get("attributes", {}).get("backblast_id") not in backblast_ids:
+                continue
+            ack = next(span for span in by_name["slackbot.request"] if span["attributes"]["lazy"] == "0")
+            lazy = next(span for span in by_name["slackbot.request"] if span["attributes"]["lazy"] == "1")
+            enqueue = by_name["backblast.enqueue"][0]
+            handler = by_name.get("sheets.handler", [None])[0]
+
+            def _add(hop, start, end, ok=True):
+                hops[hop].append(Sample(start, end - start, ok))
+
+            _add("  ack", ack["start_time"], ack["end_time"])
+            _add("  lazy listener dispatch", ack["start_time"], lazy["start_time"])
+            for name in ("backblast.parse", "backblast.enqueue"):
+                for span in by_name.get(name, []):
+                    _add(f"  {name}", span["start_time"], span["end_time"], span["status"] == "ok")
+            if handler is None:
+                continue
+            _add("  task dispatch", enqueue["end_time"], handler["start_time"])
+            for name in ("backblast.enrich", "cockroach.transaction", "sheets.append", "backblast.post"):
+                for span in by_name.get(name, []):
+                    _add(f"  {name}", span["start_time"], span["end_time"], span["status"] == "ok")
+            posts = by_name.get("slack.post", [])
+            if posts:
+                _add("  submit to visible in channel", ack["start_time"], max(span["end_time"] for span in posts))
+        return {name: samples for name, samples in hops.items() if samples}
+
+    def sheets_handler(self, n):
+        logger = logging.getLogger("loadtest")
+        resolve_names = self.args.payload_version < 2
+        bodies = []
+        for i in range(n):
+            body = self._submission(n + i)
+            backblast_data = self.slackbot_main._parse_backblast_body(body, logger, resolve_names=resolve_names)
+            payload = {"body": backblast_data}
+            if not resolve_names:
+                payload["version"] = 2
+            bodies.append(json.dumps(payload))
+        return {"sheets_handler": _replay(self.sheets_port, bodies, self.args.concurrency, "application/json", sign=False)}
+
+    def run(self, scenario):
+        before = self._calls()
+        results = getattr(self, scenario)(self.args.requests)
+        after = self._calls()
+        calls = {name: n - before.get(name, 0) for name, n in after.items() if n - before.get(name, 0)}
+        for name, samples in results.items():
+            self.report(name, samples)
+        print(f"    calls: {', '.join(f'{name}={n}' for name, n in sorted(calls.items())) or 'none'}")
+
+    def report(self, name, samples):
+        if not samples:
+            return
+        latencies = [sample.seconds * 1000 for sample in samples]
+        elapsed = max(s.started_at + s.seconds for s in samples) - min(s.started_at for s in samples)
+        print(
+            f"{name:<36} {len(samples):>5} {sum(s.ok for s in samples):>5}"
+            f" {_percentile(latencies, 0.5):>8.0f} {_percentile(latencies, 0.95):>8.0f} {_percentile(latencies, 0.99):>8.0f}"
+            f" {len(samples) / elapsed:>8.1f}"
+        )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="requests in flight at once")
+    parser.add_argument("--users", type=int, default=150, help="members of the stand-in workspace")
+    parser.add_argument("--payload-version", type=int, default=1, help="BACKBLAST_PAYLOAD_VERSION")
+    parser.add_argument("--slack-latency", type=float, default=0.05, help="seconds per slack api call")
+    parser.add_argument("--enqueue-latency", type=float, default=0.08, help="seconds to create a cloud task")
+    parser.add_argument("--dispatch-latency", type=float, default=0.1, help="seconds before a task is dispatched")
+    parser.add_argument("--max-concurrent-dispatches", type=int, default=100)
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="seconds per sheets api call")
+    parser.add_argument("--sheets-batch-window", type=float, default=0,
+                        help="SHEETS_BATCH_WINDOW_SECONDS of the sheets handler (0: an append per backblast)")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="seconds per database statement")
+    parser.add_argument("--database-url", help="sqlalchemy url of the database (default: a temporary sqlite file)")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for backblasts to be handled")
+    parser.add_argument("--cold", action="store_true",
+                        help="skip the scheduled warmup (/healthz?warm=1), so name lookups start from empty caches")
+    parser.add_argument("--verbose", action="store_true", help="keep the functions' info and metrics logging")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.requests)
+    load_test = LoadTest(args)
+    load_test.start()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    print(f"{'scenario':<36} {'n':>5} {'ok':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    for scenario in SCENARIOS if args.scenario == "all" else (args.scenario,):
+        load_test.run(scenario)
+
+
+if __name__ == "__main__":
+    main()
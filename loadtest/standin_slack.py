@@ -0,0 +1,151 @@
+"""A stand-in for the slack api on localhost, shared by the load test, the slackbot's benchmarks and its tests.
+
+Standard library only, so it can be imported without either function's requirements.
+"""
+import collections
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+
+class CallCounter:
+    def __init__(self):
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+
+class StandInSlack:
+    """Serves the slack api on localhost; every call takes `latency` seconds.
+
+    users.list lists `n_users` members (Upax0000, Upax0001, ...) in pages of `page_size`;
+    conversations.info reports every channel as an AO the bot is a member of. auth.test answers
+    for `team_id`.
+
+    Each new connection first takes `connect_latency` seconds (the round trips of a TCP and TLS
+    handshake to slack), and with `ssl_context` (a server-side ssl.SSLContext) the stand-in serves
+    https. The first `n_rate_limited` calls are answered 429, with a Retry-After of `retry_after`.
+    `latency`, `n_rate_limited` and `retry_after` can be changed while it runs. `calls` counts the
+    calls to each method, and `client_ports` holds the port of each connection a client opened.
+    """
+
+    def __init__(self, latency=0.05, n_users=150, page_size=200, team_id="Tisateamid", connect_latency=0.0,
+                 ssl_context=None, n_rate_limited=0, retry_after=1):
+        self.latency = latency
+        self.members = [{"id": f"Upax{i:04d}", "name": f"pax{i}", "profile": {"display_name": f"Pax {i}"}}
+                        for i in range(n_users)]
+        self.page_size = page_size
+        self.team_id = team_id
+        self.connect_latency = connect_latency
+        self.n_rate_limited = n_rate_limited
+        self.retry_after = retry_after
+        self.calls = CallCounter()
+        self.client_ports = set()
+        self._lock = threading.Lock()
+        self._n_calls = 0
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self.scheme = "http"
+        if ssl_context is not None:
+            # Handshake in each connection's handler thread, not one at a time in the accept loop
+            self._server.socket = ssl_context.wrap_socket(
+                self._server.socket, server_side=True, do_handshake_on_connect=False,
+            )
+            self.scheme = "https"
+
+    @property
+    def url(self):
+        return f"{self.scheme}://127.0.0.1:{self._server.server_port}/"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="standin-slack", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, method, args):
+        if method == "auth.test":
+            return {"user_id": "Ubot", "bot_id": "Bbot", "team_id": self.team_id, "team": "f3paxmatedev"}
+        if method == "users.list":
+            start = int(args.get("cursor") or 0)
+            end = start + self.page_size
+            return {
+                "members": self.members[start:end],
+                "response_metadata": {"next_cursor": str(end) if end < len(self.members) else ""},
+            }
+        if method == "users.info":
+            user = args.get("user", "")
+            return {"user": {"id": user, "name": user.lower(), "profile": {"display_name": user}}}
+        if method == "conversations.info":
+            channel = args.get("channel", "")
+            return {"channel": {"id": channel, "name": "ao-the-grid", "is_member": True, "is_archived": False}}
+        if method == "conversations.list":
+            return {"channels": [], "response_metadata": {"next_cursor": ""}}
+        if method == "chat.postMessage":
+            return {"channel": args.get("channel"), "ts": f"{time.time():.6f}"}
+        return {}
+
+    def _record(self, method, client_port):
+        with self._lock:
+            self._n_calls += 1
+            self.client_ports.add(client_port)
+            rate_limited = self._n_calls <= self.n_rate_limited
+        self.calls.add(method)
+        return rate_limited
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and body go out in separate writes; don't let them wait on delayed acks
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                time.sleep(stand_in.connect_latency)
+                super().setup()
+
+            def _respond(self):
+                path, _, query = self.path.partition("?")
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    args = json.loads(raw or "{}")
+                else:
+                    args = dict(urllib.parse.parse_qsl(raw or query))
+                method = path.strip("/")
+                rate_limited = stand_in._record(method, self.client_address[1])
+                time.sleep(stand_in.latency)
+                if rate_limited:
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(stand_in.retry_after))
+                    body = {"ok": False, "error": "ratelimited"}
+                else:
+                    self.send_response(200)
+                    body = {"ok": True, **stand_in.respond(method, args)}
+                encoded = json.dumps(body).encode()
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            do_GET = do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
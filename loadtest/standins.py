@@ -0,0 +1,145 @@
+"""Local stand-ins for the services the functions call, each with an injected latency.
+
+- StandInCloudTasks: a task sink that takes a while to create a task, then posts it to the sheets handler.
+- StandInSheetsService: takes the place of the googleapiclient sheets resource.
+- prepare_database: the cockroach engine, on sqlite (or any sqlalchemy url, e.g. postgres).
+
+Every stand-in counts its calls, so a run can report how many api calls each scenario made. The slack
+stand-in, StandInSlack, is in standin_slack.py.
+"""
+import contextvars
+import json
+import sqlite3
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import ARRAY, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import sqltypes
+
+from paxmate_common import tracing
+from standin_slack import CallCounter
+
+
+class StandInCloudTasks:
+    """A task sink (see slackbot's task_sinks.TaskSink) standing in for Cloud Tasks.
+
+    Creating a task takes `enqueue_latency`; the task is posted to `handler_url` `dispatch_latency`
+    later, at most `max_concurrent_dispatches` at a time, and retried up to `max_attempts` times. Like
+    a cloud task, the request carries the submitter's traceparent and the number of earlier attempts.
+    `completed` maps each task id to the time its handler returned.
+    """
+
+    def __init__(self, handler_url, enqueue_latency=0.08, dispatch_latency=0.1, max_concurrent_dispatches=100,
+                 max_attempts=3):
+        self.handler_url = handler_url
+        self.enqueue_latency = enqueue_latency
+        self.dispatch_latency = dispatch_latency
+        self.max_attempts = max_attempts
+        self.calls = CallCounter()
+        self.completed = {}
+        self._completed_lock = threading.Lock()
+        self._dispatcher = ThreadPoolExecutor(max_workers=max_concurrent_dispatches, thread_name_prefix="standin-tasks")
+
+    def submit(self, payload, task_id):
+        time.sleep(self.enqueue_latency)
+        self.calls.add("tasks.create")
+        headers = tracing.inject({"Content-Type": "application/json"})
+        self._dispatcher.submit(self._dispatch, payload, task_id, headers)
+        return task_id
+
+    def submit_async(self, payload, task_id):
+        # Not TaskSink's small shared pool: this one process stands in for many function instances
+        return _submit_executor.submit(contextvars.copy_context().run, self.submit, payload, task_id)
+
+    def warm(self):
+        return None
+
+    def _dispatch(self, payload, task_id, headers):
+        time.sleep(self.dispatch_latency)
+        for attempt in range(self.max_attempts):
+            self.calls.add("tasks.dispatch")
+            request = urllib.request.Request(
+                self.handler_url, data=json.dumps(payload).encode(),
+                headers={**headers, "X-CloudTasks-TaskRetryCount": str(attempt)}, method="POST",
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    response.read()
+            except Exception:
+                self.calls.add("tasks.failed_attempt")
+                continue
+            with self._completed_lock:
+                self.completed[task_id] = time.perf_counter()
+            return
+
+
+_submit_executor = ThreadPoolExecutor(max_workers=128, thread_name_prefix="standin-enqueue")
+
+
+class _Request:
+    def __init__(self, execute):
+        self.execute = execute
+
+
+class StandInSheetsService:
+    """Takes the place of discovery.build("sheets", "v4"); every request takes `latency` seconds."""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.calls = CallCounter()
+        self.rows = []
+        self._rows_lock = threading.Lock()
+
+    def _call(self, name, result=None, rows=()):
+        def execute(*args, **kwargs):
+            time.sleep(self.latency)
+            self.calls.add(name)
+            with self._rows_lock:
+                self.rows.extend(rows)
+            return result or {}
+        return _Request(execute)
+
+    # service.spreadsheets().values().append(...).execute(), service.spreadsheets().get(...).execute()
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def append(self, spreadsheetId, range, body, valueInputOption, **kwargs):
+        rows = body.get("values", [])
+        return self._call("sheets.values.append", {"updates": {"updatedRows": len(rows)}}, rows)
+
+    def get(self, spreadsheetId, **kwargs):
+        return self._call("sheets.get", {"spreadsheetId": spreadsheetId})
+
+
+@compiles(ARRAY, "sqlite")
+def _compile_array_for_sqlite(type_, compiler, **kwargs):
+    # Arrays are stored as json text
+    return "TEXT"
+
+
+def prepare_database(engine, latency=0.02):
+    """Creates the backblast table and injects `latency` before every statement; returns a CallCounter.
+
+    On sqlite, arrays are stored as json and dates as the strings the handler passes, as cockroach accepts.
+    """
+    import sheets_task.model
+
+    calls = CallCounter()
+    if engine.dialect.name == "sqlite":
+        sqlite3.register_adapter(list, json.dumps)
+        engine.dialect.colspecs = {**engine.dialect.colspecs, sqltypes.Date: sqltypes.String}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Before the statement, so a sqlite write lock isn't held while waiting
+        calls.add(f"db.{statement.split(None, 1)[0].lower()}")
+        time.sleep(latency)
+
+    sheets_task.model.Base.metadata.create_all(engine)
+    return calls
@@ -0,0 +1,91 @@
+"""Rows/sec of storing backblasts one transaction each (the task path) against one batched transaction.
+
+- "single": a run_transaction per backblast that upserts it, and another that records its status, as
+  f3_sheets_handler does for a task.
+- "batched": the same two transactions for BATCH_SIZE backblasts at a time, as a {"backblasts": [...]}
+  request does.
+
+The database is the load test's stand-in (loadtest/standins.py): a temporary sqlite file with
+DB_LATENCY added to every statement, standing in for the round trip to cockroach. Set DATABASE_URL
+to run against a real postgres-compatible database instead (e.g. cockroach start-single-node).
+
+Reports rows/sec and statements per backblast for each path.
+
+Run from the sheets_task directory: python benchmarks/bench_batch_ingest.py
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "loadtest"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "common"))
+
+N_BACKBLASTS = 500
+BATCH_SIZE = 100
+PAX_PER_BACKBLAST = 12
+DB_LATENCY = 0.005
+
+_database_dir = tempfile.TemporaryDirectory()
+os.environ["COCKROACH_CONNECTION_STRING"] = os.environ.get(
+    "DATABASE_URL", f"sqlite:///{os.path.join(_database_dir.name, 'cockroach.sqlite3')}",
+)
+
+from sqlalchemy_cockroachdb import run_transaction  # noqa: E402
+
+import sheets_task  # noqa: E402
+import standins  # noqa: E402
+
+
+def _backblasts(run, n):
+    return [
+        sheets_task.model.Backblast(
+            store_date=datetime.datetime.now(), date="2023-06-05", q="Torpedo", q_id="Upax0000", ao="ao-the-grid",
+            ao_id="Cisachannelid", summary="merkins and more merkins",
+            pax=[f"pax{p}" for p in range(PAX_PER_BACKBLAST)], pax_ids=[f"Upax{p:04d}" for p in range(PAX_PER_BACKBLAST)],
+            fngs=[], fng_ids=[], pax_no_slack="", n_visiting_pax=0, submitter_id="Upax0000", submitter="Torpedo",
+            team_id="Tbench", id=f"{run}-{i:05d}",
+        )
+        for i in range(n)
+    ]
+
+
+def _store(Session, backblasts):
+    run_transaction(Session, lambda s: sheets_task.model.upsert_backblasts(s, backblasts))
+    ids = [backblast.id for backblast in backblasts]
+    run_transaction(Session, lambda s: sheets_task.model.mark_backblast_status(s, ids, stored_at=datetime.datetime.now()))
+
+
+def _single(Session, backblasts):
+    for backblast in backblasts:
+        _store(Session, [backblast])
+
+
+def _batched(Session, backblasts):
+    for start in range(0, len(backblasts), BATCH_SIZE):
+        _store(Session, backblasts[start:start + BATCH_SIZE])
+
+
+def main():
+    engine = sheets_task.db.get_cockroach_engine()
+    calls = standins.prepare_database(engine, latency=DB_LATENCY)
+    Session = sheets_task.db.get_cockroach_sessionmaker()
+
+    print(f"{N_BACKBLASTS} backblasts, {DB_LATENCY * 1000:.0f}ms per statement, {engine.dialect.name}")
+    print(f"{'path':<10} {'seconds':>8} {'rows/s':>8} {'statements/backblast':>22}")
+    run = int(time.time())
+    for name, store in (("single", _single), ("batched", _batched)):
+        backblasts = _backblasts(f"{run}-{name}", N_BACKBLASTS)
+        before = sum(calls.snapshot().values())
+        start = time.perf_counter()
+        store(Session, backblasts)
+        elapsed = time.perf_counter() - start
+        statements = sum(calls.snapshot().values()) - before
+        print(f"{name:<10} {elapsed:>8.2f} {N_BACKBLASTS / elapsed:>8.0f} {statements / N_BACKBLASTS:>22.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# Cloud Functions runs main.py with src/ on the path, and the deploy workflow copies
+# the shared paxmate_common package into it. Mirror that for the tests.
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, "src"))
+sys.path.insert(0, os.path.join(here, "..", "common"))
+
+# main.py builds its slack client at import, from the environment. The tests never reach slack: any token
+# will do, and the client points at a closed local port, so a call a test forgot to mock fails fast
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-test")
+os.environ.setdefault("SLACK_API_URL", "http://127.0.0.1:9/")
@@ -1,43 +1,267 @@
+import contextvars
 import datetime
 import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from flask import make_response
 
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
 from slack_bolt import App
-from sqlalchemy_cockroachdb import run_transaction
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
 
+from paxmate_common import tracing
+from paxmate_common.directory import ChannelDirectory, UserDirectory
+from paxmate_common.metrics import logs_metrics, registry, render_metrics
+from paxmate_common.slack_client import HTTPConnectionPool, RateLimitedWebClient
+from paxmate_common.teams import TeamRegistry, UnknownTeamError, load_team_configs
+from paxmate_common.tracing import tracer
+from paxmate_common.warmup import run_warmup_steps
 import sheets_task
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-service = discovery.build('sheets', 'v4', cache_discovery=False)
+# A googleapiclient resource makes its requests with one httplib2.Http, which isn't thread-safe, and the
+# sheets sink runs on sink_executor's threads: each thread builds its own resource, on first use
+_sheets_services = threading.local()
+
+
+def _get_sheets_service():
+    service = getattr(_sheets_services, "service", None)
+    if service is None:
+        service = _sheets_services.service = discovery.build('sheets', 'v4', cache_discovery=False)
+    return service
+
+
+def _discard_sheets_service():
+    # After a connection error; this thread's next request builds a new resource
+    _sheets_services.service = None
 
 # TODO(multi-tenant) may want to bifurcate this data
 # Spreadsheet to which to save data
 spreadsheet_id = os.environ.get("SPREADSHEET_ID", '1c1vvx07AXdnu6NSa4is4a0oyUiu8q3cgOecFbTNWlAY')
 
+# Workspaces served by a multi-workspace deployment (TEAMS_CONFIG or TEAMS_CONFIG_PATH); empty when
+# the deployment serves only the workspace in its own env vars.
+team_configs = load_team_configs()
+
+# Where slack api calls go; only changed to point at a stand-in, e.g. for load tests
+slack_api_url = os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
+
+# Connections to slack, shared by every workspace's client
+slack_http_pool = HTTPConnectionPool(
+    max_idle=int(os.environ.get("SLACK_HTTP_POOL_SIZE", 10)),
+    idle_timeout=float(os.environ.get("SLACK_HTTP_IDLE_TIMEOUT_SECONDS", 30)),
+)
+
 # TODO(multi-tenant) this will need to change to an oauth flow
-app = App(
-    token=os.environ.get("SLACK_BOT_TOKEN"),
+# A multi-workspace deployment has a client per team instead (see Team)
+app = None if team_configs else App(
+    # Paces calls to slack's rate limits, retrying 429s rather than failing them, over pooled connections
+    client=RateLimitedWebClient(
+        token=os.environ.get("SLACK_BOT_TOKEN"), base_url=slack_api_url, http_pool=slack_http_pool,
+    ),
     signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
     process_before_response=True,
+    # Only the client is used here: this function serves Cloud Tasks, never slack's requests, so
+    # there's no signature to check, and no auth.test at import (which would need slack reachable)
+    token_verification_enabled=False,
+    request_verification_enabled=False,
 )
 
+# Names are resolved here for version 2 task payloads, which carry only slack ids
+user_directory = UserDirectory(
+    lambda: app.client,
+    max_size=int(os.environ.get("USER_CACHE_MAX_SIZE", 5000)),
+    ttl=int(os.environ.get("USER_CACHE_TTL_SECONDS", 3600)),
+)
+
+# Channel name and membership, for payloads that don't carry them (version 2, or from an older slackbot)
+channel_directory = ChannelDirectory(lambda: app.client, ttl=int(os.environ.get("CHANNEL_CACHE_TTL_SECONDS", 3600)))
+
+
+class Team:
+    """A workspace of a multi-workspace deployment, with its own client, caches, channels and spreadsheet."""
+
+    def __init__(self, config):
+        self.config = config
+        self.team_id = config.team_id
+        self.first_f_channel = config.first_f_channel
+        self.third_f_channel = config.third_f_channel
+        self.spreadsheet_id = config.spreadsheet_id or spreadsheet_id
+        self.client = RateLimitedWebClient(token=config.bot_token, base_url=slack_api_url, http_pool=slack_http_pool)
+        self.user_directory = UserDirectory(
+            lambda: self.client,
+            max_size=int(os.environ.get("USER_CACHE_MAX_SIZE", 5000)),
+            ttl=int(os.environ.get("USER_CACHE_TTL_SECONDS", 3600)),
+        )
+        self.channel_directory = ChannelDirectory(
+            lambda: self.client, ttl=int(os.environ.get("CHANNEL_CACHE_TTL_SECONDS", 3600)),
+        )
+
+
+class DeploymentTeam:
+    """The one workspace of a single-workspace deployment; its settings and state are this module's."""
+
+    @property
+    def team_id(self):
+        return os.environ.get("SLACK_TEAM_ID")
+
+    @property
+    def first_f_channel(self):
+        return os.environ.get("FIRST_F_CHANNEL")
+
+    @property
+    def third_f_channel(self):
+        return os.environ.get("THIRD_F_CHANNEL")
+
+    @property
+    def spreadsheet_id(self):
+        return spreadsheet_id
+
+    @property
+    def client(self):
+        return app.client
+
+    @property
+    def user_directory(self):
+        return user_directory
+
+    @property
+    def channel_directory(self):
+        return channel_directory
+
+
+teams = TeamRegistry(team_configs, Team)
+deployment_team = DeploymentTeam()
+
+
+def _get_team(team_id):
+    if team_configs:
+        return teams.get(team_id)
+    return deployment_team
+
+
+def _get_all_teams():
+    if team_configs:
+        return [teams.get(team_id) for team_id in team_configs]
+    return [deployment_team]
 
-def f3_sheets_handler(request):
-    global service
 
+def _warm_sheets_service():
+    # On a sink thread, which an idle pool hands the next sink to, so that append finds its resource warm
+    sink_executor.submit(
+        lambda: _get_sheets_service().spreadsheets().get(spreadsheetId=spreadsheet_id, fields="spreadsheetId").execute()
+    ).result()
+
+
+def warm_up():
+    """Makes a sheets api call, opens a cockroach connection and fills every team's user and channel caches."""
+    steps = [("sheets_service", _warm_sheets_service), ("cockroach", sheets_task.db.warm_cockroach_pool)]
+    for team_id, team in zip(team_configs or [None], _get_all_teams()):
+        prefix = f"{team_id}." if team_id else ""
+        steps.append((f"{prefix}user_directory", team.user_directory.prefetch))
+        steps.append((f"{prefix}channel_directory", team.channel_directory.prefetch))
+    return run_warmup_steps(steps)
+
+
+# Buckets for the number of tries a sheets append took
+TRY_COUNT_BUCKETS = (1, 2, 3, float("inf"))
+# Buckets for the size, in backblasts, of the batch each backblast was appended in
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, float("inf"))
+
+
+def _append_rows(spreadsheet_id, rows):
+    _get_sheets_service().spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id,
+        range="__RAW",
+        body={"values": rows},
+        valueInputOption="RAW"
+    ).execute()
+
+
+# With SHEETS_BATCH_WINDOW_SECONDS set, the rows of backblasts handled at the same time on this instance
+# (gen2 concurrency, or the in-process task sinks) go to the sheet in one append, to stay under the sheets
+# write quota when a whole region posts at once. Off by default: with one request per instance, the wait
+# would only add latency.
+sheets_batch_window = float(os.environ.get("SHEETS_BATCH_WINDOW_SECONDS", 0))
+sheets_batcher = sheets_task.batching.AppendBatcher(
+    _append_rows,
+    max_rows=int(os.environ.get("SHEETS_BATCH_MAX_ROWS", 500)),
+    window=sheets_batch_window,
+) if sheets_batch_window > 0 else None
+
+# With SHEETS_PROJECTION=1, cockroach is the only write a backblast waits for: its rows are appended to
+# the sheet afterwards, in large chunks, by POST /project (run on a schedule), so a sheets outage or quota
+# limit only delays the sheet. Off by default, which appends each backblast's rows as it is handled.
+sheets_projection = sheets_task.projection.SheetsProjection(
+    _append_rows,
+    chunk_size=int(os.environ.get("SHEETS_PROJECTION_CHUNK_SIZE", 500)),
+    lag_seconds=float(os.environ.get("SHEETS_PROJECTION_LAG_SECONDS", 60)),
+) if os.environ.get("SHEETS_PROJECTION", "0") == "1" else None
+
+
+@logs_metrics
+def f3_sheets_handler(request):
     if request.method == "GET" and request.path.endswith("/healthz"):
         print("health check")
+        if request.args.get("warm"):
+            # /healthz?warm=1 (the scheduled warmup) also primes clients and caches, and reports how long each took
+            return make_response(json.dumps({"status": "alive", "path": request.path, "warm": warm_up()}), 200)
         return make_response(f'{{"status": "alive", "path": "{request.path}"}}', 200)
+    if request.method == "GET" and request.path.endswith("/metrics"):
+        metrics_body, content_type = render_metrics(request.args.get("format"))
+        return make_response(metrics_body, 200, {"Content-Type": content_type})
+    if request.method == "POST" and request.path.endswith("/project"):
+        return _project_to_sheets(request.args.get("max_chunks", type=int))
+
+    # Tasks carry the slackbot's enqueue span as their traceparent, so this joins the submission's trace
+    with tracer.span("sheets.handler", parent=tracing.extract(request.headers)) as span:
+        payload = request.get_json()
+        if "backblasts" in payload:
+            return _handle_backblast_batch(payload, span)
+        # Cloud tasks counts the earlier deliveries of a task in this header
+        retry_count = int(request.headers.get("X-CloudTasks-TaskRetryCount") or 0)
+        return _handle_backblast_task(payload, span, retry_count)
 
-    start = time.time()
-    body = request.get_json().get("body", {})
+
+def _project_to_sheets(max_chunks=None):
+    """Runs the sheets projection for each spreadsheet this deployment writes to; reports how far each got."""
+    if sheets_projection is None:
+        return make_response('{"status": "disabled"}', 404)
+    team_ids_by_spreadsheet = {}
+    for team in _get_all_teams():
+        team_ids_by_spreadsheet.setdefault(team.spreadsheet_id, []).append(team.team_id)
+
+    results = {}
+    ok = True
+    with tracer.span("sheets.projection"):
+        for spreadsheet_id, team_ids in team_ids_by_spreadsheet.items():
+            try:
+                # Without SLACK_TEAM_ID, a single-workspace deployment projects every backblast
+                results[spreadsheet_id] = sheets_projection.run(
+                    spreadsheet_id, team_ids=None if None in team_ids else team_ids, max_chunks=max_chunks,
+                )
+            except Exception as e:
+                logger.error(f"Error projecting backblasts to {spreadsheet_id}: {e}")
+                results[spreadsheet_id] = {"error": str(e)}
+                ok = False
+                if isinstance(e, (ConnectionError, HttpError)):
+                    _discard_sheets_service()
+    return make_response(json.dumps({"status": "ok" if ok else "error", "spreadsheets": results}), 200 if ok else 500)
+
+
+def _build_backblast(payload, team):
+    """Returns the task payload's backblast data, with names filled in for version 2 payloads, and its Backblast."""
+    payload_version = str(payload.get("version", 1))
+    with registry.timer("backblast_enrich_seconds", payload_version=payload_version), \
+            tracer.span("backblast.enrich", payload_version=payload_version):
+        body = sheets_task.enrichment.get_backblast_data(payload, team.user_directory, team.channel_directory)
 
     backblast = sheets_task.model.Backblast(
         store_date=datetime.datetime.now(),
@@ -58,71 +282,345 @@ def f3_sheets_handler(request):
         team_id=body.get("team_id"),
         id=body.get("id")
     )
+    return body, backblast
 
-    try:
-        Session = sheets_task.db.get_cockroach_sessionmaker()
-        backblast_cockroach = backblast.get_sqlalchemy_model()
-        run_transaction(Session, lambda s: s.add(backblast_cockroach))
-        now = time.time()
-        logger.info(f"Done saving to cockroachdb after {now - start} seconds.")
-    except Exception as e:
-        logger.error(f"Error storing /backblast data to CockroachDb: {e}")
 
+def _append_to_sheet(spreadsheet_id, rows, batcher=None):
+    """Appends the rows, trying up to 3 times; returns whether it succeeded and the number of tries.
 
-    spreadsheet_request_body = {"values": []}
-    try:
-        spreadsheet_request_body = {
-            "values": backblast.get_rows_model()
-        }
-    except Exception as e:
-        logger.error(f"Error building spreadsheet model: {e}")
-
+    With a batcher, the rows go in its next batch for the spreadsheet.
+    """
     try_count = 0
     done = False
     while not done and try_count < 3:
         try_count += 1
         try:
-            service.spreadsheets().values().append(
-                spreadsheetId=spreadsheet_id,
-                range="__RAW",
-                body=spreadsheet_request_body,
-                valueInputOption="RAW"
-            ).execute()
+            with registry.timer("sheets_append_seconds"), \
+                    tracer.span("sheets.append", try_count=try_count) as append_span:
+                if batcher is None:
+                    _append_rows(spreadsheet_id, rows)
+                else:
+                    # Returns once the batch holding these rows is appended
+                    batch_size = batcher.append(spreadsheet_id, rows)
+                    append_span.set_attribute("batch_size", batch_size)
+                    registry.histogram("sheets_append_batch_size", buckets=BATCH_SIZE_BUCKETS).observe(batch_size)
             done = True
         except (ConnectionError, HttpError):
-            service = discovery.build('sheets', 'v4', cache_discovery=False)
+            _discard_sheets_service()
+    registry.histogram(
+        "sheets_append_try_count", buckets=TRY_COUNT_BUCKETS, outcome="ok" if done else "error",
+    ).observe(try_count)
+    return done, try_count
 
-    now = time.time()
-    logger.info(f"Done saving to sheets after {now - start} seconds (try count: {try_count}).")
 
+def _read_statuses(ids):
+    """Returns the backblast_status of those of the backblasts that have one, or None when they can't be read."""
+    ids = [id_ for id_ in ids if id_]
+    if not ids:
+        return {}
+    try:
+        with registry.timer("backblast_status_read_seconds"):
+            return sheets_task.db.run_cockroach_transaction(
+                lambda s: sheets_task.model.get_backblast_statuses(s, ids)
+            )
+    except Exception as e:
+        logger.error(f"Error reading backblast status: {e}")
+        return None
+
+
+def _mark_status(ids, **columns):
+    """Records backblast_status columns for the backblasts, in a transaction of their own; returns whether it did.
+
+    Failing to record the status (e.g. when cockroach is down, or before the table is created) is
+    logged, and fails neither the sink nor the backblast's other writes.
+    """
     try:
-        post_messages(backblast_data=body)
+        sheets_task.db.run_cockroach_transaction(
+            lambda s: sheets_task.model.mark_backblast_status(s, ids, **columns)
+        )
+        return True
     except Exception as e:
-        logger.error(f"Error posting messages to slack: {e}")
+        # A redelivery can't tell the sink succeeded; see _handle_backblast_task
+        logger.error(f"Error recording {', '.join(columns)} for {len(ids)} backblast(s): {e}")
+        return False
+
+
+def _mark_done(ids, sink):
+    """Records that `sink` (a backblast_status column, e.g. "sheet_appended_at") succeeded for the backblasts."""
+    return _mark_status(ids, **{sink: datetime.datetime.now()})
+
+
+def _post_backblast(backblast_id, body, team, status):
+    """Posts the backblast's messages that a previous delivery didn't.
+
+    Records the messages posted so far and the number of attempts in the backblast's status. Returns
+    whether all of the messages are posted, and whether every message this call posted was recorded.
+    """
+    posted_to = set(status.get("slack_posted_to") or ())
+    posted_before = set(posted_to)
+    columns = {"slack_post_attempts": (status.get("slack_post_attempts") or 0) + 1}
+    posted = False
+    try:
+        with tracer.span("backblast.post"):
+            posted = post_messages(backblast_data=body, team=team, posted_to=posted_to)
+    except Exception as e:
+        # Some of the messages may have been posted; they're recorded below like any others
+        logger.error(f"Error posting backblast {backblast_id} to slack: {e}")
+    columns["slack_posted_to"] = sorted(posted_to)
+    if posted:
+        columns["slack_posted_at"] = datetime.datetime.now()
+    recorded = _mark_status([backblast_id], **columns)
+    return posted, recorded or posted_to == posted_before
+
+
+# A task whose slack post is all that failed is redelivered until this many deliveries have tried to
+# post it, then acknowledged: the backblast is stored, and slack's answer is unlikely to change
+SLACK_POST_MAX_ATTEMPTS = int(os.environ.get("SLACK_POST_MAX_ATTEMPTS", 3))
+
+# Runs a backblast's slack post and sheets append alongside its cockroach write
+sink_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SINK_WORKERS", 16)), thread_name_prefix="sink",
+)
+
+
+def _run_sink(sink, function):
+    """Runs one of a backblast's sinks; returns its outcome ("ok" or "error") and duration, for the response.
+
+    A sink's failure is logged and reported, and doesn't stop the others.
+    """
+    start = time.perf_counter()
+    result = {"outcome": "error"}
+    try:
+        details = function()
+        if details.pop("ok"):
+            result["outcome"] = "ok"
+        result.update(details)
+    except Exception as e:
+        logger.error(f"Error in the {sink} sink: {e}")
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    registry.histogram("backblast_sink_seconds", sink=sink, outcome=result["outcome"]).observe(result["seconds"])
+    return result
+
+
+def _handle_backblast_task(payload, span, retry_count=0):
+    """Stores, appends and posts one backblast task; `retry_count` is the number of earlier deliveries of the task.
+
+    A sink that succeeds records it in backblast_status, so a redelivery skips it. Failed sinks get a
+    500, for cloud tasks to redeliver the task, only when that can't repeat a sink: when every slack
+    message posted and sheet append made by this delivery was recorded. Otherwise (e.g. cockroach is
+    down) the task is acknowledged as incomplete, and its payload logged, to be replayed if need be
+    through a batch request. For the same reason, a redelivery whose status can't be read runs no sink.
+    """
+    start = time.time()
+    backblast_id = payload.get("body", {}).get("id")
+    span.set_attribute("backblast_id", backblast_id)
+    try:
+        team = _get_team(payload.get("body", {}).get("team_id"))
+    except UnknownTeamError as e:
+        # Not acknowledged, so the task is retried once the team is configured
+        logger.error(f"Backblast from unconfigured team {e}")
+        span.status = "error"
+        return make_response('{"status": "unknown team"}', 400)
+
+    # A redelivered task (e.g. after a timeout) only runs the sinks that haven't succeeded yet
+    statuses = _read_statuses([backblast_id])
+    if statuses is None and retry_count > 0:
+        # An earlier delivery may have posted or appended the backblast; running those again could repeat them
+        logger.error(f"Can't read the status of redelivered backblast {backblast_id}; leaving it for a later delivery")
+        span.status = "error"
+        return make_response('{"status": "status unavailable"}', 503)
+    status = (statuses or {}).get(backblast_id, {})
+    done = {sink: status.get(sink) is not None for sink in sheets_task.model.SINKS}
+    if sheets_projection is not None:
+        # Appended later, from cockroach, by the sheets projection
+        done["sheet_appended_at"] = True
+    if all(done.values()):
+        logger.info(f"Backblast {backblast_id} was already stored, appended and posted; skipping it")
+        registry.counter("backblast_sinks_skipped", sink="all").inc()
+        return {"status": "ok", "try_count": 0, "sinks": {sink: {"outcome": "skipped", "seconds": 0} for sink in done}}
+    for sink in sheets_task.model.SINKS:
+        if status.get(sink) is not None:
+            logger.info(f"Backblast {backblast_id}: skipping {sink}, which already succeeded")
+            registry.counter("backblast_sinks_skipped", sink=sink).inc()
+
+    body, backblast = _build_backblast(payload, team)
+
+    def store():
+        with registry.timer("cockroach_transaction_seconds"), tracer.span("cockroach.transaction"):
+            # An upsert, so a backblast stored by an earlier delivery doesn't fail the transaction
+            sheets_task.db.run_cockroach_transaction(lambda s: sheets_task.model.upsert_backblasts(s, [backblast]))
+        _mark_done([backblast.id], "stored_at")
+        return {"ok": True}
+
+    def append():
+        rows = []
+        try:
+            rows = backblast.get_rows_model()
+        except Exception as e:
+            logger.error(f"Error building spreadsheet model: {e}")
+        appended, try_count = _append_to_sheet(team.spreadsheet_id, rows, batcher=sheets_batcher)
+        recorded = _mark_done([backblast.id], "sheet_appended_at") if appended else True
+        return {"ok": appended, "try_count": try_count, "recorded": recorded}
+
+    def post():
+        posted, recorded = _post_backblast(backblast.id, body, team, status)
+        return {"ok": posted, "recorded": recorded}
+
+    # The sinks don't depend on each other, so they run at the same time; the slack post, which
+    # users wait on, is started first, and the cockroach write runs on this thread.
+    sinks = {"slack_posted_at": post, "sheet_appended_at": append, "stored_at": store}
+    results = {sink: {"outcome": "skipped", "seconds": 0} for sink in sinks if done[sink]}
+    futures = {
+        sink: sink_executor.submit(contextvars.copy_context().run, _run_sink, sink, sinks[sink])
+        for sink in ("slack_posted_at", "sheet_appended_at") if not done[sink]
+    }
+    if not done["stored_at"]:
+        results["stored_at"] = _run_sink("stored_at", store)
+    for sink, future in futures.items():
+        results[sink] = future.result()
+
+    try_count = results["sheet_appended_at"].get("try_count", 0)
+    logger.info(f"Done with backblast {backblast_id} after {time.time() - start} seconds: {results}")
+    registry.histogram("sheets_handler_seconds").observe(time.time() - start)
+
+    failed = {sink for sink, result in results.items() if result["outcome"] == "error"}
+    if not failed:
+        return {"status": "ok", "try_count": try_count, "sinks": results}
+    span.status = "error"
+    unrecorded = sorted(sink for sink, result in results.items() if not result.get("recorded", True))
+    if unrecorded:
+        logger.error(
+            f"Not retrying backblast {backblast_id}: {', '.join(sorted(failed))} failed, and a redelivery would"
+            f" repeat {', '.join(unrecorded)}, whose success wasn't recorded. Task payload: {json.dumps(payload)}"
+        )
+        registry.counter("backblast_retry_abandoned", reason="unrecorded").inc()
+        return {"status": "incomplete", "try_count": try_count, "sinks": results}
+    slack_post_attempts = (status.get("slack_post_attempts") or 0) + 1
+    if failed == {"slack_posted_at"} and slack_post_attempts >= SLACK_POST_MAX_ATTEMPTS:
+        logger.error(f"Giving up posting backblast {backblast_id} to slack after {slack_post_attempts} attempts")
+        registry.counter("backblast_slack_post_abandoned").inc()
+        return {"status": "incomplete", "try_count": try_count, "sinks": results}
+    # Not acknowledged, so cloud tasks redelivers the task, and the sinks (and slack messages) that failed run again
+    return make_response(json.dumps({"status": "incomplete", "try_count": try_count, "sinks": results}), 500)
+
+
+def _handle_backblast_batch(payload, span):
+    """Stores a list of task payloads (replays, backfills, drained queues) with one cockroach transaction.
+
+    The request is {"backblasts": [task payload, ...], "post_messages": true}. The backblasts are
+    upserted with multi-row statements in a single transaction, and each spreadsheet gets one append;
+    as with a single task, sinks that already succeeded for a backblast are skipped. The response has
+    a result per backblast, in order: "ok" once it is stored and appended (only stored, with the sheets
+    projection, which appends it later), "rejected" when it couldn't be read (e.g. an unconfigured team)
+    and was skipped, or "error" when storing or appending it failed; "stored", "appended" and "posted"
+    say which sinks are done. Only "ok" backblasts are posted to slack, and only when post_messages
+    (default true) is set.
+    """
+    start = time.time()
+    items = payload["backblasts"]
+    span.set_attribute("n_backblasts", len(items))
+
+    results = []
+    accepted = []
+    for item in items:
+        result = {"id": None, "status": "rejected", "stored": False, "appended": False, "posted": False}
+        results.append(result)
+        try:
+            result["id"] = item["body"].get("id")
+            team = _get_team(item["body"].get("team_id"))
+            body, backblast = _build_backblast(item, team)
+            rows = backblast.get_rows_model()
+        except UnknownTeamError as e:
+            result["error"] = f"unknown team {e}"
+        except Exception as e:
+            result["error"] = f"invalid backblast: {e}"
+        else:
+            result["id"] = backblast.id
+            accepted.append((result, team, body, backblast, rows))
+    registry.histogram("backblast_batch_size", buckets=BATCH_SIZE_BUCKETS).observe(len(accepted))
+
+    statuses = _read_statuses([backblast.id for _, _, _, backblast, _ in accepted]) or {}
+    for result, _, _, backblast, _ in accepted:
+        status = statuses.get(backblast.id, {})
+        result["stored"] = status.get("stored_at") is not None
+        result["appended"] = status.get("sheet_appended_at") is not None
+        result["posted"] = status.get("slack_posted_at") is not None
+
+    to_store = [(result, backblast) for result, _, _, backblast, _ in accepted if not result["stored"]]
+    if to_store:
+        backblasts = [backblast for _, backblast in to_store]
+        try:
+            with registry.timer("cockroach_batch_transaction_seconds"), \
+                    tracer.span("cockroach.transaction", n_backblasts=len(backblasts)):
+                sheets_task.db.run_cockroach_transaction(lambda s: sheets_task.model.upsert_backblasts(s, backblasts))
+            for result, _ in to_store:
+                result["stored"] = True
+            _mark_done([backblast.id for backblast in backblasts], "stored_at")
+            logger.info(f"Done saving {len(backblasts)} backblasts to cockroachdb after {time.time() - start} seconds.")
+        except Exception as e:
+            logger.error(f"Error storing a batch of {len(backblasts)} backblasts to CockroachDb: {e}")
+            for result, _ in to_store:
+                result["error"] = f"not stored: {e}"
+
+    by_spreadsheet = {}
+    for result, team, _, backblast, rows in accepted:
+        # With the sheets projection, appended later from cockroach
+        if not result["appended"] and sheets_projection is None:
+            by_spreadsheet.setdefault(team.spreadsheet_id, []).append((result, backblast, rows))
+    for spreadsheet_id, entries in by_spreadsheet.items():
+        done, try_count = _append_to_sheet(spreadsheet_id, [row for _, _, rows in entries for row in rows])
+        if done:
+            _mark_done([backblast.id for _, backblast, _ in entries], "sheet_appended_at")
+        for result, _, _ in entries:
+            result["appended"] = done
+            if not done:
+                result.setdefault("error", f"not appended to the sheet after {try_count} tries")
+    logger.info(f"Done saving {len(accepted)} backblasts to sheets after {time.time() - start} seconds.")
+
+    for result, team, body, backblast, _ in accepted:
+        if result["stored"] and (result["appended"] or sheets_projection is not None):
+            result["status"] = "ok"
+        else:
+            result["status"] = "error"
+            continue
+        if payload.get("post_messages", True) and not result["posted"]:
+            result["posted"], _ = _post_backblast(backblast.id, body, team, statuses.get(backblast.id, {}))
 
     now = time.time()
-    logger.info(f"Done sending slack messages after {now - start} seconds.")
+    logger.info(f"Done with a batch of {len(items)} backblasts after {now - start} seconds.")
+    registry.histogram("sheets_handler_seconds").observe(now - start)
+    all_ok = all(result["status"] == "ok" for result in results)
+    if not all_ok:
+        span.status = "error"
+    return {"status": "ok" if all_ok else "partial", "backblasts": results}
+
 
-    return {"status": "ok", "try_count": try_count}
+def post_messages(backblast_data, team=None, posted_to=None):
+    """Posts the backblast to its channel(s); returns whether every message was posted (or there was none).
 
+    `posted_to`, if given, is a set of the messages already posted, as "<channel>:<message index>": those
+    are skipped, and each message posted is added to it.
+    """
+    if team is None:
+        team = _get_team(backblast_data.get("team_id"))
 
-def post_messages(backblast_data):
     message_text = sheets_task.util.build_message(backblast_data, logger)
     if message_text is None:
-        return
+        return True
 
     message_text_blocks = sheets_task.util.get_message_blocks_from_message_text(message_text=message_text)
 
     # Post in the channel(s)
-    # TODO(multi-tenant) we'll need to look these up or provide a way for folks to configure it
-    first_f_channel = os.environ.get("FIRST_F_CHANNEL")
-    third_f_channel = os.environ.get("THIRD_F_CHANNEL")
+    first_f_channel = team.first_f_channel
+    third_f_channel = team.third_f_channel
     ao_channel = backblast_data["ao_id"]
     if ao_channel is None or ao_channel == "":
         post_channels = {first_f_channel}
     else:
         try:
-            channel = app.client.conversations_info(channel=ao_channel).get("channel", {})
+            # The slackbot sends the channel's metadata along when it has it
+            channel = backblast_data.get("ao_channel") or team.channel_directory.get(ao_channel)
             ao_name = channel.get("name", "")
             post_channels = {ao_channel}
             if ao_name.startswith("ao"):
@@ -137,41 +635,73 @@ def post_messages(backblast_data):
             # TODO we should auto-join the 1stf/3rdf channel as well
             # not just this AO channel.
             if not channel["is_member"]:
-                app.client.conversations_join(channel=ao_channel)
+                team.client.conversations_join(channel=ao_channel)
+                team.channel_directory.set({**channel, "is_member": True})
         except Exception as e:
             post_channels = {ao_channel}
             logger.error(f"Error getting channel info: {e}")
 
     logger.info(f"Posting to channels: {post_channels}")
-    for message_text in message_text_blocks:
+    all_posted = True
+    for index, message_text in enumerate(message_text_blocks):
         for post_channel in post_channels:
+            key = f"{post_channel}:{index}"
+            if posted_to is not None and key in posted_to:
+                continue
             try:
-                app.client.chat_postMessage(
-                    channel=post_channel,
-                    text=message_text,
-                    blocks=[
-                        {
-                            "type": "section",
-                            "text": {
-                                "type": "mrkdwn",
-                                "text": message_text
-                            },
-                            "accessory": {
-                                "type": "overflow",
-                                "action_id": "edit-backblast",
-                                "options": [
-                                    {
-                                        "text": {
-                                            "type": "plain_text",
-                                            "text": "Edit Backblast -- NOT ACTIVE YET",
-                                            "emoji": True
-                                        },
-                                        "value": json.dumps({"id": backblast_data["id"]})
-                                    }
-                                ]
-                            }
-                        }
-                    ]
-                )
+                with registry.timer("backblast_post_seconds"), tracer.span("slack.post", channel=post_channel):
+                    _post_message(team, post_channel, message_text, backblast_data["id"])
             except Exception as e:
+                all_posted = False
                 logger.error(f"Error posting message to channel: {e}")
+                continue
+            if posted_to is not None:
+                posted_to.add(key)
+    return all_posted
+
+
+def _post_message(team, channel, message_text, backblast_id):
+    """Posts one message of a backblast to the channel.
+
+    The membership the bot acts on (from the task payload or the channel cache) can be stale, e.g. after
+    the bot was removed from the channel; when slack answers not_in_channel, the cached channel is
+    dropped, the bot joins, and the post is tried once more.
+    """
+    def _post():
+        team.client.chat_postMessage(
+            channel=channel,
+            text=message_text,
+            blocks=[
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": message_text
+                    },
+                    "accessory": {
+                        "type": "overflow",
+                        "action_id": "edit-backblast",
+                        "options": [
+                            {
+                                "text": {
+                                    "type": "plain_text",
+                                    "text": "Edit Backblast -- NOT ACTIVE YET",
+                                    "emoji": True
+                                },
+                                "value": json.dumps({"id": backblast_id})
+                            }
+                        ]
+                    }
+                }
+            ]
+        )
+
+    try:
+        _post()
+    except SlackApiError as e:
+        if e.response.get("error") != "not_in_channel":
+            raise
+        logger.info(f"Not in channel {channel}; joining it and posting again")
+        team.channel_directory.invalidate(channel)
+        team.client.conversations_join(channel=channel)
+        _post()
@@ -1,3 +1,6 @@
+import sheets_task.batching
 import sheets_task.db
+import sheets_task.enrichment
 import sheets_task.model
+import sheets_task.projection
 import sheets_task.util
\ No newline at end of file
@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class _Batch:
+    def __init__(self):
+        self.rows = []
+        self.n_backblasts = 0
+        self.error = None
+        self.done = threading.Event()
+
+
+class AppendBatcher:
+    """Coalesces the rows of concurrently handled backblasts into one sheets append per spreadsheet.
+
+    The first caller for a spreadsheet waits up to `window` seconds for others to add their rows
+    (less, once `max_rows` rows are waiting), then appends them all with `append_rows(spreadsheet_id,
+    rows)`. Every caller returns only after that append has succeeded, and raises its error if it
+    failed, so a task is only acknowledged once its rows are in the sheet.
+    """
+
+    def __init__(self, append_rows, max_rows=500, window=0.5):
+        self.append_rows = append_rows
+        self.max_rows = max_rows
+        self.window = window
+        self._open = {}
+        self._condition = threading.Condition()
+
+    def append(self, spreadsheet_id, rows):
+        """Appends `rows` in the next batch for the spreadsheet; returns the number of backblasts in that batch."""
+        with self._condition:
+            batch = self._open.get(spreadsheet_id)
+            leader = batch is None or len(batch.rows) >= self.max_rows
+            if leader:
+                batch = self._open[spreadsheet_id] = _Batch()
+            batch.rows.extend(rows)
+            batch.n_backblasts += 1
+            if len(batch.rows) >= self.max_rows:
+                self._condition.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.window
+                while len(batch.rows) < self.max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                # Later callers start the next batch
+                if self._open.get(spreadsheet_id) is batch:
+                    del self._open[spreadsheet_id]
+
+        if leader:
+            try:
+                self.append_rows(spreadsheet_id, batch.rows)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.n_backblasts
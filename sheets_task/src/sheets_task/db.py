@@ -1,8 +1,15 @@
 import logging
 import os
+import random
+import time
 
-from sqlalchemy.engine import create_engine
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import create_engine, make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy_cockroachdb import run_transaction
+
+from paxmate_common.metrics import registry
 
 logger = logging.getLogger(__name__)
 
@@ -13,20 +20,110 @@ _cockroach_engine = None
 _cockroach_session = None
 
 
+class CockroachConfigurationError(RuntimeError):
+    """COCKROACH_CONNECTION_STRING is not set."""
+
+
+class PoolSettings:
+    """Connection pool settings for one function instance, which handles a request (or a few) at a time.
+
+    Connections are checked with a ping before use, and replaced once they are `recycle` seconds old,
+    before cockroach (or a load balancer in front of it) drops them as idle; an instance's CPU is
+    throttled between requests, so its connections can sit idle for a long time.
+    """
+
+    def __init__(self):
+        self.pool_size = int(os.environ.get("COCKROACH_POOL_SIZE", 2))
+        self.max_overflow = int(os.environ.get("COCKROACH_POOL_MAX_OVERFLOW", 2))
+        # Seconds to wait for a pooled connection before giving up
+        self.pool_timeout = float(os.environ.get("COCKROACH_POOL_TIMEOUT_SECONDS", 10))
+        self.recycle = int(os.environ.get("COCKROACH_POOL_RECYCLE_SECONDS", 240))
+        # Attempts at a transaction whose connection was lost, e.g. to an expired session
+        self.max_attempts = int(os.environ.get("COCKROACH_MAX_ATTEMPTS", 3))
+
+
+pool_settings = PoolSettings()
+
+
+class _TimedQueuePool(QueuePool):
+    # A checkout includes the pre-ping, and connecting when the pool has no usable connection
+    def connect(self):
+        with registry.timer("cockroach_pool_checkout_seconds"):
+            return super().connect()
+
+
+def _observe_connects(new_engine):
+    @event.listens_for(new_engine, "do_connect")
+    def _timed_connect(dialect, connection_record, cargs, cparams):
+        with registry.timer("cockroach_connect_seconds"):
+            return dialect.connect(*cargs, **cparams)
+
+    @event.listens_for(new_engine, "invalidate")
+    def _count_invalidation(dbapi_connection, connection_record, exception):
+        registry.counter("cockroach_connections_invalidated").inc()
+
+
 def get_cockroach_engine():
     global _cockroach_engine
     if _cockroach_engine is None:
         connection_string = os.environ.get("COCKROACH_CONNECTION_STRING")
         if not connection_string:
-            logger.error("No connection string available; please set COCKROACH_CONNECTION_STRING environment variable.")
-            exit()
-        _cockroach_engine = create_engine(connection_string)
+            raise CockroachConfigurationError(
+                "No connection string available; please set COCKROACH_CONNECTION_STRING environment variable."
+            )
+        kwargs = {}
+        if make_url(connection_string).get_backend_name() != "sqlite":
+            # sqlite (e.g. the load test's stand-in) keeps its own pool
+            kwargs = dict(
+                poolclass=_TimedQueuePool,
+                pool_size=pool_settings.pool_size,
+                max_overflow=pool_settings.max_overflow,
+                pool_timeout=pool_settings.pool_timeout,
+                # The most recently used connection is the least likely to have been dropped
+                pool_use_lifo=True,
+            )
+        _cockroach_engine = create_engine(
+            connection_string, pool_pre_ping=True, pool_recycle=pool_settings.recycle, **kwargs,
+        )
+        _observe_connects(_cockroach_engine)
     return _cockroach_engine
 
 
+def warm_cockroach_pool():
+    """Opens a connection and returns it to the engine's pool, so the next transaction doesn't wait to connect."""
+    with get_cockroach_engine().connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
 def get_cockroach_sessionmaker():
     global _cockroach_session
     if _cockroach_session is None:
         engine = get_cockroach_engine()
         _cockroach_session = sessionmaker(engine)
     return _cockroach_session
+
+
+def _is_connection_error(e):
+    return isinstance(e, (exc.OperationalError, exc.DisconnectionError)) or (
+        isinstance(e, exc.DBAPIError) and e.connection_invalidated
+    )
+
+
+def run_cockroach_transaction(callback, max_attempts=None, base_backoff=0.1):
+    """Runs `callback(session)` in a transaction, like sqlalchemy_cockroachdb.run_transaction.
+
+    run_transaction retries transactions cockroach asks to be retried; this also retries, on a fresh
+    connection, ones whose connection failed, up to `max_attempts` (COCKROACH_MAX_ATTEMPTS) attempts.
+    """
+    max_attempts = max_attempts or pool_settings.max_attempts
+    Session = get_cockroach_sessionmaker()
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return run_transaction(Session, callback)
+        except exc.SQLAlchemyError as e:
+            if not _is_connection_error(e) or attempt == max_attempts:
+                raise
+            registry.counter("cockroach_transaction_reconnects").inc()
+            backoff = random.uniform(0, base_backoff * 2 ** (attempt - 1))
+            logger.warning(f"Lost the cockroach connection (attempt {attempt}), retrying in {backoff:.2f}s: {e}")
+            time.sleep(backoff)
@@ -0,0 +1,49 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_backblast_data(payload, user_directory, channel_directory):
+    """Returns the backblast data from a task payload, resolving names for version 2 payloads.
+
+    Version 1 payloads (no "version" key) already carry names. Version 2 payloads carry only slack
+    ids (and the raw view state), so the names and the AO channel name are looked up here.
+    """
+    backblast_data = payload.get("body", {})
+    version = payload.get("version", 1)
+    if version < 2:
+        return backblast_data
+    return enrich_backblast_data(backblast_data, user_directory, channel_directory)
+
+
+def enrich_backblast_data(backblast_data, user_directory, channel_directory):
+    backblast_data = dict(backblast_data)
+    backblast_data.pop("view_state", None)
+
+    # As in the slackbot, a failed lookup only blanks its own field
+    ao_id = backblast_data.get("ao_id")
+    backblast_data["ao"] = ""
+    if ao_id:
+        try:
+            backblast_data["ao_channel"] = channel_directory.get(ao_id)
+            backblast_data["ao"] = backblast_data["ao_channel"]["name"]
+        except Exception as e:
+            logger.error(f"Error getting channel info for channel {ao_id}: {e}")
+
+    for id_field, name_field in (("q_id", "q"), ("submitter_id", "submitter")):
+        backblast_data[name_field] = ""
+        user_id = backblast_data.get(id_field)
+        if user_id:
+            try:
+                backblast_data[name_field] = user_directory.get_name(user_id)
+            except Exception as e:
+                logger.error(f"Error getting name for {id_field} {user_id}: {e}")
+
+    for ids_field, names_field in (("pax_ids", "pax"), ("fng_ids", "fngs")):
+        backblast_data[names_field] = []
+        try:
+            backblast_data[names_field] = user_directory.get_names(backblast_data.get(ids_field) or [])
+        except Exception as e:
+            logger.error(f"Error getting names for {ids_field}: {e}")
+
+    return backblast_data
@@ -1,7 +1,8 @@
 import datetime
 import uuid
 
-from sqlalchemy import Column, INTEGER, String, ARRAY, Date, DateTime
+from sqlalchemy import Column, INTEGER, JSON, String, ARRAY, Date, DateTime, Index, and_, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import declarative_base
 
 import sheets_task.db
@@ -122,9 +123,35 @@ class Backblast():
 
         return sqlalchemy_backblast
 
+    def get_table_row(self):
+        """The backblast's column values, for a Core insert into the backblast table."""
+        return {
+            "id": self.id,
+            "store_date": self.store_date,
+            "date": self.date,
+            "q": self.q,
+            "q_id": self.q_id,
+            "ao": self.ao,
+            "ao_id": self.ao_id,
+            "summary": self.summary,
+            "n_pax": self.n_pax,
+            "pax": self.pax,
+            "pax_ids": self.pax_ids,
+            "n_fngs": self.n_fngs,
+            "fngs": self.fngs,
+            "fng_ids": self.fng_ids,
+            "pax_no_slack": self.pax_no_slack,
+            "n_visiting_pax": self.n_visiting_pax,
+            "submitter_id": self.submitter_id,
+            "submitter": self.submitter,
+            "team_id": self.team_id,
+        }
+
 
 class SqlAlchemyBackblast(Base):
     __tablename__ = 'backblast'
+    # Projections read the table in (store_date, id) order, from a checkpoint
+    __table_args__ = (Index("backblast_store_date_id", "store_date", "id"),)
 
     id = Column(String, primary_key=True)
     store_date = Column(DateTime)
@@ -152,6 +179,169 @@ class SqlAlchemyBackblast(Base):
         )
 
 
+class SqlAlchemyBackblastStatus(Base):
+    """When each of a backblast's sinks succeeded, so a redelivered task can skip them.
+
+    A backblast is posted to slack as several messages, to one or more channels; slack_posted_to holds
+    those already posted ("<channel>:<message index>"), so a redelivery only posts the rest, and
+    slack_post_attempts counts the deliveries that tried.
+    """
+    __tablename__ = 'backblast_status'
+
+    id = Column(String, primary_key=True)
+    stored_at = Column(DateTime)
+    sheet_appended_at = Column(DateTime)
+    slack_posted_at = Column(DateTime)
+    slack_posted_to = Column(JSON)
+    slack_post_attempts = Column(INTEGER)
+
+
+class SqlAlchemyProjectionCheckpoint(Base):
+    """The last backblast (by store_date, then id) a projection of the backblast table, e.g. to a sheet, has written.
+
+    A run holds the checkpoint (locked_until is in the future) while it appends, so runs don't overlap.
+    """
+    __tablename__ = 'projection_checkpoint'
+
+    # The projection's name, e.g. sheets:<spreadsheet id>:<team ids>
+    id = Column(String, primary_key=True)
+    store_date = Column(DateTime)
+    backblast_id = Column(String)
+    updated_at = Column(DateTime)
+    locked_until = Column(DateTime)
+
+
+# The backblast_status columns, in the order the sinks run
+SINKS = ("stored_at", "sheet_appended_at", "slack_posted_at")
+
+# Rows per INSERT statement; keeps each statement's bind parameters well under postgres' limit of 65535
+INSERT_CHUNK_SIZE = 500
+
+
+def _insert(session, table):
+    # ON CONFLICT is dialect specific; cockroach takes postgres'
+    if session.get_bind().dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+def _upsert(session, table, rows, update_columns, chunk_size=INSERT_CHUNK_SIZE):
+    for start in range(0, len(rows), chunk_size):
+        statement = _insert(session, table).values(rows[start:start + chunk_size])
+        session.execute(statement.on_conflict_do_update(
+            index_elements=["id"], set_={column: statement.excluded[column] for column in update_columns},
+        ))
+
+
+def upsert_backblasts(session, backblasts, chunk_size=INSERT_CHUNK_SIZE):
+    """Writes the backblasts with multi-row upserts on id (one per `chunk_size` backblasts) in the session's transaction.
+
+    Unlike session.add, nothing goes through the ORM unit of work, so a batch costs a statement per
+    chunk rather than one per backblast; and a backblast that is already stored (e.g. by an earlier
+    delivery of its task) is updated instead of failing the transaction. Its store_date is kept.
+    """
+    table = SqlAlchemyBackblast.__table__
+    rows = [backblast.get_table_row() for backblast in backblasts]
+    update_columns = [column.name for column in table.columns if column.name not in ("id", "store_date")]
+    _upsert(session, table, rows, update_columns, chunk_size)
+
+
+def mark_backblast_status(session, ids, **columns):
+    """Records when sinks succeeded for the backblasts, e.g. sheet_appended_at=datetime.datetime.now().
+
+    The other backblast_status columns can be set the same way, e.g. slack_post_attempts=2.
+    """
+    rows = [{"id": id_, **columns} for id_ in ids]
+    _upsert(session, SqlAlchemyBackblastStatus.__table__, rows, list(columns))
+
+
+def get_backblast_statuses(session, ids):
+    """Returns {id: {column: value or None}} for those of the backblasts that have a status."""
+    table = SqlAlchemyBackblastStatus.__table__
+    columns = [column.name for column in table.columns if column.name != "id"]
+    result = session.execute(select(table).where(table.c.id.in_(list(ids))))
+    return {row.id: {column: getattr(row, column) for column in columns} for row in result}
+
+
+def get_backblasts_after(session, checkpoint, before, team_ids=None, limit=INSERT_CHUNK_SIZE):
+    """Returns up to `limit` Backblasts stored after `checkpoint` and before `before`, in (store_date, id) order.
+
+    `checkpoint` is the (store_date, id) of the last backblast already read, or None to start from the first.
+    """
+    table = SqlAlchemyBackblast.__table__
+    query = select(SqlAlchemyBackblast).where(table.c.store_date < before)
+    if checkpoint is not None:
+        store_date, backblast_id = checkpoint
+        query = query.where(or_(
+            table.c.store_date > store_date, and_(table.c.store_date == store_date, table.c.id > backblast_id),
+        ))
+    if team_ids is not None:
+        query = query.where(table.c.team_id.in_(list(team_ids)))
+    query = query.order_by(table.c.store_date, table.c.id).limit(limit)
+    return [row.get_backblast() for row in session.execute(query).scalars()]
+
+
+def get_last_appended_backblast(session, before, team_ids=None):
+    """Returns the (store_date, id) of the last backblast stored before `before` that is already in the sheet, or None.
+
+    That is one the handler appended (sheet_appended_at is set), or one with no status at all, which was
+    stored (and appended) before backblast_status was.
+    """
+    table = SqlAlchemyBackblast.__table__
+    status = SqlAlchemyBackblastStatus.__table__
+    query = (
+        select(table.c.store_date, table.c.id)
+        .select_from(table.outerjoin(status, status.c.id == table.c.id))
+        .where(table.c.store_date < before, or_(status.c.id.is_(None), status.c.sheet_appended_at.isnot(None)))
+    )
+    if team_ids is not None:
+        query = query.where(table.c.team_id.in_(list(team_ids)))
+    row = session.execute(query.order_by(table.c.store_date.desc(), table.c.id.desc()).limit(1)).first()
+    return None if row is None else (row.store_date, row.id)
+
+
+def get_projection_checkpoint(session, name):
+    """Returns the projection's checkpoint, (store_date, backblast id), or None if it hasn't written anything."""
+    checkpoint = session.get(SqlAlchemyProjectionCheckpoint, name)
+    if checkpoint is None or checkpoint.store_date is None:
+        return None
+    return checkpoint.store_date, checkpoint.backblast_id
+
+
+def create_projection_checkpoint(session, name, checkpoint):
+    """Creates the projection's checkpoint at `checkpoint` ((store_date, backblast id), or None) unless it exists."""
+    store_date, backblast_id = checkpoint or (None, None)
+    statement = _insert(session, SqlAlchemyProjectionCheckpoint.__table__).values(
+        id=name, store_date=store_date, backblast_id=backblast_id, updated_at=datetime.datetime.now(),
+    )
+    session.execute(statement.on_conflict_do_nothing(index_elements=["id"]))
+
+
+def lock_projection_checkpoint(session, name, until):
+    """Holds the projection's checkpoint until `until`; returns False if another run holds it."""
+    table = SqlAlchemyProjectionCheckpoint.__table__
+    now = datetime.datetime.now()
+    result = session.execute(
+        update(table)
+        .where(table.c.id == name, or_(table.c.locked_until.is_(None), table.c.locked_until < now))
+        .values(locked_until=until)
+    )
+    return result.rowcount == 1
+
+
+def unlock_projection_checkpoint(session, name):
+    table = SqlAlchemyProjectionCheckpoint.__table__
+    session.execute(update(table).where(table.c.id == name).values(locked_until=None))
+
+
+def set_projection_checkpoint(session, name, store_date, backblast_id, locked_until=None):
+    """Moves the projection's checkpoint on, and with `locked_until`, extends the run's hold on it."""
+    row = {"id": name, "store_date": store_date, "backblast_id": backblast_id, "updated_at": datetime.datetime.now()}
+    if locked_until is not None:
+        row["locked_until"] = locked_until
+    _upsert(session, SqlAlchemyProjectionCheckpoint.__table__, [row], [column for column in row if column != "id"])
+
+
 def init_cockroach_db():
     engine = sheets_task.db.get_cockroach_engine()
     Base.metadata.create_all(engine)
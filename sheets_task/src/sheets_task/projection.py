@@ -0,0 +1,113 @@
+import datetime
+import logging
+
+import sheets_task.db
+import sheets_task.model
+from paxmate_common.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class SheetsProjection:
+    """Appends the backblasts stored in cockroach to a spreadsheet's __RAW sheet, after the fact.
+
+    Cockroach is the system of record, and the sheet a view of it that may lag behind. A run reads the
+    backblasts stored since the projection's checkpoint (the store_date and id of the last backblast it
+    appended), in order, and appends `chunk_size` of them at a time with `append_rows(spreadsheet_id,
+    rows)`, moving the checkpoint on in the transaction that marks them appended. A failed append ends the
+    run with its error, and the next run starts again from the checkpoint; a run that stops between an
+    append and its checkpoint appends that chunk again.
+
+    Backblasts stored less than `lag_seconds` ago are left for the next run: their store_date is taken
+    before their transaction commits, so one that commits late could otherwise land behind the checkpoint.
+    Backblasts already appended by the handler (sheet_appended_at is set) only move the checkpoint on.
+
+    Each spreadsheet and set of teams has a checkpoint of its own, since regions can share a spreadsheet.
+    The first run starts it after the last backblast already in the sheet (see
+    model.get_last_appended_backblast), not at the start of the table. A run holds the checkpoint for
+    `lease_seconds`, extended with each chunk, and a run that finds it held by another does nothing.
+    """
+
+    def __init__(self, append_rows, run_transaction=None, chunk_size=500, lag_seconds=60, lease_seconds=600):
+        self.append_rows = append_rows
+        self.run_transaction = run_transaction or sheets_task.db.run_cockroach_transaction
+        self.chunk_size = chunk_size
+        self.lag = datetime.timedelta(seconds=lag_seconds)
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+
+    @staticmethod
+    def checkpoint_name(spreadsheet_id, team_ids=None):
+        if team_ids is None:
+            return f"sheets:{spreadsheet_id}"
+        return f"sheets:{spreadsheet_id}:{','.join(sorted(team_ids))}"
+
+    def run(self, spreadsheet_id, team_ids=None, max_chunks=None):
+        """Projects the backblasts of `team_ids` (all, when None) to the spreadsheet, up to `max_chunks` chunks.
+
+        Returns the number of backblasts, rows and chunks appended, the checkpoint's store_date, and whether
+        another run held the checkpoint ("locked"), in which case this one appended nothing.
+        """
+        name = self.checkpoint_name(spreadsheet_id, team_ids)
+        before = datetime.datetime.now() - self.lag
+        summary = {"backblasts": 0, "rows": 0, "chunks": 0, "checkpoint": None, "locked": False}
+
+        def _start(session):
+            if session.get(sheets_task.model.SqlAlchemyProjectionCheckpoint, name) is None:
+                last_appended = sheets_task.model.get_last_appended_backblast(session, before, team_ids=team_ids)
+                sheets_task.model.create_projection_checkpoint(session, name, last_appended)
+            if not sheets_task.model.lock_projection_checkpoint(session, name, datetime.datetime.now() + self.lease):
+                return False, None
+            return True, sheets_task.model.get_projection_checkpoint(session, name)
+
+        held, checkpoint = self.run_transaction(_start)
+        if not held:
+            logger.info(f"Another run is projecting to {spreadsheet_id} ({name}); leaving it")
+            summary["locked"] = True
+            return summary
+        try:
+            checkpoint = self._run(spreadsheet_id, name, checkpoint, before, team_ids, max_chunks, summary)
+        finally:
+            self.run_transaction(lambda s: sheets_task.model.unlock_projection_checkpoint(s, name))
+
+        if checkpoint is not None:
+            summary["checkpoint"] = checkpoint[0].isoformat()
+        logger.info(f"Projected {summary['backblasts']} backblasts to {spreadsheet_id}: {summary}")
+        return summary
+
+    def _run(self, spreadsheet_id, name, checkpoint, before, team_ids, max_chunks, summary):
+        while max_chunks is None or summary["chunks"] < max_chunks:
+            def _read(session):
+                backblasts = sheets_task.model.get_backblasts_after(
+                    session, checkpoint, before, team_ids=team_ids, limit=self.chunk_size,
+                )
+                statuses = sheets_task.model.get_backblast_statuses(session, [b.id for b in backblasts])
+                return backblasts, statuses
+
+            backblasts, statuses = self.run_transaction(_read)
+            if not backblasts:
+                break
+            pending = [b for b in backblasts if statuses.get(b.id, {}).get("sheet_appended_at") is None]
+            rows = [row for backblast in pending for row in backblast.get_rows_model()]
+            if rows:
+                with registry.timer("sheets_projection_append_seconds"):
+                    self.append_rows(spreadsheet_id, rows)
+
+            last = backblasts[-1]
+
+            def _advance(session):
+                sheets_task.model.mark_backblast_status(
+                    session, [b.id for b in pending], sheet_appended_at=datetime.datetime.now(),
+                )
+                sheets_task.model.set_projection_checkpoint(
+                    session, name, last.store_date, last.id, locked_until=datetime.datetime.now() + self.lease,
+                )
+
+            self.run_transaction(_advance)
+            checkpoint = (last.store_date, last.id)
+            summary["backblasts"] += len(pending)
+            summary["rows"] += len(rows)
+            summary["chunks"] += 1
+            registry.counter("sheets_projection_backblasts").inc(len(pending))
+            if len(backblasts) < self.chunk_size:
+                break
+        return checkpoint
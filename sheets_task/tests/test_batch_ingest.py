@@ -0,0 +1,60 @@
+import datetime
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import sheets_task
+
+
+def _backblast(i):
+    return sheets_task.model.Backblast(
+        store_date=datetime.datetime(2023, 6, 5, 6, 15), date="2023-06-05", q="Torpedo", q_id="QWERTY123",
+        ao="ao-the-grid", ao_id="C8LR0QG5V", summary="merkins", pax=["Banjo"], pax_ids=["ASDF456"], fngs=[],
+        fng_ids=[], pax_no_slack="", n_visiting_pax=0, submitter_id="QWERTY123", submitter="Torpedo",
+        team_id="T046M8F12U8", id=f"bb{i}",
+    )
+
+
+def test_upsert_backblasts_uses_one_multi_row_upsert_per_chunk():
+    session = mock.MagicMock()
+    sheets_task.model.upsert_backblasts(session, [_backblast(i) for i in range(5)], chunk_size=2)
+
+    statements = [call[0][0].compile(dialect=postgresql.dialect()) for call in session.execute.call_args_list]
+    assert len(statements) == 3
+    assert [str(statement).count("VALUES") for statement in statements] == [1, 1, 1]
+    assert "ON CONFLICT (id) DO UPDATE SET" in str(statements[0])
+    # A redelivered backblast keeps the store_date of its first delivery
+    assert "store_date = excluded.store_date" not in str(statements[0])
+    assert "summary = excluded.summary" in str(statements[0])
+    assert [statement.params["id_m0"] for statement in statements] == ["bb0", "bb2", "bb4"]
+    assert statements[0].params["id_m1"] == "bb1"
+    assert "id_m1" not in statements[2].params
+
+
+def test_table_row_matches_the_orm_model():
+    backblast = _backblast(0)
+    model = backblast.get_sqlalchemy_model()
+    assert backblast.get_table_row() == {
+        column.name: getattr(model, column.name) for column in sheets_task.model.SqlAlchemyBackblast.__table__.columns
+    }
+
+
+def test_backblast_status_records_each_sink(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'status.sqlite3'}")
+    sheets_task.model.SqlAlchemyBackblastStatus.__table__.create(engine)
+    stored_at = datetime.datetime(2023, 6, 5, 6, 15)
+    appended_at = datetime.datetime(2023, 6, 5, 6, 16)
+    with Session(engine) as session, session.begin():
+        sheets_task.model.mark_backblast_status(session, ["bb0", "bb1"], stored_at=stored_at)
+        sheets_task.model.mark_backblast_status(session, ["bb0"], sheet_appended_at=appended_at)
+        sheets_task.model.mark_backblast_status(session, ["bb1"], slack_posted_to=["C1STF:0"], slack_post_attempts=1)
+
+    with Session(engine) as session:
+        statuses = sheets_task.model.get_backblast_statuses(session, ["bb0", "bb1", "bb2"])
+    assert {id_: {sink: status[sink] for sink in sheets_task.model.SINKS} for id_, status in statuses.items()} == {
+        "bb0": {"stored_at": stored_at, "sheet_appended_at": appended_at, "slack_posted_at": None},
+        "bb1": {"stored_at": stored_at, "sheet_appended_at": None, "slack_posted_at": None},
+    }
+    assert (statuses["bb1"]["slack_posted_to"], statuses["bb1"]["slack_post_attempts"]) == (["C1STF:0"], 1)
@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+from sheets_task.batching import AppendBatcher
+
+
+def _append_concurrently(batcher, calls):
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(batcher.append, spreadsheet_id, rows) for spreadsheet_id, rows in calls]
+        return [future.result() for future in futures]
+
+
+def test_concurrent_backblasts_share_one_append():
+    append_rows = mock.MagicMock()
+    batcher = AppendBatcher(append_rows, window=0.2)
+    sizes = _append_concurrently(batcher, [("sheet", [[f"bb{i}", "pax"]]) for i in range(5)])
+    assert sizes == [5] * 5
+    append_rows.assert_called_once()
+    spreadsheet_id, rows = append_rows.call_args[0]
+    assert spreadsheet_id == "sheet"
+    assert sorted(rows) == [[f"bb{i}", "pax"] for i in range(5)]
+
+
+def test_full_batch_is_appended_before_the_window_ends():
+    append_rows = mock.MagicMock()
+    batcher = AppendBatcher(append_rows, max_rows=4, window=5)
+    start = time.monotonic()
+    _append_concurrently(batcher, [("sheet", [["bb", "pax1"], ["bb", "pax2"]]) for _ in range(2)])
+    assert time.monotonic() - start < 1
+    append_rows.assert_called_once()
+
+
+def test_spreadsheets_are_batched_separately():
+    append_rows = mock.MagicMock()
+    batcher = AppendBatcher(append_rows, window=0.2)
+    _append_concurrently(batcher, [("peakcity", [["a"]]), ("carpex", [["b"]]), ("peakcity", [["c"]])])
+    appended = {call[0][0]: sorted(call[0][1]) for call in append_rows.call_args_list}
+    assert appended == {"peakcity": [["a"], ["c"]], "carpex": [["b"]]}
+
+
+def test_failed_append_fails_every_backblast_in_the_batch():
+    batcher = AppendBatcher(mock.MagicMock(side_effect=ConnectionError("sheets down")), window=0.2)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(batcher.append, "sheet", [[i]]) for i in range(3)]
+        for future in futures:
+            with pytest.raises(ConnectionError):
+                future.result()
+
+
+def test_callers_wait_for_the_append():
+    appended = threading.Event()
+
+    def _slow_append(spreadsheet_id, rows):
+        time.sleep(0.1)
+        appended.set()
+
+    batcher = AppendBatcher(_slow_append, window=0.01)
+    batcher.append("sheet", [["bb"]])
+    assert appended.is_set()
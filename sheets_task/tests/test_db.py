@@ -0,0 +1,68 @@
+from unittest import mock
+
+import pytest
+from sqlalchemy import exc
+
+import sheets_task
+from paxmate_common.metrics import registry
+
+
+@pytest.fixture
+def fresh_engine(monkeypatch):
+    monkeypatch.setattr(sheets_task.db, "_cockroach_engine", None)
+    monkeypatch.setattr(sheets_task.db, "_cockroach_session", None)
+    yield monkeypatch
+    if sheets_task.db._cockroach_engine is not None:
+        sheets_task.db._cockroach_engine.dispose()
+
+
+def test_missing_connection_string_raises(fresh_engine):
+    fresh_engine.delenv("COCKROACH_CONNECTION_STRING", raising=False)
+    with pytest.raises(sheets_task.db.CockroachConfigurationError):
+        sheets_task.db.get_cockroach_engine()
+    with pytest.raises(sheets_task.db.CockroachConfigurationError):
+        sheets_task.db.warm_cockroach_pool()
+
+
+def test_engine_is_pooled_for_one_instance(fresh_engine):
+    fresh_engine.setenv("COCKROACH_CONNECTION_STRING", "cockroachdb://root@localhost:26257/defaultdb")
+    engine = sheets_task.db.get_cockroach_engine()
+    assert isinstance(engine.pool, sheets_task.db._TimedQueuePool)
+    assert engine.pool.size() == 2
+    assert engine.pool._pre_ping
+    assert engine.pool._recycle == 240
+
+
+def test_connects_are_timed(fresh_engine, tmp_path):
+    fresh_engine.setenv("COCKROACH_CONNECTION_STRING", f"sqlite:///{tmp_path / 'cockroach.sqlite3'}")
+    connects = registry.histogram("cockroach_connect_seconds", outcome="ok").count
+    sheets_task.db.warm_cockroach_pool()
+    assert registry.histogram("cockroach_connect_seconds", outcome="ok").count == connects + 1
+
+
+def _connection_lost():
+    return exc.OperationalError("SELECT 1", {}, Exception("server closed the connection unexpectedly"))
+
+
+def test_transaction_is_retried_after_a_lost_connection():
+    with mock.patch("sheets_task.db.get_cockroach_sessionmaker"), \
+            mock.patch("sheets_task.db.run_transaction", side_effect=[_connection_lost(), "done"]) as run_transaction:
+        assert sheets_task.db.run_cockroach_transaction(mock.MagicMock(), base_backoff=0) == "done"
+    assert run_transaction.call_count == 2
+
+
+def test_transaction_gives_up_after_max_attempts():
+    with mock.patch("sheets_task.db.get_cockroach_sessionmaker"), \
+            mock.patch("sheets_task.db.run_transaction", side_effect=_connection_lost()) as run_transaction:
+        with pytest.raises(exc.OperationalError):
+            sheets_task.db.run_cockroach_transaction(mock.MagicMock(), max_attempts=3, base_backoff=0)
+    assert run_transaction.call_count == 3
+
+
+def test_other_errors_are_not_retried():
+    duplicate = exc.IntegrityError("INSERT", {}, Exception("duplicate key value violates unique constraint"))
+    with mock.patch("sheets_task.db.get_cockroach_sessionmaker"), \
+            mock.patch("sheets_task.db.run_transaction", side_effect=duplicate) as run_transaction:
+        with pytest.raises(exc.IntegrityError):
+            sheets_task.db.run_cockroach_transaction(mock.MagicMock(), base_backoff=0)
+    assert run_transaction.call_count == 1
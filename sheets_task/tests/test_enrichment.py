@@ -0,0 +1,69 @@
+from unittest import mock
+
+from paxmate_common.directory import ChannelDirectory, UserDirectory
+from sheets_task.enrichment import get_backblast_data
+
+
+MEMBERS = {
+    "QWERTY123": {"id": "QWERTY123", "name": "torpedo", "profile": {"display_name": "Torpedo"}},
+    "ASDF456": {"id": "ASDF456", "name": "banjo", "profile": {"display_name": "Banjo"}},
+    "ZXCV123": {"id": "ZXCV123", "name": "parker", "profile": {"real_name": "Parker"}},
+}
+
+
+def _build_client():
+    client = mock.MagicMock()
+    client.users_info.side_effect = lambda user: {"user": MEMBERS[user]}
+    client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+    return client
+
+
+def test_version_1_payload_is_unchanged():
+    client = _build_client()
+    body = {"q_id": "QWERTY123", "q": "Torpedo"}
+    assert get_backblast_data({"body": body}, UserDirectory(lambda: client), ChannelDirectory(lambda: client)) == body
+    assert client.users_info.call_count == 0
+
+
+def test_version_2_payload_is_enriched():
+    client = _build_client()
+    payload = {
+        "version": 2,
+        "body": {
+            "ao_id": "C8LR0QG5V",
+            "q_id": "QWERTY123",
+            "pax_ids": ["ASDF456", "ZXCV123", "QWERTY123"],
+            "fng_ids": [],
+            "submitter_id": "QWERTY123",
+            "view_state": {"pax-select": {}},
+        },
+    }
+    backblast_data = get_backblast_data(payload, UserDirectory(lambda: client), ChannelDirectory(lambda: client))
+    assert backblast_data["ao"] == "ao-the-grid"
+    assert backblast_data["q"] == "Torpedo"
+    assert backblast_data["pax"] == ["Banjo", "Parker", "Torpedo"]
+    assert backblast_data["fngs"] == []
+    assert backblast_data["submitter"] == "Torpedo"
+    assert "view_state" not in backblast_data
+    # One users.info per person, however many fields they appear in
+    assert client.users_info.call_count == 3
+    assert client.users_list.call_count == 0
+
+
+def test_version_2_failed_channel_lookup_blanks_only_ao():
+    client = _build_client()
+    client.conversations_info.side_effect = RuntimeError("channel_not_found")
+    payload = {"version": 2, "body": {"ao_id": "C8LR0QG5V", "q_id": "QWERTY123", "pax_ids": ["ASDF456"]}}
+    backblast_data = get_backblast_data(payload, UserDirectory(lambda: client), ChannelDirectory(lambda: client))
+    assert backblast_data["ao"] == ""
+    assert backblast_data["q"] == "Torpedo"
+    assert backblast_data["pax"] == ["Banjo"]
+
+
+def test_version_2_channel_info_is_cached():
+    client = _build_client()
+    users, channels = UserDirectory(lambda: client), ChannelDirectory(lambda: client)
+    for _ in range(3):
+        backblast_data = get_backblast_data({"version": 2, "body": {"ao_id": "C8LR0QG5V"}}, users, channels)
+    assert backblast_data["ao_channel"] == {"id": "C8LR0QG5V", "name": "ao-the-grid", "is_member": False, "is_archived": False}
+    assert client.conversations_info.call_count == 1
@@ -0,0 +1,267 @@
+import datetime
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import flask
+import pytest
+from slack_sdk.errors import SlackApiError
+from sqlalchemy import exc
+
+import main
+import sheets_task
+from paxmate_common.directory import ChannelDirectory, UserDirectory
+
+
+class _Team:
+    """A workspace whose slack client is a mock."""
+
+    first_f_channel = "C1STF"
+    third_f_channel = "C3RDF"
+    spreadsheet_id = "sheet1"
+
+    def __init__(self):
+        self.client = mock.MagicMock()
+        self.channel_directory = ChannelDirectory(lambda: self.client)
+        self.user_directory = UserDirectory(lambda: self.client)
+
+
+@pytest.fixture
+def team():
+    return _Team()
+
+
+class _Sinks:
+    """Stands in for cockroach, the sheet and slack behind f3_sheets_handler; `statuses` is backblast_status."""
+
+    def __init__(self):
+        self.statuses = {}
+        self.store = mock.MagicMock()
+        self.append = mock.MagicMock(return_value=(True, 1))
+        self.post = mock.MagicMock(return_value=True)
+        # For tests that post through the team's (mock) slack client
+        self.real_post_messages = main.post_messages
+
+    def get_statuses(self, session, ids):
+        return {id_: dict(self.statuses[id_]) for id_ in ids if id_ in self.statuses}
+
+    def mark(self, session, ids, **columns):
+        for id_ in ids:
+            self.statuses.setdefault(id_, {}).update(columns)
+
+
+@pytest.fixture
+def sinks(team):
+    sinks = _Sinks()
+    with mock.patch.object(main, "_get_team", return_value=team), \
+            mock.patch.object(main, "sheets_projection", None), \
+            mock.patch.object(main, "_append_to_sheet", sinks.append), \
+            mock.patch.object(main, "post_messages", sinks.post), \
+            mock.patch.object(sheets_task.db, "run_cockroach_transaction", lambda callback: callback(mock.MagicMock())), \
+            mock.patch.object(sheets_task.model, "upsert_backblasts", sinks.store), \
+            mock.patch.object(sheets_task.model, "get_backblast_statuses", sinks.get_statuses), \
+            mock.patch.object(sheets_task.model, "mark_backblast_status", sinks.mark):
+        yield sinks
+
+
+def _handle(body, headers=None):
+    """Sends `body` to f3_sheets_handler; returns the response's status code and json."""
+    with flask.Flask(__name__).test_request_context("/", method="POST", json=body, headers=headers):
+        response = main.f3_sheets_handler(flask.request)
+    if isinstance(response, dict):
+        return 200, response
+    return response.status_code, json.loads(response.get_data())
+
+
+def _task(backblast_id="bb1"):
+    return {"body": {**_backblast_data(), "id": backblast_id}}
+
+
+def _backblast_data(ao_channel=None):
+    return {
+        "id": "bb1", "team_id": "T046M8F12U8", "date": "2023-06-05", "q_id": "QWERTY123", "q": "Torpedo",
+        "pax_ids": ["ASDF456"], "pax": ["Banjo"], "fng_ids": [], "fngs": [], "summary": "merkins", "n_visiting_pax": 0, "pax_no_slack": "", "ao_id": "Cdownrange",
+        "ao_channel": ao_channel or {"id": "Cdownrange", "name": "downrange", "is_member": True, "is_archived": False},
+    }
+
+
+def _not_in_channel():
+    return SlackApiError("not_in_channel", {"ok": False, "error": "not_in_channel"})
+
+
+def test_post_joins_and_retries_once_when_membership_is_stale(team):
+    # The payload says the bot is a member, but it was removed from the channel since
+    team.client.chat_postMessage.side_effect = [_not_in_channel(), {"ok": True}]
+    team.channel_directory.set({"id": "Cdownrange", "name": "downrange", "is_member": True, "is_archived": False})
+
+    assert main.post_messages(_backblast_data(), team=team) is True
+    team.client.conversations_join.assert_called_once_with(channel="Cdownrange")
+    assert [c.kwargs["channel"] for c in team.client.chat_postMessage.call_args_list] == ["Cdownrange"] * 2
+    # The stale cached membership is dropped
+    assert team.channel_directory.cache.get("Cdownrange") is None
+
+
+def test_post_is_only_retried_once(team):
+    team.client.chat_postMessage.side_effect = _not_in_channel()
+
+    assert main.post_messages(_backblast_data(), team=team) is False
+    assert team.client.conversations_join.call_count == 1
+    assert team.client.chat_postMessage.call_count == 2
+
+
+def test_post_skips_the_messages_already_posted(team):
+    third_f = {"id": "Cdownrange", "name": "3rdf-downrange", "is_member": True, "is_archived": False}
+    posted_to = {"Cdownrange:0"}
+
+    assert main.post_messages(_backblast_data(ao_channel=third_f), team=team, posted_to=posted_to) is True
+    assert [c.kwargs["channel"] for c in team.client.chat_postMessage.call_args_list] == ["C3RDF"]
+    assert posted_to == {"Cdownrange:0", "C3RDF:0"}
+
+
+def test_redelivery_only_posts_to_the_channels_that_failed(sinks, team):
+    sinks.post.side_effect = sinks.real_post_messages
+    third_f = {"id": "Cdownrange", "name": "3rdf-downrange", "is_member": True, "is_archived": False}
+    task = {"body": _backblast_data(ao_channel=third_f)}
+
+    def post_to_the_ao_only(channel, **kwargs):
+        if channel != "Cdownrange":
+            raise ConnectionError("slack is down")
+        return {"ok": True}
+
+    team.client.chat_postMessage.side_effect = post_to_the_ao_only
+
+    assert _handle(task)[0] == 500
+    assert sinks.statuses["bb1"]["slack_posted_to"] == ["Cdownrange:0"]
+    team.client.chat_postMessage.reset_mock(side_effect=True)
+
+    assert _handle(task)[0] == 200
+    assert [c.kwargs["channel"] for c in team.client.chat_postMessage.call_args_list] == ["C3RDF"]
+    assert sinks.statuses["bb1"]["slack_posted_at"] is not None
+    assert sinks.store.call_count == 1
+
+
+def test_slack_only_failures_are_acknowledged_after_the_last_attempt(sinks):
+    sinks.post.return_value = False
+
+    for attempt in range(1, main.SLACK_POST_MAX_ATTEMPTS):
+        assert _handle(_task())[0] == 500
+        assert sinks.statuses["bb1"]["slack_post_attempts"] == attempt
+    status_code, response = _handle(_task())
+    assert (status_code, response["status"]) == (200, "incomplete")
+    assert response["sinks"]["slack_posted_at"]["outcome"] == "error"
+    assert "slack_posted_at" not in sinks.statuses["bb1"]
+    assert sinks.post.call_count == main.SLACK_POST_MAX_ATTEMPTS
+
+
+def test_backblast_is_stored_when_its_status_cant_be_recorded(sinks):
+    # e.g. the backblast_status table hasn't been created yet
+    def no_table(session, ids, **columns):
+        raise exc.ProgrammingError("INSERT", {}, Exception("no backblast_status"))
+
+    with mock.patch.object(sheets_task.model, "mark_backblast_status", no_table):
+        status_code, response = _handle(_task())
+    assert (status_code, response["status"]) == (200, "ok")
+    assert sinks.store.call_count == 1
+
+
+def test_backblast_is_posted_and_appended_once_while_cockroach_is_down(sinks, team):
+    sinks.post.side_effect = sinks.real_post_messages
+
+    def cockroach_down(callback):
+        raise exc.OperationalError("SELECT", {}, Exception("connection refused"))
+
+    with mock.patch.object(sheets_task.db, "run_cockroach_transaction", cockroach_down):
+        status_code, response = _handle(_task())
+        # Redelivering it for the store would post and append it again, as neither could be recorded
+        assert (status_code, response["status"]) == (200, "incomplete")
+        assert {sink: result["outcome"] for sink, result in response["sinks"].items()} == {
+            "stored_at": "error", "sheet_appended_at": "ok", "slack_posted_at": "ok",
+        }
+        # Cloud tasks can still redeliver it, e.g. after a timeout; with no status to read, no sink runs
+        for retry_count in range(1, 4):
+            status_code, response = _handle(_task(), headers={"X-CloudTasks-TaskRetryCount": str(retry_count)})
+            assert (status_code, response["status"]) == (503, "status unavailable")
+    assert team.client.chat_postMessage.call_count == 1
+    assert sinks.append.call_count == 1
+
+
+def test_batch_request_stores_appends_and_posts_each_backblast(sinks):
+    body = {"backblasts": [_task("bb1"), _task("bb2"), {"version": 1}]}
+
+    status_code, response = _handle(body)
+    assert (status_code, response["status"]) == (200, "partial")
+    assert [(r["id"], r["status"]) for r in response["backblasts"]] == [("bb1", "ok"), ("bb2", "ok"), (None, "rejected")]
+    # One transaction and one append for the batch; a post per backblast
+    assert sinks.store.call_count == 1
+    assert [b.id for b in sinks.store.call_args.args[1]] == ["bb1", "bb2"]
+    assert sinks.append.call_count == 1
+    assert sinks.post.call_count == 2
+    assert all(sinks.statuses[id_]["slack_posted_at"] is not None for id_ in ("bb1", "bb2"))
+
+
+def test_batch_request_can_skip_the_slack_posts(sinks):
+    status_code, response = _handle({"backblasts": [_task("bb1")], "post_messages": False})
+    assert (status_code, response["status"]) == (200, "ok")
+    assert response["backblasts"][0]["posted"] is False
+    assert sinks.post.call_count == 0
+
+
+def test_redelivery_of_a_finished_backblast_calls_no_sink(sinks):
+    done_at = datetime.datetime(2023, 6, 5, 6, 15)
+    sinks.statuses["bb1"] = {"stored_at": done_at, "sheet_appended_at": done_at, "slack_posted_at": done_at}
+
+    status_code, response = _handle(_task())
+    assert (status_code, response["status"]) == (200, "ok")
+    assert {sink: result["outcome"] for sink, result in response["sinks"].items()} == dict.fromkeys(
+        sheets_task.model.SINKS, "skipped",
+    )
+    assert (sinks.store.call_count, sinks.append.call_count, sinks.post.call_count) == (0, 0, 0)
+
+
+def test_redelivery_only_runs_the_sinks_that_havent_succeeded(sinks):
+    done_at = datetime.datetime(2023, 6, 5, 6, 15)
+    sinks.statuses["bb1"] = {"stored_at": done_at, "sheet_appended_at": None, "slack_posted_at": done_at}
+
+    status_code, response = _handle(_task())
+    assert status_code == 200
+    assert {sink: result["outcome"] for sink, result in response["sinks"].items()} == {
+        "stored_at": "skipped", "sheet_appended_at": "ok", "slack_posted_at": "skipped",
+    }
+    assert (sinks.store.call_count, sinks.append.call_count, sinks.post.call_count) == (0, 1, 0)
+    assert sinks.statuses["bb1"]["sheet_appended_at"] is not None
+
+
+def test_each_thread_gets_its_own_sheets_resource():
+    with mock.patch.object(main.discovery, "build", side_effect=lambda *args, **kwargs: mock.MagicMock()):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            this_thread = executor.submit(lambda: (main._get_sheets_service(), main._get_sheets_service())).result()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other_thread = executor.submit(main._get_sheets_service).result()
+    assert this_thread[0] is this_thread[1]
+    assert other_thread is not this_thread[0]
+
+
+def test_sinks_run_at_the_same_time(sinks):
+    # Each sink waits for the other two; run one after another, they would time out
+    together = threading.Barrier(3, timeout=5)
+    sinks.store.side_effect = lambda *args: together.wait()
+    sinks.append.side_effect = lambda *args, **kwargs: (together.wait(), (True, 1))[1]
+    sinks.post.side_effect = lambda **kwargs: (together.wait(), True)[1]
+
+    status_code, response = _handle(_task())
+    assert (status_code, response["status"]) == (200, "ok")
+    assert {result["outcome"] for result in response["sinks"].values()} == {"ok"}
+
+
+def test_a_failed_sink_doesnt_stop_the_others(sinks):
+    sinks.append.side_effect = RuntimeError("sheets quota exceeded")
+
+    status_code, response = _handle(_task())
+    assert status_code == 500
+    assert {sink: result["outcome"] for sink, result in response["sinks"].items()} == {
+        "stored_at": "ok", "sheet_appended_at": "error", "slack_posted_at": "ok",
+    }
+    assert response["sinks"]["sheet_appended_at"]["error"] == "sheets quota exceeded"
+    assert sinks.statuses["bb1"]["stored_at"] is not None
+    assert sinks.statuses["bb1"]["slack_posted_at"] is not None
@@ -0,0 +1,152 @@
+import datetime
+
+import pytest
+from sqlalchemy import ARRAY, create_engine, types
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+
+import sheets_task
+
+
+@compiles(ARRAY, "sqlite")
+def _compile_array(type_, compiler, **kw):
+    return "JSON"
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'projection.sqlite3'}")
+    # Arrays are stored as json on sqlite
+    engine.dialect.colspecs = {**engine.dialect.colspecs, types.ARRAY: sqlite.JSON}
+    sheets_task.model.Base.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def run_transaction(engine):
+    def _run_transaction(callback):
+        with Session(engine) as session, session.begin():
+            return callback(session)
+    return _run_transaction
+
+
+def _store(run_transaction, *backblasts, status=True):
+    # As the handler does; without a status, a backblast is taken to predate backblast_status
+    run_transaction(lambda s: sheets_task.model.upsert_backblasts(s, backblasts))
+    if status:
+        run_transaction(lambda s: sheets_task.model.mark_backblast_status(
+            s, [backblast.id for backblast in backblasts], stored_at=datetime.datetime.now(),
+        ))
+
+
+def _backblast(i, minutes_ago=10, team_id="T046M8F12U8"):
+    return sheets_task.model.Backblast(
+        store_date=datetime.datetime.now() - datetime.timedelta(minutes=minutes_ago, seconds=i),
+        date=datetime.date(2023, 6, 5), q="Torpedo", q_id="QWERTY123", ao="ao-the-grid", ao_id="C8LR0QG5V",
+        summary="merkins", pax=[], pax_ids=[], fngs=[], fng_ids=[], pax_no_slack="", n_visiting_pax=0,
+        submitter_id="QWERTY123", submitter="Torpedo", team_id=team_id, id=f"bb{i}",
+    )
+
+
+class _Sheet:
+    def __init__(self, fail=False):
+        self.appends = []
+        self.fail = fail
+
+    def append_rows(self, spreadsheet_id, rows):
+        if self.fail:
+            raise ConnectionError("sheets is down")
+        self.appends.append((spreadsheet_id, [row[12] for row in rows]))
+
+
+def test_appends_in_store_order_and_resumes_from_the_checkpoint(run_transaction):
+    # bb4 was stored first
+    _store(run_transaction, *[_backblast(i) for i in range(5)])
+    sheet = _Sheet()
+    projection = sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction, chunk_size=2)
+
+    summary = projection.run("sheet1")
+    assert sheet.appends == [("sheet1", ["bb4", "bb3"]), ("sheet1", ["bb2", "bb1"]), ("sheet1", ["bb0"])]
+    assert (summary["backblasts"], summary["chunks"]) == (5, 3)
+
+    _store(run_transaction, _backblast(5, minutes_ago=5))
+    assert projection.run("sheet1")["backblasts"] == 1
+    assert sheet.appends[-1] == ("sheet1", ["bb5"])
+    statuses = run_transaction(lambda s: sheets_task.model.get_backblast_statuses(s, ["bb0", "bb5"]))
+    assert all(status["sheet_appended_at"] is not None for status in statuses.values())
+
+
+def test_recent_and_other_teams_backblasts_are_left(run_transaction):
+    _store(run_transaction, _backblast(0), _backblast(1, minutes_ago=0), _backblast(2, team_id="TOTHER"))
+    sheet = _Sheet()
+    projection = sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction, lag_seconds=60)
+
+    projection.run("sheet1", team_ids=["T046M8F12U8"])
+    assert sheet.appends == [("sheet1", ["bb0"])]
+
+
+def test_backblasts_appended_by_the_handler_only_move_the_checkpoint(run_transaction):
+    _store(run_transaction, _backblast(0), _backblast(1))
+    run_transaction(lambda s: sheets_task.model.mark_backblast_status(
+        s, ["bb1"], sheet_appended_at=datetime.datetime.now(),
+    ))
+    sheet = _Sheet()
+    projection = sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction)
+
+    assert projection.run("sheet1")["backblasts"] == 1
+    assert sheet.appends == [("sheet1", ["bb0"])]
+    assert projection.run("sheet1")["backblasts"] == 0
+
+
+def test_failed_append_keeps_the_checkpoint(run_transaction):
+    _store(run_transaction, _backblast(0), _backblast(1))
+    down = _Sheet(fail=True)
+    with pytest.raises(ConnectionError):
+        sheets_task.projection.SheetsProjection(down.append_rows, run_transaction).run("sheet1")
+    assert run_transaction(lambda s: sheets_task.model.get_projection_checkpoint(s, "sheets:sheet1")) is None
+
+    # Nor does the failed run keep holding the checkpoint
+    sheet = _Sheet()
+    sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction).run("sheet1")
+    assert sheet.appends == [("sheet1", ["bb1", "bb0"])]
+
+
+def test_first_run_starts_after_the_backblasts_already_in_the_sheet(run_transaction):
+    # bb3 and bb2 were appended before backblast_status existed, bb1 by the handler; bb0 is new
+    _store(run_transaction, _backblast(3), _backblast(2), status=False)
+    _store(run_transaction, _backblast(1), _backblast(0))
+    run_transaction(lambda s: sheets_task.model.mark_backblast_status(
+        s, ["bb1"], sheet_appended_at=datetime.datetime.now(),
+    ))
+    sheet = _Sheet()
+
+    assert sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction).run("sheet1")["backblasts"] == 1
+    assert sheet.appends == [("sheet1", ["bb0"])]
+
+
+def test_regions_sharing_a_spreadsheet_have_their_own_checkpoints(run_transaction):
+    _store(run_transaction, _backblast(1, team_id="TPEAKCITY"), _backblast(0, team_id="TGREENLEVEL"))
+    sheet = _Sheet()
+    projection = sheets_task.projection.SheetsProjection(sheet.append_rows, run_transaction)
+
+    projection.run("sheet1", team_ids=["TPEAKCITY"])
+    projection.run("sheet1", team_ids=["TGREENLEVEL"])
+    assert sheet.appends == [("sheet1", ["bb1"]), ("sheet1", ["bb0"])]
+
+
+def test_overlapping_run_leaves_the_checkpoint_to_the_first(run_transaction):
+    _store(run_transaction, _backblast(0))
+    sheet = _Sheet()
+    overlapping = []
+
+    def append_while_another_run_starts(spreadsheet_id, rows):
+        overlapping.append(projection.run(spreadsheet_id))
+        sheet.append_rows(spreadsheet_id, rows)
+
+    projection = sheets_task.projection.SheetsProjection(append_while_another_run_starts, run_transaction)
+    assert projection.run("sheet1")["backblasts"] == 1
+    assert (overlapping[0]["locked"], overlapping[0]["backblasts"]) == (True, 0)
+    assert sheet.appends == [("sheet1", ["bb0"])]
+    # Released once the first run is done
+    assert projection.run("sheet1")["locked"] is False
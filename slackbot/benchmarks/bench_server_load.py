@@ -0,0 +1,222 @@
+"""Backblast throughput of the cloud function path against the long-running server (server.py).
+
+Sends N_SUBMISSIONS signed backblast submissions, CONCURRENCY at a time, to each path:
+
+- "faas": main.slackbot behind a threaded WSGI server. The ack re-posts the request to itself
+  (HttpLazyListenerRunner, as with SLACKBOT_URL), and the continuation enqueues to a stand-in for
+  Cloud Tasks that takes ENQUEUE_LATENCY to create a task and DISPATCH_DELAY to deliver it.
+- "server": server.py's aiohttp app, with backblasts handed to the handler in-process (ThreadSink,
+  with CONCURRENCY workers, i.e. TASK_SINK=thread and TASK_SINK_WORKERS).
+
+Slack is the load test's stand-in (loadtest/standin_slack.py), taking SLACK_LATENCY per call; the sheets handler is a stand-in that takes
+SHEETS_LATENCY. Each submission has PAX_PER_SUBMISSION pax drawn from PAX_POOL people, and caches
+start empty for each path (names missing from them cost a users.info call each). Cold starts are not included; see
+bench_cold_start.py for those.
+
+Reports ack latency (what the submitter waits for), end-to-end latency (until the sheets handler is
+done with the backblast), throughput and slack api calls.
+
+Run from the slackbot directory: python benchmarks/bench_server_load.py
+"""
+import asyncio
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "slackbot"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "common"))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "loadtest"))
+
+N_SUBMISSIONS = 60
+CONCURRENCY = 6
+PAX_PER_SUBMISSION = 12
+PAX_POOL = 150
+SLACK_LATENCY = 0.03
+ENQUEUE_LATENCY = 0.05
+DISPATCH_DELAY = 0.1
+SHEETS_LATENCY = 0.05
+SIGNING_SECRET = "bench-signing-secret"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+FAAS_PORT = _free_port()
+os.environ.update({
+    "SLACK_BOT_TOKEN": "xoxb-bench",
+    "SLACK_SIGNING_SECRET": SIGNING_SECRET,
+    "SLACK_TEAM_ID": "Tbench",
+    "SLACKBOT_URL": f"http://127.0.0.1:{FAAS_PORT}/",
+    "TASK_SINK": "thread",
+    "PAX_SELECT_COALESCE_SECONDS": "0",
+})
+
+import main  # noqa: E402
+import server  # noqa: E402
+from aiohttp import web  # noqa: E402
+from flask import Flask, request  # noqa: E402
+from slack_sdk.signature import SignatureVerifier  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+from paxmate_common.directory import ChannelDirectory, TTLCache, UserDirectory  # noqa: E402
+from standin_slack import CallCounter, StandInSlack  # noqa: E402
+from task_sinks import TaskSink, ThreadSink  # noqa: E402
+
+
+class Completions:
+    """The sheets handler stand-in; records when each backblast was handled."""
+
+    def __init__(self):
+        self.done_at = {}
+        self.lock = threading.Lock()
+        self.all_done = threading.Event()
+
+    def __call__(self, payload):
+        time.sleep(SHEETS_LATENCY)
+        with self.lock:
+            self.done_at[payload["body"]["id"]] = time.perf_counter()
+            if len(self.done_at) == N_SUBMISSIONS:
+                self.all_done.set()
+
+
+class StandInCloudTasksSink(TaskSink):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def submit(self, payload, task_id):
+        time.sleep(ENQUEUE_LATENCY)
+        threading.Timer(DISPATCH_DELAY, self.handler, args=(payload,)).start()
+        return task_id
+
+
+def _submission(i):
+    pax = random.sample([f"Upax{n:04d}" for n in range(PAX_POOL)], PAX_PER_SUBMISSION)
+    values = {
+        "date-ao-q": {
+            "date-select": {"type": "datepicker", "selected_date": "2023-06-05"},
+            "ao-select": {"type": "channels_select", "selected_channel": "Cbench"},
+            "q-select": {"type": "users_select", "selected_user": pax[0]},
+        },
+        "pax-select": {"pax-select": {"type": "multi_users_select", "selected_users": pax}},
+        "summary": {"summary": {"type": "plain_text_input", "value": "Merkins and more merkins"}},
+    }
+    body = {
+        "type": "view_submission",
+        "team": {"id": "Tbench", "domain": "bench"},
+        "user": {"id": pax[0], "team_id": "Tbench"},
+        "api_app_id": "Abench",
+        "trigger_id": f"trigger{i}",
+        "view": {
+            "id": f"Vbench{i:05d}", "team_id": "Tbench", "type": "modal", "callback_id": "backblast_modal",
+            "hash": f"1685991526.{i:08d}", "private_metadata": "", "state": {"values": values},
+        },
+    }
+    return body
+
+
+def _signed(body):
+    raw = urllib.parse.urlencode({"payload": json.dumps(body)})
+    timestamp = str(int(time.time()))
+    return raw, {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "X-Slack-Request-Timestamp": timestamp,
+        "X-Slack-Signature": SignatureVerifier(SIGNING_SECRET).generate_signature(timestamp=timestamp, body=raw),
+    }
+
+
+def _post(port, path, body):
+    raw, headers = _signed(body)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        start = time.perf_counter()
+        connection.request("POST", path, body=raw, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return start, time.perf_counter() - start, response.status
+    finally:
+        connection.close()
+
+
+def _reset_state(sink, slack):
+    main.user_directory = UserDirectory(lambda: main.app.client)
+    main.channel_directory = ChannelDirectory(lambda: main.app.client)
+    main.recent_submissions = TTLCache(max_size=1000, ttl=3600)
+    main.task_sink = sink
+    slack.calls = CallCounter()
+
+
+def start_faas(port):
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule("/", view_func=lambda: main.slackbot(request), methods=["GET", "POST"])
+    wsgi_server = make_server("127.0.0.1", port, flask_app, threaded=True)
+    threading.Thread(target=wsgi_server.serve_forever, daemon=True).start()
+    return wsgi_server
+
+
+def start_async_server():
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server.build_web_app(warm_up=False))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return runner.addresses[0][1]
+
+
+def run_load(name, port, path, completions, slack):
+    submissions = [_submission(i) for i in range(N_SUBMISSIONS)]
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        results = list(executor.map(lambda body: _post(port, path, body), submissions))
+    if not completions.all_done.wait(timeout=120):
+        print(f"{name:>6}: only {len(completions.done_at)} of {N_SUBMISSIONS} backblasts were handled")
+        return
+
+    sent_at = {main._get_backblast_id(body): start for body, (start, _, _) in zip(submissions, results)}
+    acks = sorted(ack for _, ack, _ in results)
+    end_to_end = sorted(completions.done_at[backblast_id] - start for backblast_id, start in sent_at.items())
+    elapsed = max(completions.done_at.values()) - min(sent_at.values())
+    statuses = sorted({status for _, _, status in results})
+
+    def p(values, q):
+        return values[int(q * (len(values) - 1))] * 1000
+
+    print(
+        f"{name:>6}: ack p50 {statistics.median(acks) * 1000:.0f} ms, p95 {p(acks, 0.95):.0f} ms;"
+        f" end-to-end p50 {statistics.median(end_to_end) * 1000:.0f} ms, p95 {p(end_to_end, 0.95):.0f} ms;"
+        f" {N_SUBMISSIONS / elapsed:.1f} backblasts/s; {slack.calls.total()} slack api calls; status {statuses}"
+    )
+
+
+def run():
+    random.seed(0)
+    # users.list lists everyone, for the server's warm-up sweep
+    slack = StandInSlack(latency=SLACK_LATENCY, n_users=PAX_POOL, team_id="Tbench").start()
+    main.app.client.base_url = slack.url
+    server.app.client.base_url = slack.url
+
+    faas = start_faas(FAAS_PORT)
+    completions = Completions()
+    _reset_state(StandInCloudTasksSink(completions), slack)
+    run_load("faas", FAAS_PORT, "/", completions, slack)
+    faas.shutdown()
+
+    server_port = start_async_server()
+    completions = Completions()
+    _reset_state(ThreadSink(completions, workers=CONCURRENCY), slack)
+    run_load("server", server_port, "/slack/events", completions, slack)
+
+
+if __name__ == "__main__":
+    run()
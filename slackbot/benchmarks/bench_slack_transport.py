@@ -0,0 +1,99 @@
+"""Per-call latency of slack api calls with and without pooled keep-alive connections.
+
+Replays the lookups for a 25-PAX backblast (one conversations.info, and users.info for each pax,
+the Q and the submitter, 8 at a time as the slackbot does) against the load test's slack stand-in
+(loadtest/standin_slack.py) over TLS, several times over to look like a warm instance.
+
+"pooled" is the client both functions call slack with: a RateLimitedWebClient on a shared
+HTTPConnectionPool, with main.py's default settings. "urllib" is the same client without the pool, on
+slack_sdk's transport, which opens a connection and a TLS session per call. "webclient" is a plain
+slack_sdk WebClient, with neither the pool nor the client's rate limiting, for comparison.
+
+The stub sleeps CONNECT_LATENCY on each new connection (the round trips of a TCP and TLS
+handshake to slack) and REQUEST_LATENCY on each request.
+
+Needs the openssl command line tool for the stub's certificate.
+Run from the slackbot directory: python benchmarks/bench_slack_transport.py
+"""
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "common"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "loadtest"))
+
+from slack_sdk import WebClient  # noqa: E402
+
+from paxmate_common.slack_client import HTTPConnectionPool, RateLimitedWebClient  # noqa: E402
+from standin_slack import StandInSlack  # noqa: E402
+
+N_PAX = 25
+N_SUBMISSIONS = 5
+LOOKUP_WORKERS = 8
+CONNECT_LATENCY = 0.03
+REQUEST_LATENCY = 0.005
+# SLACK_HTTP_POOL_SIZE and SLACK_HTTP_IDLE_TIMEOUT_SECONDS' defaults
+POOL_SIZE = 10
+IDLE_TIMEOUT = 30
+
+
+def start_stub(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+    stub = StandInSlack(latency=REQUEST_LATENCY, connect_latency=CONNECT_LATENCY, ssl_context=server_context)
+    return stub.start(), ssl.create_default_context(cafile=cert)
+
+
+def replay_submission(client, executor):
+    def timed(call):
+        start = time.perf_counter()
+        call()
+        return time.perf_counter() - start
+
+    calls = [lambda: client.conversations_info(channel="C04V4E61LN8")]
+    calls += [lambda i=i: client.users_info(user=f"U{i:010d}") for i in range(N_PAX + 2)]
+    return list(executor.map(timed, calls))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        stub, client_context = start_stub(directory)
+        clients = (
+            ("webclient", WebClient(token="xoxb-test", base_url=stub.url, ssl=client_context)),
+            ("urllib", RateLimitedWebClient(token="xoxb-test", base_url=stub.url, ssl=client_context, pool_size=0)),
+            ("pooled", RateLimitedWebClient(
+                token="xoxb-test", base_url=stub.url, ssl=client_context,
+                http_pool=HTTPConnectionPool(max_idle=POOL_SIZE, idle_timeout=IDLE_TIMEOUT),
+            )),
+        )
+        for name, client in clients:
+            latencies = []
+            submission_seconds = []
+            with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+                for _ in range(N_SUBMISSIONS):
+                    start = time.perf_counter()
+                    latencies += replay_submission(client, executor)
+                    submission_seconds.append(time.perf_counter() - start)
+            latencies.sort()
+            print(
+                f"{name:>9}: per call p50 {statistics.median(latencies) * 1000:.1f} ms,"
+                f" p95 {latencies[int(0.95 * (len(latencies) - 1))] * 1000:.1f} ms;"
+                f" per submission {statistics.mean(submission_seconds) * 1000:.0f} ms"
+                f" ({N_PAX + 3} calls, first {submission_seconds[0] * 1000:.0f} ms)"
+            )
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Per-call cost of building the /backblast modal.
+
+"rebuild" is what open_backblast_form used to do: construct the whole nested view (and the
+f-string metadata) on every call. "template" patches the pre-built template.
+
+Run from the slackbot directory: python benchmarks/bench_views.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "slackbot"))
+
+from views import _build_backblast_modal_template, build_backblast_modal  # noqa: E402
+
+
+def rebuild():
+    view = _build_backblast_modal_template()
+    view["private_metadata"] = f'{{"initial_channel": "{"C04V4E61LN8"}", "team": "{"T04MU29F08G"}"}}'
+    view["blocks"][0]["elements"][0]["initial_date"] = "2023-06-05"
+    view["blocks"][0]["elements"][2]["initial_user"] = "U04M6R3FPBN"
+    return view
+
+
+def template():
+    return build_backblast_modal("2023-06-05", "U04M6R3FPBN", "C04V4E61LN8", "T04MU29F08G")
+
+
+def main(number=20000):
+    for name, func in (("rebuild", rebuild), ("template", template)):
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print(f"{name:>8}: {seconds / number * 1e6:.2f} us/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Cloud Functions runs main.py with its source directory on the path, and the deploy
+# workflow copies the shared paxmate_common package into it. Mirror that for the tests.
+here = os.path.dirname(__file__)
+sys.path.insert(0, os.path.join(here, "slackbot"))
+sys.path.insert(0, os.path.join(here, "..", "common"))
+# The load test's slack stand-in, also used by the tests and benchmarks
+sys.path.insert(0, os.path.join(here, "..", "loadtest"))
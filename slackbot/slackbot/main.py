@@ -1,15 +1,33 @@
-import copy
 import datetime
+import http.client
 import json
 import logging
 import os
+import socket
 import time
+import urllib.parse
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import make_response
 
-from google.cloud import tasks_v2
-from slack_bolt import App
+from slack_bolt import App, BoltRequest
+from slack_bolt.authorization import AuthorizeResult
 from slack_bolt.adapter.flask import SlackRequestHandler
+from slack_bolt.lazy_listener import LazyListenerRunner
+from slack_bolt.middleware.request_verification import RequestVerification
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.signature import SignatureVerifier
+
+from paxmate_common import tracing
+from paxmate_common.directory import ChannelDirectory, TTLCache, UserDirectory
+from paxmate_common.metrics import logs_metrics, registry, render_metrics
+from paxmate_common.slack_client import HTTPConnectionPool, RateLimitedWebClient
+from paxmate_common.teams import TeamRegistry, load_team_configs
+from paxmate_common.tracing import tracer
+from paxmate_common.warmup import run_warmup_steps
+from task_sinks import build_task_sink
+from views import ViewUpdateCoalescer, build_backblast_modal, build_pax_count_update
 
 class SlackbotConfig:
     def __init__(self):
@@ -19,32 +37,243 @@ class SlackbotConfig:
         self.handler_url = os.environ.get("BACKBLAST_HANDLER_URL")
         # This will be set on a per-deployment basis for now, but if we had a multi-workspace app woudl come from interaction payloads
         self.team_id = os.environ.get("SLACK_TEAM_ID")  
+        # Checked by slackbot() rather than bolt, so importing this module (e.g. from server.py in
+        # Socket Mode, where requests aren't signed) doesn't need it
+        self.signing_secret = os.environ.get("SLACK_SIGNING_SECRET")
+        # Public URL of this function. When set, lazy listeners (e.g. backblast parsing and enqueueing)
+        # run in a separate invocation of the function so the interaction is acked right away.
+        self.lazy_listener_url = os.environ.get("SLACKBOT_URL")
 
         # Default to empty, but expect a comma separated list of IDs
         self.paxmate_say_authorized_slack_ids = os.environ.get("PAXMATE_SAY_AUTHORIZED_SLACK_IDS", "").replace(" ", "").split(",")
 
+        # In-process cache of user id -> name, filled by a users.list sweep on a cold instance
+        self.user_cache_ttl = int(os.environ.get("USER_CACHE_TTL_SECONDS", 3600))
+        self.user_cache_max_size = int(os.environ.get("USER_CACHE_MAX_SIZE", 5000))
+        # In-process cache of channel id -> conversations.info metadata; rename/archive/membership
+        # events drop entries early, but only on the instance that receives the event
+        self.channel_cache_ttl = int(os.environ.get("CHANNEL_CACHE_TTL_SECONDS", 3600))
+        # Version 1 task payloads carry resolved names; version 2 payloads carry only slack ids plus
+        # the raw view state, and the sheets handler resolves names. Keep at 1 until every sheets
+        # handler understands version 2.
+        self.backblast_payload_version = int(os.environ.get("BACKBLAST_PAYLOAD_VERSION", 1))
+        # How long a pax selection made during a burst of them waits for a newer one before updating the pax count
+        self.pax_select_coalesce_seconds = float(os.environ.get("PAX_SELECT_COALESCE_SECONDS", 0.25))
+        # Where backblast tasks go: "cloud_tasks" (default), or "thread"/"sqlite" to handle them on this
+        # machine (see task_sinks.build_task_sink). TASK_SINK_HANDLER ("path/to/main.py:f3_sheets_handler")
+        # makes the local sinks call the sheets handler in-process instead of posting to BACKBLAST_HANDLER_URL.
+        self.task_sink = os.environ.get("TASK_SINK", "cloud_tasks")
+        self.task_sink_handler = os.environ.get("TASK_SINK_HANDLER")
+        # Tasks the "thread" sink handles at once
+        self.task_sink_workers = int(os.environ.get("TASK_SINK_WORKERS", 1))
+        # Sqlite file for the "sqlite" sink; with "cloud_tasks", tasks that fail to enqueue are spooled here for retry
+        self.task_spool_path = os.environ.get("TASK_SPOOL_PATH", "/tmp/paxmate-tasks.sqlite3" if self.task_sink == "sqlite" else "")
+        # Per-attempt deadline, in seconds, and number of attempts for creating a cloud task
+        self.enqueue_deadline = float(os.environ.get("ENQUEUE_DEADLINE_SECONDS", 5))
+        self.enqueue_max_attempts = int(os.environ.get("ENQUEUE_MAX_ATTEMPTS", 3))
+        # Upper bound on concurrent slack lookups while parsing a backblast
+        self.lookup_workers = int(os.environ.get("SLACK_LOOKUP_WORKERS", 8))
+        # Idle keep-alive connections to slack kept for reuse (0 disables pooling), and how long one may sit idle
+        self.slack_http_pool_size = int(os.environ.get("SLACK_HTTP_POOL_SIZE", 10))
+        self.slack_http_idle_timeout = float(os.environ.get("SLACK_HTTP_IDLE_TIMEOUT_SECONDS", 30))
+        # Where slack api calls go; only changed to point at a stand-in, e.g. for load tests
+        self.slack_api_url = os.environ.get("SLACK_API_URL", WebClient.BASE_URL)
+
 slackbot_config = SlackbotConfig()
 
-client = tasks_v2.CloudTasksClient()
-parent = client.queue_path(slackbot_config.gcp_project, slackbot_config.gcp_location, slackbot_config.gcp_queue_name)
+# Workspaces served by a multi-workspace deployment (TEAMS_CONFIG or TEAMS_CONFIG_PATH); empty when
+# the deployment serves only the workspace in its own env vars.
+team_configs = load_team_configs()
+
+task_sink = build_task_sink(slackbot_config)
 
 logging.basicConfig(level=logging.INFO)
 
-app = App(
-    token=os.environ.get("SLACK_BOT_TOKEN"),
-    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
-    process_before_response=True,
+# Connections to slack, shared by every workspace's client
+slack_http_pool = HTTPConnectionPool(
+    max_idle=slackbot_config.slack_http_pool_size, idle_timeout=slackbot_config.slack_http_idle_timeout,
 )
 
+
+def _authorize_team(enterprise_id, team_id, logger):
+    return AuthorizeResult(enterprise_id=enterprise_id, team_id=team_id, bot_token=teams.get(team_id).config.bot_token)
+
+
+if team_configs:
+    # Each workspace may be a different slack app: slackbot() checks the signature with the
+    # request's team's signing secret, and listeners get that team's token from _authorize_team.
+    app = App(
+        client=RateLimitedWebClient(base_url=slackbot_config.slack_api_url, http_pool=slack_http_pool),
+        authorize=_authorize_team,
+        request_verification_enabled=False,
+        process_before_response=True,
+    )
+else:
+    app = App(
+        # Paces calls to slack's rate limits, retrying 429s rather than failing them, over pooled connections
+        client=RateLimitedWebClient(
+            token=os.environ.get("SLACK_BOT_TOKEN"), base_url=slackbot_config.slack_api_url, http_pool=slack_http_pool,
+        ),
+        # slackbot() checks the signature (see _verify_request)
+        request_verification_enabled=False,
+        process_before_response=True,
+        # Don't call auth.test at import; bolt calls it on the first slack request instead,
+        # which keeps it off cold starts that only serve /healthz.
+        token_verification_enabled=False,
+    )
+
+
+class HttpLazyListenerRunner(LazyListenerRunner):
+    """Runs a lazy listener by re-posting the original Slack request to this function.
+
+    The copy carries the original body and Slack signature headers, so it passes request
+    verification, plus Bolt's lazy-only headers so only the named lazy function runs, and a
+    traceparent so the continuation joins this request's trace. We only
+    wait long enough to hand the request off; the continuation keeps running on its own.
+    """
+    forwarded_headers = {"content-type", "x-slack-signature", "x-slack-request-timestamp"}
+
+    def __init__(self, url, logger, connect_timeout=2.0, response_timeout=0.2):
+        self.url = url
+        self.logger = logger
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+
+    def start(self, function, request):
+        headers = {k: v[0] for k, v in request.headers.items() if k in self.forwarded_headers and v}
+        headers["x-slack-bolt-lazy-only"] = "1"
+        headers["x-slack-bolt-lazy-function-name"] = request.lazy_function_name
+        tracing.inject(headers)
+
+        url = urllib.parse.urlsplit(self.url)
+        connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        connection = connection_class(url.netloc, timeout=self.connect_timeout)
+        try:
+            try:
+                connection.request("POST", url.path or "/", body=request.raw_body.encode(), headers=headers)
+            except OSError as e:
+                # The continuation was never delivered; do the work here rather than lose it.
+                self.logger.error(f"Error dispatching lazy listener {request.lazy_function_name}, running inline: {e}")
+                self.run(function=function, request=request)
+                return
+            try:
+                connection.sock.settimeout(self.response_timeout)
+                response = connection.getresponse()
+                if response.status >= 400:
+                    self.logger.error(f"Lazy listener {request.lazy_function_name} returned status {response.status}")
+            except socket.timeout:
+                # Expected: the continuation is still running.
+                pass
+        finally:
+            connection.close()
+
+
+class InlineLazyListenerRunner(LazyListenerRunner):
+    """Runs lazy listeners before the response is returned (the behavior without SLACKBOT_URL)."""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def start(self, function, request):
+        self.run(function=function, request=request)
+
+
+# Backblast ids of recently processed submissions, so a repeated delivery is dropped before any api call
+recent_submissions = TTLCache(max_size=1000, ttl=3600)
+
+pax_select_coalescer = ViewUpdateCoalescer(slackbot_config.pax_select_coalesce_seconds)
+
+lookup_executor = ThreadPoolExecutor(max_workers=slackbot_config.lookup_workers, thread_name_prefix="slack-lookup")
+
+user_directory = UserDirectory(
+    lambda: app.client,
+    max_size=slackbot_config.user_cache_max_size,
+    ttl=slackbot_config.user_cache_ttl,
+)
+
+channel_directory = ChannelDirectory(lambda: app.client, ttl=slackbot_config.channel_cache_ttl)
+
+
+class Team:
+    """A workspace of a multi-workspace deployment, with its own client and caches."""
+
+    def __init__(self, config):
+        self.config = config
+        self.team_id = config.team_id
+        self.paxmate_say_authorized_slack_ids = config.paxmate_say_authorized_slack_ids
+        self.client = RateLimitedWebClient(
+            token=config.bot_token, base_url=slackbot_config.slack_api_url, http_pool=slack_http_pool,
+        )
+        self.user_directory = UserDirectory(
+            lambda: self.client,
+            max_size=slackbot_config.user_cache_max_size,
+            ttl=slackbot_config.user_cache_ttl,
+        )
+        self.channel_directory = ChannelDirectory(lambda: self.client, ttl=slackbot_config.channel_cache_ttl)
+
+
+class DeploymentTeam:
+    """The one workspace of a single-workspace deployment; its client and caches are this module's."""
+
+    @property
+    def team_id(self):
+        return slackbot_config.team_id
+
+    @property
+    def paxmate_say_authorized_slack_ids(self):
+        return slackbot_config.paxmate_say_authorized_slack_ids
+
+    @property
+    def client(self):
+        return app.client
+
+    @property
+    def user_directory(self):
+        return user_directory
+
+    @property
+    def channel_directory(self):
+        return channel_directory
+
+
+teams = TeamRegistry(team_configs, Team)
+deployment_team = DeploymentTeam()
+
+
+def _get_team(team_id):
+    if team_configs:
+        return teams.get(team_id)
+    return deployment_team
+
+
+def _get_all_teams():
+    if team_configs:
+        return [teams.get(team_id) for team_id in team_configs]
+    return [deployment_team]
+
+
+def _get_team_id(body):
+    return body.get("team", {}).get("id") or body.get("team_id") or body.get("view", {}).get("team_id")
+
+
+if slackbot_config.lazy_listener_url:
+    app.listener_runner.lazy_listener_runner = HttpLazyListenerRunner(slackbot_config.lazy_listener_url, app.logger)
+else:
+    app.listener_runner.lazy_listener_runner = InlineLazyListenerRunner(app.logger)
+
+# Listeners call slack through their team's client rather than the `client` bolt passes them, which is a
+# plain WebClient per request: no pacing to rate limits and no pooled connections.
+
 @app.command("/paxmate")
-def post_as_paxmate(ack, client, command, logger):
+def post_as_paxmate(ack, command, logger):
     ack()
     logger.info(json.dumps(command))
     user = command.get("user_id")
     channel = command.get("channel_id")
     text = command.get("text")
+    team = _get_team(command.get("team_id"))
     if text is None or not text.startswith("say "):
-        client.chat_postEphemeral(
+        team.client.chat_postEphemeral(
             channel=channel,
             text="I don't understand that command. Try saying, /paxmate say I like Banjo.",
             user=user
@@ -54,285 +283,33 @@ def post_as_paxmate(ack, client, command, logger):
     else:
         text = text[4:]
 
-    if user not in slackbot_config.paxmate_say_authorized_slack_ids:
-        client.chat_postEphemeral(
+    if user not in team.paxmate_say_authorized_slack_ids:
+        team.client.chat_postEphemeral(
             channel=channel,
             # TODO(multi-tenant) look this up based on the list of slack ids
             text="Sorry, you don't have this power; please check with the Paxmate Admin.",
             user=user
         )
     else:
-        client.chat_postMessage(
+        team.client.chat_postMessage(
             channel=channel,
             text=text,
         )
 
 
 @app.command("/backblast")
-def open_backblast_form(ack, client, command, logger):
+def open_backblast_form(ack, command, logger):
     ack()
     trigger_id = command.get("trigger_id")
     user = command.get("user_id")
-    team = slackbot_config.team_id
+    team = _get_team(command.get("team_id"))
     channel = command.get("channel_id")
     default_date = datetime.datetime.now().strftime("%Y-%m-%d")
 
     try:
-        client.views_open(
+        team.client.views_open(
             trigger_id=trigger_id,
-            view={
-                "type": "modal",
-                "callback_id": "backblast_modal",
-                "title": {
-                    "type": "plain_text",
-                    # TODO(multi-tenant) Add customization of this header.
-                    # There is a 25 character limit.
-                    "text": "F3 PaxMate",
-                    "emoji": True
-                },
-                "submit": {
-                    "type": "plain_text",
-                    "text": "Submit",
-                    "emoji": True
-                },
-                "close": {
-                    "type": "plain_text",
-                    "text": "Cancel",
-                    "emoji": True
-                },
-                "private_metadata": f'{{"initial_channel": "{channel}", "team": "{team}"}}',
-                # body of the view
-                "blocks": [
-                    {
-                        "type": "actions",
-                        "block_id": "date-ao-q",
-                        "elements": [
-                            {
-                                "type": "datepicker",
-                                "initial_date": default_date,
-                                "placeholder": {
-                                    "type": "plain_text",
-                                    "text": "Select date",
-                                    "emoji": True
-                                },
-                                "action_id": "date-select"
-                            },
-                            {
-                                "type": "channels_select",
-                                "placeholder": {
-                                    "type": "plain_text",
-                                    "text": "Select an AO by channel",
-                                    "emoji": True
-                                },
-                                "action_id": "ao-select",
-                                # do not set an initial_channel since too many people left it as default (1st f)
-                                # "initial_channel": channel,
-                            },
-                            {
-                                "type": "users_select",
-                                "initial_user": user,
-                                "placeholder": {
-                                    "type": "plain_text",
-                                    "text": "Select Q",
-                                    "emoji": True
-                                },
-                                "action_id": "q-select"
-                            }
-                        ]
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "pax-select",
-                        "dispatch_action": True,
-                        "element": {
-                            "type": "multi_users_select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Select pax who posted",
-                                "emoji": True
-                            },
-                            "action_id": "pax-select"
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "Pax",
-                            "emoji": True
-                        }
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "summary",
-                        "element": {
-                            "type": "plain_text_input",
-                            "multiline": True,
-                            "initial_value": """WARMUP:
-
-THE THANG:
-
-MARY:
-
-ANNOUNCEMENTS / COT:
-""",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Workout summary"
-                            },
-                            "action_id": "summary",
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "Workout Summary",
-                            "emoji": True
-                        },
-                        "optional": True
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "fng-select",
-                        "element": {
-                            "type": "multi_users_select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "FNGs",
-                                "emoji": True
-                            },
-                            "action_id": "fng-select"
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "FNGs",
-                            "emoji": True
-                        },
-                        "optional": True
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "pax-no-slack",
-                        "element": {
-                            "type": "plain_text_input",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Pax Not Yet on Slack"
-                            },
-                            "action_id": "pax-no-slack",
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "Additional Pax?",
-                            "emoji": True
-                        },
-                        "optional": True
-                    },
-                    {
-                        "type": "input",
-                        "block_id": "visiting-pax",
-                        "element": {
-                            "type": "static_select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "How many PAX from another region?"
-                            },
-                            "options": [
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "0",
-                                        "emoji": True
-                                    },
-                                    "value": "0"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "1",
-                                        "emoji": True
-                                    },
-                                    "value": "1"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "2",
-                                        "emoji": True
-                                    },
-                                    "value": "2"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "3",
-                                        "emoji": True
-                                    },
-                                    "value": "3"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "4",
-                                        "emoji": True
-                                    },
-                                    "value": "4"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "5",
-                                        "emoji": True
-                                    },
-                                    "value": "5"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "6",
-                                        "emoji": True
-                                    },
-                                    "value": "6"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "7",
-                                        "emoji": True
-                                    },
-                                    "value": "7"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "8",
-                                        "emoji": True
-                                    },
-                                    "value": "8"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "9",
-                                        "emoji": True
-                                    },
-                                    "value": "9"
-                                },
-                                {
-                                    "text": {
-                                        "type": "plain_text",
-                                        "text": "10+",
-                                        "emoji": True
-                                    },
-                                    "value": "10+"
-                                }
-                            ],
-                            "action_id": "visiting-pax"
-                        },
-                        "label": {
-                            "type": "plain_text",
-                            "text": "Visiting PAX",
-                            "emoji": True
-                        },
-                        "optional": True
-                    }
-                ]
-            }
+            view=build_backblast_modal(default_date, user, channel, team.team_id),
         )
 
     except Exception as e:
@@ -364,39 +341,30 @@ def handle_pax_select_interactive(ack, body, logger):
     # Get the number of selected users
     actions = body.get("actions", [])
     selected_users_cnt = 0
+    action_ts = 0.0
     for action in actions:
         if action.get("action_id") == "pax-select":
             selected_users_cnt = len(action.get("selected_users", []))
+            action_ts = float(action.get("action_ts", 0))
 
-    def _update_pax_number(blocks, new_num):
-        for block in blocks:
-            # descend into action blocks
-            if block["type"] == "actions":
-                _update_pax_number(block["elements"], new_num)
-            elif block["type"] == "input":
-                if block["element"]["action_id"] == "pax-select":
-                    block["label"]["text"] = f"Pax ({new_num} selected)"
-                    block["element"]["placeholder"]["text"] = f"{new_num} selected"
-
-    # Build the view update:
     view = body.get("view", {})
-    view = copy.deepcopy(view)
-    view.pop("id")
-    view.pop("team_id")
-    view.pop("state")
-    view.pop("hash")
-    view.pop("previous_view_id")
-    view.pop("root_view_id")
-    view.pop("app_id")
-    view.pop("app_installed_team_id")
-    view.pop("bot_id")
-    _update_pax_number(view["blocks"], selected_users_cnt)
-
-    app.client.views_update(
-        view_id=body["view"]["id"],
-        hash=body["view"]["hash"],
-        view=view
-    )
+    if not pax_select_coalescer.wait_for_latest(view["id"], action_ts):
+        logger.info(f"Skipping pax count update for view {view['id']}; a newer selection superseded it")
+        return
+
+    client = _get_team(_get_team_id(body)).client
+    update = build_pax_count_update(view, selected_users_cnt)
+    try:
+        client.views_update(view_id=view["id"], hash=view["hash"], view=update)
+    except SlackApiError as e:
+        if e.response.get("error") != "hash_conflict":
+            raise
+        if not pax_select_coalescer.is_latest(view["id"], action_ts):
+            # The view changed since this selection was made; the update for the newer selection wins
+            logger.info(f"Skipping stale pax count update for view {view['id']}")
+            return
+        # Changed by an earlier selection's update (e.g. the first of this burst); this count is the newest
+        client.views_update(view_id=view["id"], view=update)
 
 
 @app.action("edit-backblast")
@@ -406,24 +374,40 @@ def edit_backblast(ack, body, logger):
     user = body.get("user").get("id")
     channel = body.get("channel").get("id")
     logger.info(f"got data: {dump}")
-    app.client.chat_postEphemeral(
+    _get_team(_get_team_id(body)).client.chat_postEphemeral(
         channel=channel,
         text=f"I can't edit messages yet, but this is in the works. I saw data: {dump}",
         user=user
     )
 
 
-@app.view("backblast_modal")
-def handle_backblast_submit(ack, body, logger) -> None:
-    start = time.time()
-    # Validate data. Currently, this is validating that an AO was selected.
-    # We're doing it separately now because we don't want any latency to
-    # delay the errors update, and in the normal parsing process we hit the slack api
-    ao_id = None
+@app.event("channel_rename")
+@app.event("channel_archive")
+@app.event("channel_unarchive")
+@app.event("member_joined_channel")
+@app.event("member_left_channel")
+@app.event("channel_left")
+def invalidate_channel(body, event, logger):
+    # channel is an object for channel_rename and an id for the others; channel_left is the bot being removed
+    channel = event.get("channel")
+    channel_id = channel.get("id") if isinstance(channel, dict) else channel
+    if channel_id:
+        logger.info(f"Dropping cached channel info for {channel_id} after {event.get('type')}")
+        _get_team(body.get("team_id")).channel_directory.invalidate(channel_id)
+
+
+def _get_selected_ao_id(body):
     try:
-        ao_id = body["view"]["state"]["values"]["date-ao-q"]["ao-select"]["selected_channel"]
+        return body["view"]["state"]["values"]["date-ao-q"]["ao-select"]["selected_channel"]
     except KeyError:
-        pass
+        return None
+
+
+def handle_backblast_submit(ack, body, logger) -> None:
+    # Validate data. Currently, this is validating that an AO was selected.
+    # Only validation happens here; the slack api lookups and enqueueing happen
+    # in process_backblast_submit so they don't count against slack's 3 second ack deadline.
+    ao_id = _get_selected_ao_id(body)
     if ao_id is None or ao_id == "":
         # We cannot put the error message on the channel select because it is not an "input"
         # type object. This seems like a slack limitation (see: 
@@ -432,18 +416,56 @@ def handle_backblast_submit(ack, body, logger) -> None:
         ack(response_action="errors", errors=errors)
         return
     ack()
-    backblast_data = _parse_backblast_body(body, logger)
-    now = time.time()
-    logger.info(f"starting to add to queue after {now - start}")
-    _add_data_to_queue(backblast_data, logger)
+
+
+def process_backblast_submit(body, logger) -> None:
+    start = time.time()
+    # Lazy listeners run even when the submission was rejected, so re-check the AO.
+    ao_id = _get_selected_ao_id(body)
+    if ao_id is None or ao_id == "":
+        return
+    backblast_id = _get_backblast_id(body)
+    if not recent_submissions.add(backblast_id, True):
+        logger.info(f"Skipping repeated delivery of backblast {backblast_id}")
+        return
+    # Set up the queue client while the slack lookups run
+    task_sink.warm()
+    resolve_names = slackbot_config.backblast_payload_version < 2
+    with tracer.span("backblast.process", backblast_id=backblast_id) as span:
+        payload_version = str(slackbot_config.backblast_payload_version)
+        with registry.timer("backblast_parse_seconds", payload_version=payload_version), \
+                tracer.span("backblast.parse", payload_version=payload_version):
+            backblast_data = _parse_backblast_body(body, logger, resolve_names=resolve_names)
+        now = time.time()
+        logger.info(f"user directory stats: {_get_team(_get_team_id(body)).user_directory.stats()}")
+        logger.info(f"starting to add to queue after {now - start} (trace {span.context.trace_id})")
+        if not _add_data_to_queue(backblast_data, logger):
+            # Let a redelivery try again
+            recent_submissions.pop(backblast_id)
+            span.status = "error"
     now = time.time()
     logger.info(f"done adding to queue after {now - start}")
 
 
-def _parse_backblast_body(body, logger):
+app.view("backblast_modal")(ack=handle_backblast_submit, lazy=[process_backblast_submit])
+
+
+def _get_backblast_id(body):
+    # Derived from the submitted view rather than random, so every delivery of the same submission
+    # gets the same id, and so the same cloud task name, which cloud tasks deduplicates.
+    view = body.get("view", {})
+    view_id = view.get("id")
+    if not view_id:
+        return uuid.uuid4().hex
+    team_id = view.get("team_id") or body.get("team", {}).get("id", "")
+    return uuid.uuid5(uuid.NAMESPACE_URL, f"slack:{team_id}:{view_id}:{view.get('hash', '')}").hex
+
+
+def _parse_backblast_body(body, logger, resolve_names=True):
     date = "1970-01-01"
     ao_id = ""
     ao = ""
+    ao_channel = None
     q_id = ""
     q = ""
     pax_ids = []
@@ -455,6 +477,17 @@ def _parse_backblast_body(body, logger):
     n_visiting_pax = 0
     submitter_id = ""
     submitter = ""
+
+    team = _get_team(_get_team_id(body))
+
+    # Every slack lookup is submitted to the lookup pool as soon as its id is known, and
+    # collected below, so parsing takes about as long as the slowest lookup rather than all of them.
+    ao_future = None
+    q_future = None
+    pax_futures = None
+    fng_futures = None
+    submitter_future = None
+
     values = body.get("view", {}).get("state", {}).get("values", {})
     for val in values.values():
         try:
@@ -462,23 +495,22 @@ def _parse_backblast_body(body, logger):
                 date = val["date-select"]["selected_date"]
             if "ao-select" in val:
                 ao_id = val["ao-select"].get("selected_channel", "")
-                try:
-                    ao_obj = app.client.conversations_info(channel=ao_id)
-                    ao = ao_obj.get("channel", {}).get("name", "")
-                except Exception as e:
-                    logger.error(f"Error getting channel info for channel {ao_id}")
-                    ao = ""
+                if resolve_names:
+                    ao_future = lookup_executor.submit(team.channel_directory.get, ao_id)
             if "q-select" in val:
                 q_id = val["q-select"]["selected_user"]
-                q = _get_name_from_id(q_id)
+                if resolve_names:
+                    q_future = lookup_executor.submit(team.user_directory.get_name, q_id)
             if "pax-select" in val:
                 pax_ids = val["pax-select"]["selected_users"]
-                pax = _get_names_from_id_list(pax_ids)
+                if resolve_names:
+                    pax_futures = [lookup_executor.submit(team.user_directory.get_name, id_) for id_ in pax_ids]
             if "summary" in val:
                 summary = val["summary"]["value"]
             if "fng-select" in val:
                 fng_ids = val["fng-select"]["selected_users"]
-                fngs = _get_names_from_id_list(fng_ids)
+                if resolve_names:
+                    fng_futures = [lookup_executor.submit(team.user_directory.get_name, id_) for id_ in fng_ids]
             if "pax-no-slack" in val:
                 pax_no_slack = val["pax-no-slack"]["value"]
             if "visiting-pax" in val:
@@ -498,15 +530,44 @@ def _parse_backblast_body(body, logger):
             logger.error(f"Error parsing /backblast data: {e}")
     try:
         submitter_id = body.get("user", {}).get("id")
-        if submitter_id is not None:
-            submitter = _get_name_from_id(submitter_id)
+        if submitter_id is not None and resolve_names:
+            submitter_future = lookup_executor.submit(team.user_directory.get_name, submitter_id)
     except Exception as e:
         logger.error(f"Error getting submitter from /backblast data: {e}")
 
+    # A failed lookup only blanks its own field
+    if ao_future is not None:
+        try:
+            ao_channel = ao_future.result()
+            ao = ao_channel["name"]
+        except Exception as e:
+            logger.error(f"Error getting channel info for channel {ao_id}")
+    if q_future is not None:
+        try:
+            q = q_future.result()
+        except Exception as e:
+            logger.error(f"Error parsing /backblast data: {e}")
+    if pax_futures is not None:
+        try:
+            pax = [future.result() for future in pax_futures]
+        except Exception as e:
+            logger.error(f"Error parsing /backblast data: {e}")
+    if fng_futures is not None:
+        try:
+            fngs = [future.result() for future in fng_futures]
+        except Exception as e:
+            logger.error(f"Error parsing /backblast data: {e}")
+    if submitter_future is not None:
+        try:
+            submitter = submitter_future.result()
+        except Exception as e:
+            logger.error(f"Error getting submitter from /backblast data: {e}")
+
     backblast_data = {
         "date": date,
         "ao_id": ao_id,
         "ao": ao,
+        "ao_channel": ao_channel,
         "q_id": q_id,
         "q": q,
         "pax_ids": pax_ids,
@@ -518,57 +579,122 @@ def _parse_backblast_body(body, logger):
         "n_visiting_pax": n_visiting_pax,
         "submitter_id": submitter_id,
         "submitter": submitter,
-        "team_id": slackbot_config.team_id,
-        "id": uuid.uuid4().hex
+        "team_id": team.team_id,
+        "id": _get_backblast_id(body)
     }
+    if not resolve_names:
+        # Names are resolved by the sheets handler; ship the raw state along with the ids
+        for field in ("ao", "ao_channel", "q", "pax", "fngs", "submitter"):
+            backblast_data.pop(field)
+        backblast_data["view_state"] = values
     logger.debug(f"Built backblast object: \n{json.dumps(backblast_data, indent=2)}")
     return backblast_data
 
 
-def _get_name_from_id(id_):
-    user = app.client.users_info(user=id_).get("user", {})
-    display_name = user.get("profile", {}).get("display_name", None)
-    real_name = user.get("profile", {}).get("real_name", None)
-    name = user.get("name", None)
-    return display_name or real_name or name or ""
-
-
-def _get_names_from_id_list(id_list):
-    names = []
-    for id_ in id_list:
-        names.append(_get_name_from_id(id_))
-    return names
-
-
 def _add_data_to_queue(backblast_data, logger):
+    payload = {
+        "body": backblast_data
+    }
+    if "view_state" in backblast_data:
+        # Only ids; the sheets handler resolves names
+        payload["version"] = 2
     try:
-        payload = {
-            "body": backblast_data
-        }
-        payload = json.dumps(payload)
-        converted_payload = payload.encode()
-        task = {
-            "http_request": {
-                "http_method": tasks_v2.HttpMethod.POST,
-                "url": slackbot_config.handler_url,
-                "headers": {"Content-type": "application/json"},
-                "body": converted_payload
-            },
-            "name": client.task_path(slackbot_config.gcp_project, slackbot_config.gcp_location, slackbot_config.gcp_queue_name, backblast_data.get("id", uuid.uuid4().hex))
-        }
-        response = client.create_task(request={"parent": parent, "task": task})
-        logger.info(f"Created task {response.name}")
+        # Retries and deadlines are handled by the sink; the result is waited for because work
+        # left running after the request returns gets no cpu on cloud functions. The task carries
+        # the enqueue span as its traceparent.
+        with registry.timer("backblast_enqueue_seconds"), tracer.span("backblast.enqueue"):
+            task_name = task_sink.submit_async(payload, backblast_data.get("id", uuid.uuid4().hex)).result()
+        logger.info(f"Created task {task_name}")
+        return True
     except Exception as e:
         logger.error(f"Error creating task: {e}")
+        return False
 
 
 handler = SlackRequestHandler(app)
 
+def _verify_request(request):
+    """Checks a request's signature with the deployment's signing secret, or its team's in a multi-workspace one.
+
+    Returns an error response, or None when the request may be handled. Requests that name no team
+    (e.g. slack's url_verification) are accepted when any team's secret matches. Without a signing
+    secret, every request is rejected.
+    """
+    body = request.get_data(as_text=True)
+    headers = {k.lower(): v for k, v in request.headers.items()}
+    if not team_configs:
+        if not slackbot_config.signing_secret:
+            logging.error("Rejecting request: SLACK_SIGNING_SECRET is not set")
+        secrets = [slackbot_config.signing_secret]
+    else:
+        team_id = BoltRequest(body=body, headers=headers).context.team_id
+        if team_id is None:
+            secrets = [config.signing_secret for config in team_configs.values()]
+        elif team_id in teams:
+            secrets = [team_configs[team_id].signing_secret]
+        else:
+            logging.warning(f"Rejecting request from unconfigured team {team_id}")
+            return make_response("", 404)
+    if not any(secret and SignatureVerifier(secret).is_valid_request(body, headers) for secret in secrets):
+        return make_response("", 401)
+    return None
+
+
+def _wait_for_task_sink():
+    future = task_sink.warm()
+    if future is not None:
+        future.result()
+
+
+def warm_up():
+    """Sets up the task queue client and fills the user and channel caches of every team served."""
+    steps = [("task_sink", _wait_for_task_sink)]
+    for team in _get_all_teams():
+        prefix = f"{team.team_id}." if team_configs else ""
+        steps.append((f"{prefix}user_directory", team.user_directory.prefetch))
+        steps.append((f"{prefix}channel_directory", team.channel_directory.prefetch))
+    return run_warmup_steps(steps)
+
+
+def _get_request_kind(request):
+    """The slash command, interaction type or event type of a slack request, to label its metrics."""
+    body = request.get_data(as_text=True)
+    try:
+        if body.startswith("{"):
+            payload = json.loads(body)
+            return payload.get("event", {}).get("type") or payload.get("type") or "unknown"
+        fields = urllib.parse.parse_qs(body)
+        if "command" in fields:
+            return fields["command"][0]
+        return json.loads(fields["payload"][0]).get("type") or "unknown"
+    except (KeyError, ValueError):
+        return "unknown"
+
+
+@logs_metrics
 def slackbot(request):
     if request.method == "GET" and request.path.endswith("/healthz"):
+        if request.args.get("warm"):
+            # /healthz?warm=1 (the scheduled warmup) also primes clients and caches, and reports how long each took
+            return make_response(json.dumps({"status": "alive", "path": request.path, "warm": warm_up()}), 200)
         return make_response(f'{{"status": "alive", "path": "{request.path}"}}', 200)
-    return handler.handle(request)
+    if request.method == "GET" and request.path.endswith("/metrics"):
+        body, content_type = render_metrics(request.args.get("format"))
+        return make_response(body, 200, {"Content-Type": content_type})
+
+    # For requests other than lazy listener continuations, this is the time slack waits for its ack
+    lazy = "1" if request.headers.get("x-slack-bolt-lazy-only") else "0"
+    kind = _get_request_kind(request)
+    # A lazy listener continuation carries the traceparent of the request that started it
+    with registry.timer("slackbot_request_seconds", kind=kind, lazy=lazy), \
+            tracer.span("slackbot.request", parent=tracing.extract(request.headers), kind=kind, lazy=lazy):
+        rejection = _verify_request(request)
+        if rejection is not None:
+            return rejection
+        return handler.handle(request)
 
 if __name__ == "__main__":
+    # bolt's development server doesn't go through slackbot(), so bolt checks the signature here
+    app.use(RequestVerification(slackbot_config.signing_secret))
     app.start(port=int(os.environ.get("PORT", 3000)))
 
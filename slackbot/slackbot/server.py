@@ -0,0 +1,205 @@
+"""Runs the slackbot as one long-lived process on bolt's AsyncApp, as an alternative to a cloud function per request.
+
+    python server.py                          # HTTP on $PORT (default 3000); point slack at /slack/events
+    SLACK_APP_TOKEN=xapp-... python server.py # Socket Mode; no public URL needed
+
+Listeners are coroutines: slack is acked as soon as a submission is validated, and the lookups and
+enqueueing run afterwards as an asyncio task, so there is no lazy listener re-post and no cold start.
+Lookups still go through main's user and channel caches and its paced, pooled client; those are
+blocking calls, so they run on threads (concurrently, on main's lookup pool) off the event loop.
+
+Backblasts go wherever main's task sink sends them. To handle them in this process too, with no
+Cloud Tasks hop, set TASK_SINK=sqlite (or thread) and
+TASK_SINK_HANDLER=path/to/sheets_task/src/main.py:f3_sheets_handler.
+
+Serves the single workspace in the env vars (SLACK_BOT_TOKEN, SLACK_SIGNING_SECRET, ...); multi-workspace
+deployments (TEAMS_CONFIG) run as cloud functions.
+"""
+import asyncio
+import datetime
+import json
+import os
+
+from aiohttp import web
+from slack_bolt.app.async_server import AsyncSlackAppServer
+from slack_bolt.async_app import AsyncApp
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_async_handlers import AsyncRateLimitErrorRetryHandler, async_default_handlers
+from slack_sdk.web.async_client import AsyncWebClient
+
+import main
+from paxmate_common.metrics import render_metrics
+from views import build_backblast_modal, build_pax_count_update
+
+# Socket Mode connects out to slack with an app-level token, so requests need no signature check
+app_token = os.environ.get("SLACK_APP_TOKEN")
+
+app = AsyncApp(
+    client=AsyncWebClient(
+        token=os.environ.get("SLACK_BOT_TOKEN"),
+        base_url=main.slackbot_config.slack_api_url,
+        retry_handlers=async_default_handlers() + [AsyncRateLimitErrorRetryHandler(max_retry_count=3)],
+    ),
+    signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+    request_verification_enabled=app_token is None,
+)
+
+
+@app.command("/paxmate")
+async def post_as_paxmate(ack, client, command, logger):
+    await ack()
+    logger.info(json.dumps(command))
+    user = command.get("user_id")
+    channel = command.get("channel_id")
+    text = command.get("text")
+    if text is None or not text.startswith("say "):
+        await client.chat_postEphemeral(
+            channel=channel,
+            text="I don't understand that command. Try saying, /paxmate say I like Banjo.",
+            user=user
+        )
+        logger.warning(f"unrecognized subcommand: {text}")
+        return
+    text = text[4:]
+
+    if user not in main._get_team(command.get("team_id")).paxmate_say_authorized_slack_ids:
+        await client.chat_postEphemeral(
+            channel=channel,
+            text="Sorry, you don't have this power; please check with the Paxmate Admin.",
+            user=user
+        )
+    else:
+        await client.chat_postMessage(channel=channel, text=text)
+
+
+@app.command("/backblast")
+async def open_backblast_form(ack, client, command, logger):
+    await ack()
+    default_date = datetime.datetime.now().strftime("%Y-%m-%d")
+    team = main._get_team(command.get("team_id")).team_id
+    try:
+        await client.views_open(
+            trigger_id=command.get("trigger_id"),
+            view=build_backblast_modal(default_date, command.get("user_id"), command.get("channel_id"), team),
+        )
+    except Exception as e:
+        logger.error(f"Error processing /backblast command: {e}")
+
+
+@app.action("date-select")
+@app.action("ao-select")
+@app.action("q-select")
+async def handle_select_interactive(ack, body, logger):
+    await ack()
+    logger.debug(body)
+
+
+@app.action("pax-select")
+async def handle_pax_select_interactive(ack, body, client, logger):
+    await ack()
+
+    selected_users_cnt = 0
+    action_ts = 0.0
+    for action in body.get("actions", []):
+        if action.get("action_id") == "pax-select":
+            selected_users_cnt = len(action.get("selected_users", []))
+            action_ts = float(action.get("action_ts", 0))
+
+    view = body.get("view", {})
+    if not await main.pax_select_coalescer.wait_for_latest_async(view["id"], action_ts):
+        logger.info(f"Skipping pax count update for view {view['id']}; a newer selection superseded it")
+        return
+
+    update = build_pax_count_update(view, selected_users_cnt)
+    try:
+        await client.views_update(view_id=view["id"], hash=view["hash"], view=update)
+    except SlackApiError as e:
+        if e.response.get("error") != "hash_conflict":
+            raise
+        if not main.pax_select_coalescer.is_latest(view["id"], action_ts):
+            logger.info(f"Skipping stale pax count update for view {view['id']}")
+            return
+        # Changed by an earlier selection's update; this count is the newest
+        await client.views_update(view_id=view["id"], view=update)
+
+
+@app.action("edit-backblast")
+async def edit_backblast(ack, body, client, logger):
+    await ack()
+    dump = json.dumps(body)
+    logger.info(f"got data: {dump}")
+    await client.chat_postEphemeral(
+        channel=body.get("channel").get("id"),
+        text=f"I can't edit messages yet, but this is in the works. I saw data: {dump}",
+        user=body.get("user").get("id"),
+    )
+
+
+@app.event("channel_rename")
+@app.event("channel_archive")
+@app.event("channel_unarchive")
+@app.event("member_joined_channel")
+@app.event("member_left_channel")
+@app.event("channel_left")
+async def invalidate_channel(body, event, logger):
+    main.invalidate_channel(body, event, logger)
+
+
+async def handle_backblast_submit(ack, body, logger):
+    ao_id = main._get_selected_ao_id(body)
+    if ao_id is None or ao_id == "":
+        await ack(response_action="errors", errors={"pax-select": "Please select an AO above for your backblast."})
+        return
+    await ack()
+
+
+async def process_backblast_submit(body, logger):
+    # Dedupes, looks up names concurrently and enqueues, as the cloud function does, on a thread
+    await asyncio.to_thread(main.process_backblast_submit, body, logger)
+
+
+# Lazy listeners of an AsyncApp run as asyncio tasks after the ack is sent
+app.view("backblast_modal")(ack=handle_backblast_submit, lazy=[process_backblast_submit])
+
+
+async def healthz(request):
+    response = {"status": "alive", "path": request.path}
+    if request.query.get("warm"):
+        response["warm"] = await asyncio.to_thread(main.warm_up)
+    return web.json_response(response)
+
+
+async def metrics(request):
+    body, content_type = render_metrics(request.query.get("format"))
+    return web.Response(text=body, headers={"Content-Type": content_type})
+
+
+async def _warm_up_on_startup(web_app):
+    # Fill the caches once, in the background; the process then stays warm
+    asyncio.get_running_loop().run_in_executor(None, main.warm_up)
+
+
+def build_web_app(path="/slack/events", warm_up=True):
+    """The aiohttp application serving slack requests at `path`, plus /healthz and /metrics."""
+    web_app = AsyncSlackAppServer(port=0, path=path, app=app).web_app
+    web_app.router.add_get("/healthz", healthz)
+    web_app.router.add_get("/metrics", metrics)
+    if warm_up:
+        web_app.on_startup.append(_warm_up_on_startup)
+    return web_app
+
+
+async def serve_socket_mode():
+    from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+
+    asyncio.get_running_loop().run_in_executor(None, main.warm_up)
+    await AsyncSocketModeHandler(app, app_token).start_async()
+
+
+if __name__ == "__main__":
+    if main.team_configs:
+        raise SystemExit("server.py serves a single workspace; unset TEAMS_CONFIG and TEAMS_CONFIG_PATH")
+    if app_token:
+        asyncio.run(serve_socket_mode())
+    else:
+        web.run_app(build_web_app(), port=int(os.environ.get("PORT", 3000)))
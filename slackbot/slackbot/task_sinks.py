@@ -0,0 +1,376 @@
+import contextvars
+import importlib.util
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from paxmate_common import tracing
+from paxmate_common.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Runs submissions (and client setup) off the calling thread
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="task-sink")
+
+
+class TaskSink:
+    """Delivers backblast task payloads to the sheets handler.
+
+    `submit` returns a name for the task, and raises if the task could not be accepted.
+    """
+
+    def submit(self, payload, task_id):
+        raise NotImplementedError()
+
+    def submit_async(self, payload, task_id):
+        """Runs `submit` on a background thread and returns a Future for its result.
+
+        On Cloud Functions, wait for the future before returning from the request, since work
+        left running after the response is not guaranteed any CPU. The submit runs in the caller's
+        trace context, so the task carries the caller's span.
+        """
+        return _executor.submit(contextvars.copy_context().run, self.submit, payload, task_id)
+
+    def warm(self):
+        """Starts any slow client setup in the background, so a later submit doesn't wait for it.
+
+        Returns a Future for the setup, or None when there is nothing (left) to set up.
+        """
+        return None
+
+
+class CloudTasksSink(TaskSink):
+    """Creates a Cloud Tasks http task that posts the payload to the sheets handler.
+
+    Each create_task attempt gets `deadline` seconds. Transient errors are retried up to
+    `max_attempts` attempts in total, sleeping a random ("full jitter") share of an exponentially
+    growing backoff in between. The latency and outcome of every attempt is recorded in the
+    cloud_tasks_create_task_seconds histogram. The task's request carries the current span in a
+    traceparent header.
+    """
+
+    def __init__(self, project, location, queue_name, handler_url, deadline=5.0, max_attempts=3, base_backoff=0.2):
+        self.project = project
+        self.location = location
+        self.queue_name = queue_name
+        self.handler_url = handler_url
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Created on first use so cold starts don't pay for the grpc stack
+        with self._client_lock:
+            if self._client is None:
+                from google.cloud import tasks_v2
+                self._client = tasks_v2.CloudTasksClient()
+            return self._client
+
+    def warm(self):
+        if self._client is None:
+            return _executor.submit(lambda: self.client)
+        return None
+
+    def build_task(self, payload, task_id):
+        from google.cloud import tasks_v2
+        return {
+            "http_request": {
+                "http_method": tasks_v2.HttpMethod.POST,
+                "url": self.handler_url,
+                "headers": tracing.inject({"Content-type": "application/json"}),
+                "body": json.dumps(payload).encode(),
+            },
+            "name": self.client.task_path(self.project, self.location, self.queue_name, task_id),
+        }
+
+    def submit(self, payload, task_id):
+        from google.api_core import exceptions
+        retryable = (
+            exceptions.DeadlineExceeded,
+            exceptions.ServiceUnavailable,
+            exceptions.InternalServerError,
+            exceptions.ResourceExhausted,
+            exceptions.Aborted,
+        )
+
+        parent = self.client.queue_path(self.project, self.location, self.queue_name)
+        task = self.build_task(payload, task_id)
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.time()
+            outcome = "error"
+            try:
+                # retry=None: retries are done here, so each one is bounded and recorded
+                response = self.client.create_task(
+                    request={"parent": parent, "task": task}, timeout=self.deadline, retry=None,
+                )
+                outcome = "ok"
+                return response.name
+            except exceptions.AlreadyExists:
+                # An earlier attempt that timed out on our side actually created the task
+                outcome = "already_exists"
+                return task["name"]
+            except retryable as e:
+                outcome = "retryable_error"
+                if attempt == self.max_attempts:
+                    raise
+                backoff = random.uniform(0, self.base_backoff * 2 ** (attempt - 1))
+                logger.warning(f"Error creating task {task_id} (attempt {attempt}), retrying in {backoff:.2f}s: {e}")
+                time.sleep(backoff)
+            finally:
+                registry.histogram("cloud_tasks_create_task_seconds", outcome=outcome).observe(time.time() - start)
+
+
+class ThreadSink(TaskSink):
+    """Hands payloads to `handler` on a background thread in this process (for local or dev use).
+
+    Nothing is persisted, so queued tasks are lost if the process exits. With several `workers`,
+    tasks are handled concurrently, as Cloud Tasks dispatches them. Each is handled in the trace
+    context it was submitted in.
+    """
+
+    def __init__(self, handler, workers=1):
+        self.handler = handler
+        self._queue = queue.Queue()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"thread-sink-{i}", daemon=True) for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            payload, task_id, context = self._queue.get()
+            try:
+                with tracing.use_context(context):
+                    self.handler(payload)
+            except Exception as e:
+                logger.error(f"Error handling task {task_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, payload, task_id):
+        self._queue.put((payload, task_id, tracing.current_context()))
+        return task_id
+
+    def join(self):
+        """Blocks until every submitted task has been handled."""
+        self._queue.join()
+
+
+class SqliteSink(TaskSink):
+    """A durable queue in a local sqlite file, drained by a worker thread that calls `handler`.
+
+    Failed tasks are retried with exponential backoff up to `max_attempts` times; tasks that still
+    fail stay in the file (with their last error) for inspection. Submitting the same task_id twice
+    only queues it once. The submitter's traceparent is stored with the task and restored for its handler.
+    """
+
+    def __init__(self, path, handler, max_attempts=5, base_backoff=1.0, poll_interval=0.5, start_worker=True):
+        self.path = path
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt_at REAL NOT NULL,"
+            " last_error TEXT,"
+            " done_at REAL,"
+            " traceparent TEXT"
+            ")"
+        )
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(tasks)")}
+        if "traceparent" not in columns:
+            # Spool files from before traces were propagated
+            self._connection.execute("ALTER TABLE tasks ADD COLUMN traceparent TEXT")
+        self._worker = None
+        if start_worker:
+            self._worker = threading.Thread(target=self._work, name="sqlite-sink", daemon=True)
+            self._worker.start()
+
+    def submit(self, payload, task_id):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO tasks (id, payload, next_attempt_at, traceparent) VALUES (?, ?, ?, ?)",
+                (task_id, json.dumps(payload), time.time(), tracing.inject().get(tracing.TRACEPARENT_HEADER)),
+            )
+        self._wakeup.set()
+        return task_id
+
+    def _next_due_task(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT id, payload, attempts, traceparent FROM tasks"
+                " WHERE done_at IS NULL AND attempts < ? AND next_attempt_at <= ?"
+                " ORDER BY next_attempt_at LIMIT 1",
+                (self.max_attempts, time.time()),
+            ).fetchone()
+
+    def process_due_tasks(self):
+        """Handles every task that is currently due; returns the number handled successfully."""
+        n_done = 0
+        while True:
+            task = self._next_due_task()
+            if task is None:
+                return n_done
+            task_id, payload, attempts, traceparent = task
+            try:
+                with tracing.use_context(tracing.SpanContext.from_traceparent(traceparent)):
+                    self.handler(json.loads(payload))
+            except Exception as e:
+                backoff = self.base_backoff * 2 ** attempts
+                logger.error(f"Error handling task {task_id} (attempt {attempts + 1}): {e}")
+                with self._lock:
+                    self._connection.execute(
+                        "UPDATE tasks SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                        (time.time() + backoff, str(e), task_id),
+                    )
+            else:
+                n_done += 1
+                with self._lock:
+                    self._connection.execute(
+                        "UPDATE tasks SET attempts = attempts + 1, done_at = ? WHERE id = ?", (time.time(), task_id),
+                    )
+
+    def pending_count(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE done_at IS NULL AND attempts < ?", (self.max_attempts,),
+            ).fetchone()[0]
+
+    def _work(self):
+        while True:
+            try:
+                self.process_due_tasks()
+            except Exception as e:
+                logger.error(f"Error draining task spool {self.path}: {e}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+class SpoolingSink(TaskSink):
+    """Submits to `primary`, and spools the task for retry when `primary` fails.
+
+    The spool's handler should re-submit to `primary`, e.g. SqliteSink(path, handler=primary_handler).
+    """
+
+    def __init__(self, primary, spool):
+        self.primary = primary
+        self.spool = spool
+
+    def warm(self):
+        return self.primary.warm()
+
+    def submit(self, payload, task_id):
+        try:
+            return self.primary.submit(payload, task_id)
+        except Exception as e:
+            logger.warning(f"Error submitting task {task_id}, spooling it for retry: {e}")
+            return self.spool.submit(payload, task_id)
+
+
+def post_to_url(url, timeout=60):
+    """Returns a handler that posts payloads to `url` as json, like a Cloud Tasks http task."""
+    def _post(payload):
+        request = urllib.request.Request(
+            url, data=json.dumps(payload).encode(), headers=tracing.inject({"Content-type": "application/json"}),
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+    return _post
+
+
+def call_request_handler(request_handler):
+    """Returns a handler that calls a Cloud Functions entry point (e.g. f3_sheets_handler) in-process.
+
+    An error response raises, as it fails a Cloud Tasks http task, so sinks that retry do.
+    """
+    def _call(payload):
+        from werkzeug.test import EnvironBuilder
+        request = EnvironBuilder(method="POST", path="/", json=payload, headers=tracing.inject()).get_request()
+        response = request_handler(request)
+        status = getattr(response, "status_code", 200)
+        if status >= 400:
+            raise RuntimeError(f"Task handler returned status {status}")
+        return response
+    return _call
+
+
+def load_request_handler(spec):
+    """Loads an entry point from a "path/to/main.py:function" spec.
+
+    The file's directory is put on the path so its own imports resolve; it is imported under a
+    private name since both functions' entry modules are called main.
+    """
+    path, function_name = spec.rsplit(":", 1)
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    module_spec = importlib.util.spec_from_file_location(f"_task_handler_{function_name}", path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, function_name)
+
+
+def running_on_cloud_functions(environ=os.environ):
+    """Whether this process is a Cloud Functions (or Cloud Run) instance, which sets these variables."""
+    return bool(environ.get("K_SERVICE") or environ.get("FUNCTION_TARGET"))
+
+
+def build_task_sink(config, environ=os.environ):
+    """Builds the sink selected by config.task_sink: "cloud_tasks" (default), "thread" or "sqlite".
+
+    The thread and sqlite sinks post to config.handler_url, or call config.task_sink_handler
+    ("path/to/main.py:f3_sheets_handler") in-process when it is set. With "cloud_tasks", setting
+    config.task_spool_path spools tasks that Cloud Tasks rejects and retries them from the spool.
+
+    A spool needs a long-running process: on Cloud Functions its file is in memory, gone with the
+    instance, and its worker gets no CPU once the response is sent, so a spooled task could be lost
+    unnoticed. There, "sqlite" is refused and task_spool_path is ignored, so a task Cloud Tasks
+    rejects fails its submission instead.
+    """
+    on_cloud_functions = running_on_cloud_functions(environ)
+    if config.task_sink_handler:
+        handler = call_request_handler(load_request_handler(config.task_sink_handler))
+    else:
+        handler = post_to_url(config.handler_url)
+
+    if config.task_sink == "thread":
+        return ThreadSink(handler, workers=config.task_sink_workers)
+    if config.task_sink == "sqlite":
+        if on_cloud_functions:
+            raise ValueError("TASK_SINK=sqlite needs a long-running process, not Cloud Functions")
+        return SqliteSink(config.task_spool_path, handler)
+
+    sink = CloudTasksSink(
+        config.gcp_project,
+        config.gcp_location,
+        config.gcp_queue_name,
+        config.handler_url,
+        deadline=config.enqueue_deadline,
+        max_attempts=config.enqueue_max_attempts,
+    )
+    if config.task_spool_path and on_cloud_functions:
+        logger.warning("Ignoring TASK_SPOOL_PATH on Cloud Functions; tasks that fail to enqueue are not spooled")
+    elif config.task_spool_path:
+        spool = SqliteSink(config.task_spool_path, lambda payload: sink.submit(payload, payload["body"]["id"]))
+        return SpoolingSink(sink, spool)
+    return sink
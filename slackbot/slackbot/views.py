@@ -0,0 +1,263 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class FrozenDict(dict):
+    """A dict that refuses modification; still serializes as a plain json object."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenDict is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def _plain_text(text, emoji=True):
+    return {"type": "plain_text", "text": text, "emoji": emoji}
+
+
+def _build_backblast_modal_template():
+    return {
+        "type": "modal",
+        "callback_id": "backblast_modal",
+        # TODO(multi-tenant) Add customization of this header.
+        # There is a 25 character limit.
+        "title": _plain_text("F3 PaxMate"),
+        "submit": _plain_text("Submit"),
+        "close": _plain_text("Cancel"),
+        "private_metadata": "",
+        # body of the view
+        "blocks": [
+            {
+                "type": "actions",
+                "block_id": "date-ao-q",
+                "elements": [
+                    {
+                        "type": "datepicker",
+                        "initial_date": "1970-01-01",
+                        "placeholder": _plain_text("Select date"),
+                        "action_id": "date-select"
+                    },
+                    {
+                        "type": "channels_select",
+                        "placeholder": _plain_text("Select an AO by channel"),
+                        "action_id": "ao-select",
+                        # do not set an initial_channel since too many people left it as default (1st f)
+                        # "initial_channel": channel,
+                    },
+                    {
+                        "type": "users_select",
+                        "initial_user": None,
+                        "placeholder": _plain_text("Select Q"),
+                        "action_id": "q-select"
+                    }
+                ]
+            },
+            {
+                "type": "input",
+                "block_id": "pax-select",
+                "dispatch_action": True,
+                "element": {
+                    "type": "multi_users_select",
+                    "placeholder": _plain_text("Select pax who posted"),
+                    "action_id": "pax-select"
+                },
+                "label": _plain_text("Pax")
+            },
+            {
+                "type": "input",
+                "block_id": "summary",
+                "element": {
+                    "type": "plain_text_input",
+                    "multiline": True,
+                    "initial_value": """WARMUP:
+
+THE THANG:
+
+MARY:
+
+ANNOUNCEMENTS / COT:
+""",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "Workout summary"
+                    },
+                    "action_id": "summary",
+                },
+                "label": _plain_text("Workout Summary"),
+                "optional": True
+            },
+            {
+                "type": "input",
+                "block_id": "fng-select",
+                "element": {
+                    "type": "multi_users_select",
+                    "placeholder": _plain_text("FNGs"),
+                    "action_id": "fng-select"
+                },
+                "label": _plain_text("FNGs"),
+                "optional": True
+            },
+            {
+                "type": "input",
+                "block_id": "pax-no-slack",
+                "element": {
+                    "type": "plain_text_input",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "Pax Not Yet on Slack"
+                    },
+                    "action_id": "pax-no-slack",
+                },
+                "label": _plain_text("Additional Pax?"),
+                "optional": True
+            },
+            {
+                "type": "input",
+                "block_id": "visiting-pax",
+                "element": {
+                    "type": "static_select",
+                    "placeholder": {
+                        "type": "plain_text",
+                        "text": "How many PAX from another region?"
+                    },
+                    "options": [
+                        {"text": _plain_text(value), "value": value}
+                        for value in [str(n) for n in range(10)] + ["10+"]
+                    ],
+                    "action_id": "visiting-pax"
+                },
+                "label": _plain_text("Visiting PAX"),
+                "optional": True
+            }
+        ]
+    }
+
+
+# Built once at import; build_backblast_modal only replaces the parts that change per call.
+BACKBLAST_MODAL_TEMPLATE = freeze(_build_backblast_modal_template())
+
+
+def build_backblast_modal(initial_date, initial_user, initial_channel, team):
+    """Returns the /backblast modal for one call.
+
+    Only the path down to the datepicker and Q select is copied; every other block is shared
+    with (read-only) BACKBLAST_MODAL_TEMPLATE.
+    """
+    template = BACKBLAST_MODAL_TEMPLATE
+    date_ao_q = template["blocks"][0]
+    datepicker, ao_select, q_select = date_ao_q["elements"]
+    return {
+        **template,
+        "private_metadata": json.dumps({"initial_channel": initial_channel, "team": team}),
+        "blocks": (
+            {
+                **date_ao_q,
+                "elements": (
+                    {**datepicker, "initial_date": initial_date},
+                    ao_select,
+                    {**q_select, "initial_user": initial_user},
+                ),
+            },
+        ) + template["blocks"][1:],
+    }
+
+
+# Fields slack returns on a view that views.update does not accept
+VIEW_RESPONSE_ONLY_FIELDS = frozenset({
+    "id", "team_id", "state", "hash", "previous_view_id", "root_view_id", "app_id", "app_installed_team_id", "bot_id",
+})
+
+
+def build_pax_count_update(view, n_selected):
+    """Returns a views.update payload for `view` with the pax count shown in the pax-select block.
+
+    Only the pax-select block (and its label, element and placeholder) is copied; the other blocks
+    are passed through as-is and the submitted state is dropped rather than copied.
+    """
+    update = {k: v for k, v in view.items() if k not in VIEW_RESPONSE_ONLY_FIELDS}
+    blocks = list(update.get("blocks", []))
+    for i, block in enumerate(blocks):
+        if block.get("type") == "input" and block.get("element", {}).get("action_id") == "pax-select":
+            element = block["element"]
+            blocks[i] = {
+                **block,
+                "label": {**block["label"], "text": f"Pax ({n_selected} selected)"},
+                "element": {**element, "placeholder": {**element["placeholder"], "text": f"{n_selected} selected"}},
+            }
+    update["blocks"] = blocks
+    return update
+
+
+class ViewUpdateCoalescer:
+    """Lets only the newest of a burst of actions on a view go on to call views.update.
+
+    Each pick in a multi-select dispatches its own action. A pick with no other action on the same
+    view in the last `window` seconds proceeds straight away. One that arrives during a burst waits
+    `window` seconds and proceeds only if no newer action (by action_ts) arrived in the meantime, so
+    the burst ends in a single trailing update rather than a cascade of hash conflicts. Bursts are
+    only seen within one instance; actions spread across instances each update on their own.
+
+    The burst's first update changes the view's hash, so the trailing one, made with the hash its action
+    saw, can still get a hash_conflict; `is_latest` tells whether it should be retried without the hash.
+    """
+
+    def __init__(self, window, max_views=1000, clock=time.monotonic, sleep=time.sleep):
+        self.window = window
+        self.max_views = max_views
+        self.clock = clock
+        self.sleep = sleep
+        # view id: (newest action_ts, when an action on the view was last seen)
+        self._latest = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_latest(self, view_id, action_ts):
+        """Whether no newer action on the view has been seen."""
+        with self._lock:
+            entry = self._latest.get(view_id)
+            return entry is None or entry[0] == action_ts
+
+    def _record(self, view_id, action_ts):
+        """Records the action; returns whether it is the view's newest, and whether it is part of a burst."""
+        with self._lock:
+            now = self.clock()
+            entry = self._latest.get(view_id)
+            in_burst = entry is not None and now - entry[1] < self.window
+            if entry is not None and entry[0] > action_ts:
+                self._latest[view_id] = (entry[0], now)
+                return False, in_burst
+            self._latest[view_id] = (action_ts, now)
+            self._latest.move_to_end(view_id)
+            while len(self._latest) > self.max_views:
+                self._latest.popitem(last=False)
+        return True, in_burst
+
+    def wait_for_latest(self, view_id, action_ts):
+        newest, in_burst = self._record(view_id, action_ts)
+        if not newest:
+            return False
+        if not in_burst:
+            return True
+        self.sleep(self.window)
+        return self.is_latest(view_id, action_ts)
+
+    async def wait_for_latest_async(self, view_id, action_ts):
+        """Like wait_for_latest, but waits without blocking the event loop."""
+        newest, in_burst = self._record(view_id, action_ts)
+        if not newest:
+            return False
+        if not in_burst:
+            return True
+        await asyncio.sleep(self.window)
+        return self.is_latest(view_id, action_ts)
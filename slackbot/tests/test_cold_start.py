@@ -0,0 +1,27 @@
+import json
+
+from benchmarks.bench_cold_start import (
+    FIRST_REQUEST_BUDGET_SECONDS,
+    IMPORT_BUDGET_SECONDS,
+    fastest_cold_start,
+    measure_cold_start,
+)
+
+
+def test_cold_start_is_within_budget():
+    result = fastest_cold_start()
+    assert result["status"] == 200
+    # the cloud tasks client and grpc are only loaded when a backblast is enqueued
+    assert result["loaded_deferred_modules"] == []
+    assert result["import_seconds"] < IMPORT_BUDGET_SECONDS
+    assert result["first_request_seconds"] < FIRST_REQUEST_BUDGET_SECONDS
+
+
+def test_cold_start_with_several_teams():
+    teams = {
+        "T1": {"bot_token": "xoxb-one", "signing_secret": "one"},
+        "T2": {"bot_token_env": "SLACK_BOT_TOKEN_T2", "signing_secret": "two"},
+    }
+    result = measure_cold_start({"TEAMS_CONFIG": json.dumps(teams), "SLACK_BOT_TOKEN_T2": "xoxb-two"})
+    assert result["status"] == 200
+    assert result["loaded_deferred_modules"] == []
@@ -0,0 +1,84 @@
+import io
+import json
+import time
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+from slack_sdk.signature import SignatureVerifier
+
+import slackbot.main
+from paxmate_common.metrics import MetricsRegistry, log_pending_metrics, registry
+
+
+def test_timer_labels_outcome():
+    metrics = MetricsRegistry()
+    with metrics.timer("stage_seconds", stage="parse"):
+        pass
+    with pytest.raises(RuntimeError):
+        with metrics.timer("stage_seconds", stage="parse"):
+            raise RuntimeError("boom")
+    assert metrics.histogram("stage_seconds", stage="parse", outcome="ok").count == 1
+    assert metrics.histogram("stage_seconds", stage="parse", outcome="error").count == 1
+
+
+def test_prometheus_exposition():
+    metrics = MetricsRegistry()
+    metrics.counter("slack_api_rate_limited", method="users.info").inc(2)
+    histogram = metrics.histogram("sheets_append_try_count", buckets=(1, 2, 3, float("inf")), outcome="ok")
+    histogram.observe(1)
+    histogram.observe(3)
+    text = metrics.to_prometheus()
+    assert '# TYPE slack_api_rate_limited counter\nslack_api_rate_limited{method="users.info"} 2\n' in text
+    assert 'sheets_append_try_count_bucket{le="1",outcome="ok"} 1\n' in text
+    assert 'sheets_append_try_count_bucket{le="3",outcome="ok"} 2\n' in text
+    assert 'sheets_append_try_count_bucket{le="+Inf",outcome="ok"} 2\n' in text
+    assert 'sheets_append_try_count_count{outcome="ok"} 2\n' in text
+
+
+def test_pending_updates_are_logged_once_as_json_lines():
+    metrics = MetricsRegistry()
+    metrics.histogram("backblast_parse_seconds").observe(0.25)
+    metrics.counter("slack_api_rate_limited", method="users.info").inc()
+    stream = io.StringIO()
+    with patch.dict("os.environ", {"K_SERVICE": "slackbot-peakcity"}):
+        log_pending_metrics(stream, registry=metrics)
+        log_pending_metrics(stream, registry=metrics)
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert lines == [
+        {"severity": "INFO", "message": "metric backblast_parse_seconds", "function": "slackbot-peakcity",
+         "metric": "backblast_parse_seconds", "type": "histogram", "labels": {}, "value": 0.25},
+        {"severity": "INFO", "message": "metric slack_api_rate_limited", "function": "slackbot-peakcity",
+         "metric": "slack_api_rate_limited", "type": "counter", "labels": {"method": "users.info"}, "value": 1},
+    ]
+
+
+def test_slackbot_times_requests_and_serves_metrics():
+    body = "team_id=Tisateamid&command=%2Fbackblast&user_id=Uisauserid&channel_id=Cisachannelid"
+    timestamp = str(int(time.time()))
+    headers = {
+        "x-slack-request-timestamp": timestamp,
+        "x-slack-signature": SignatureVerifier("secret").generate_signature(timestamp=timestamp, body=body),
+    }
+    requests = registry.histogram("slackbot_request_seconds", kind="/backblast", lazy="0", outcome="ok").count
+    with patch("slackbot.main.handler") as mock_handler, \
+            patch.object(slackbot.main.slackbot_config, "signing_secret", "secret"):
+        mock_handler.handle.return_value = "acked"
+        with Flask(__name__).test_request_context("/slackbot", method="POST", data=body, headers=headers,
+                                                  content_type="application/x-www-form-urlencoded"):
+            from flask import request
+            assert slackbot.main.slackbot(request) == "acked"
+    assert registry.histogram("slackbot_request_seconds", kind="/backblast", lazy="0", outcome="ok").count == requests + 1
+
+    with Flask(__name__).test_request_context("/slackbot/metrics", method="GET"):
+        from flask import request
+        response = slackbot.main.slackbot(request)
+    assert response.headers["Content-Type"] == "application/json"
+    names = {metric["name"] for metric in json.loads(response.get_data())}
+    assert "slackbot_request_seconds" in names
+
+    with Flask(__name__).test_request_context("/slackbot/metrics?format=prometheus", method="GET"):
+        from flask import request
+        response = slackbot.main.slackbot(request)
+    assert response.headers["Content-Type"].startswith("text/plain")
+    assert "# TYPE slackbot_request_seconds histogram" in response.get_data(as_text=True)
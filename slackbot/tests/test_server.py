@@ -0,0 +1,175 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from aiohttp.test_utils import TestClient, TestServer
+from slack_sdk.errors import SlackApiError
+
+import server
+from paxmate_common.directory import ChannelDirectory, TTLCache, UserDirectory
+from task_sinks import ThreadSink
+from views import ViewUpdateCoalescer
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "slackbot")
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "common")
+
+
+@pytest.fixture(autouse=True)
+def fresh_main_state():
+    # server uses main's caches; don't let them leak between tests
+    with patch.object(server.main, "user_directory", UserDirectory(lambda: server.main.app.client)), \
+            patch.object(server.main, "channel_directory", ChannelDirectory(lambda: server.main.app.client)), \
+            patch.object(server.main, "recent_submissions", TTLCache(max_size=1000, ttl=3600)):
+        yield
+
+
+def _submission(pax_ids, ao_id="Cisachannelid"):
+    return {
+        "type": "view_submission",
+        "team": {"id": "Tisateamid"},
+        "user": {"id": "Uisauserid"},
+        "view": {
+            "id": "Visaviewid",
+            "team_id": "Tisateamid",
+            "hash": "1685991526.FGKdT3jB",
+            "callback_id": "backblast_modal",
+            "state": {"values": {
+                "date-ao-q": {
+                    "date-select": {"selected_date": "2023-06-05"},
+                    "ao-select": {"selected_channel": ao_id},
+                    "q-select": {"selected_user": "Uisauserid"},
+                },
+                "pax-select": {"pax-select": {"selected_users": pax_ids}},
+            }},
+        },
+    }
+
+
+def test_backblast_submission_without_ao_is_rejected():
+    ack = AsyncMock()
+    asyncio.run(server.handle_backblast_submit(ack, _submission([], ao_id=None), MagicMock()))
+    ack.assert_awaited_once_with(response_action="errors", errors={"pax-select": "Please select an AO above for your backblast."})
+
+
+def test_backblast_is_handled_in_process():
+    handled = []
+    sink = ThreadSink(handled.append)
+    with patch.object(server.main, "app") as mock_app, patch.object(server.main, "task_sink", sink):
+        names = {f"Upax{i}": f"pax{i}" for i in range(3)}
+        mock_app.client.users_info.side_effect = lambda user: {"user": {"name": names.get(user, "torpedo")}}
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        asyncio.run(server.process_backblast_submit(_submission(["Upax0", "Upax1", "Upax2"]), MagicMock()))
+        sink.join()
+
+    assert len(handled) == 1
+    backblast_data = handled[0]["body"]
+    assert backblast_data["pax"] == ["pax0", "pax1", "pax2"]
+    assert backblast_data["q"] == "torpedo"
+    assert backblast_data["ao"] == "ao-the-grid"
+
+
+def test_backblast_lookups_do_not_block_the_event_loop():
+    def _slow_users_info(**kwargs):
+        time.sleep(0.1)
+        return {"user": {"name": kwargs.get("user")}}
+
+    async def _run():
+        ticks = 0
+
+        async def _tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(_tick())
+        await server.process_backblast_submit(_submission(["Upax0", "Upax1"]), MagicMock())
+        ticker.cancel()
+        return ticks
+
+    with patch.object(server.main, "app") as mock_app, patch.object(server.main, "task_sink") as mock_task_sink:
+        mock_app.client.users_list.return_value = {"members": [], "response_metadata": {"next_cursor": ""}}
+        mock_app.client.users_info.side_effect = _slow_users_info
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        ticks = asyncio.run(_run())
+
+    assert mock_task_sink.submit_async.call_count == 1
+    # The lookups took at least 100ms, and other coroutines kept running meanwhile
+    assert ticks >= 5
+
+
+def test_pax_select_burst_makes_one_trailing_views_update():
+    view = {
+        "id": "Visaviewid",
+        "hash": "1685991526.FGKdT3jB",
+        "blocks": [{"type": "input", "block_id": "pax-select", "label": {"type": "plain_text", "text": "Pax"},
+                    "element": {"type": "multi_users_select", "action_id": "pax-select",
+                                "placeholder": {"type": "plain_text", "text": "Select the PAX"}}}],
+    }
+
+    async def _burst(client):
+        # Every pick is recorded before any wait ends, so only the first (no wait) and last go through
+        actions = []
+        for n in range(1, 6):
+            body = {"view": view, "actions": [
+                {"action_id": "pax-select", "selected_users": [f"Upax{i}" for i in range(n)], "action_ts": f"1685991526.{n:06d}"},
+            ]}
+            actions.append(asyncio.create_task(server.handle_pax_select_interactive(AsyncMock(), body, client, MagicMock())))
+        await asyncio.gather(*actions)
+
+    # As slack does, each update changes the view's hash, and one made with an older hash fails
+    view_hash = [view["hash"]]
+    updates = []
+
+    async def _views_update(view_id, view, hash=None):
+        if hash is not None and hash != view_hash[0]:
+            raise SlackApiError("hash_conflict", {"ok": False, "error": "hash_conflict"})
+        updates.append(view)
+        view_hash[0] += "+"
+
+    client = AsyncMock()
+    client.views_update.side_effect = _views_update
+    with patch.object(server.main, "pax_select_coalescer", ViewUpdateCoalescer(window=0.01, clock=lambda: 0.0)):
+        asyncio.run(_burst(client))
+
+    # The trailing update's hash is from before the first update, so it's made again without one
+    assert [call[1].get("hash") for call in client.views_update.call_args_list] == [
+        "1685991526.FGKdT3jB", "1685991526.FGKdT3jB", None,
+    ]
+    assert [update["blocks"][0]["label"]["text"] for update in updates] == ["Pax (1 selected)", "Pax (5 selected)"]
+
+
+def test_healthz():
+    async def _get(path):
+        async with TestClient(TestServer(server.build_web_app(warm_up=False))) as client:
+            response = await client.get(path)
+            return response.status, await response.json()
+
+    status, body = asyncio.run(_get("/healthz"))
+    assert status == 200
+    assert body == {"status": "alive", "path": "/healthz"}
+
+    with patch.object(server.main, "warm_up", return_value={"task_sink": {"status": "ok"}}) as mock_warm_up:
+        status, body = asyncio.run(_get("/healthz?warm=1"))
+    assert body["warm"] == {"task_sink": {"status": "ok"}}
+    assert mock_warm_up.call_count == 1
+
+
+def test_socket_mode_starts_without_a_signing_secret():
+    # A fresh interpreter with only Socket Mode's tokens, as `SLACK_APP_TOKEN=xapp-... python server.py` would have
+    env = {k: v for k, v in os.environ.items() if not k.startswith(("SLACK_", "TEAMS_CONFIG"))}
+    env.update({"SLACK_APP_TOKEN": "xapp-test", "SLACK_BOT_TOKEN": "xoxb-test"})
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [COMMON_DIR, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-c", "import server; print(server.app_token)"],
+        cwd=SOURCE_DIR, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "xapp-test"
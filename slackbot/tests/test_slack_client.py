@@ -0,0 +1,148 @@
+import inspect
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import pytest
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+from paxmate_common.metrics import registry
+from paxmate_common.slack_client import PooledWebClient, RateLimitedWebClient, TokenBucket
+from standin_slack import StandInSlack
+
+
+@pytest.fixture
+def stub_slack():
+    """The load test's keep-alive slack stand-in, answering at once."""
+    stand_in = StandInSlack(latency=0.0).start()
+    yield stand_in
+    stand_in.stop()
+
+
+def test_token_bucket_allows_burst_then_paces():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, capacity=3, clock=lambda: now[0], sleep=lambda s: None)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+    now[0] = 10.0
+    assert bucket.reserve() == 0
+    bucket.pause(4)
+    assert bucket.reserve() == pytest.approx(4)
+
+
+def test_rate_limited_call_waits_for_retry_after_and_succeeds(stub_slack):
+    stub_slack.n_rate_limited = 1
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stub_slack.url)
+    throttles = registry.counter("slack_api_rate_limited", method="users.info").value
+
+    start = time.time()
+    response = client.users_info(user="U1")
+    elapsed = time.time() - start
+
+    assert response["user"]["name"] == "u1"
+    assert stub_slack.calls.total() == 2
+    assert elapsed >= 1
+    assert registry.counter("slack_api_rate_limited", method="users.info").value == throttles + 1
+
+
+def test_rate_limited_call_gives_up_on_long_retry_after(stub_slack):
+    stub_slack.n_rate_limited = 1
+    stub_slack.retry_after = 120
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stub_slack.url, max_retry_after=30)
+    with pytest.raises(SlackApiError):
+        client.users_info(user="U1")
+    assert stub_slack.calls.total() == 1
+
+
+def test_identical_concurrent_calls_are_coalesced(stub_slack):
+    stub_slack.latency = 0.2
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stub_slack.url)
+    coalesced = registry.counter("slack_api_coalesced_calls", method="users.info").value
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        responses = list(executor.map(lambda _: client.users_info(user="U1"), range(5)))
+        client.users_info(user="U2")
+
+    assert [r["user"]["name"] for r in responses] == ["u1"] * 5
+    assert stub_slack.calls.total() == 2
+    assert registry.counter("slack_api_coalesced_calls", method="users.info").value == coalesced + 4
+
+
+def test_calls_are_not_paced_until_slack_rate_limits_them(stub_slack):
+    sleeps = []
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stub_slack.url, tier_limits={2: 1}, sleep=sleeps.append)
+    for cursor in range(20):
+        client.users_list(cursor=str(cursor))
+    assert stub_slack.calls.total() == 20
+    assert sleeps == []
+
+
+def test_calls_after_a_429_are_paced_to_the_tier_until_it_is_quiet(stub_slack):
+    # users.list is tier 2, here one call a second
+    now = [0.0]
+    sleeps = []
+    client = RateLimitedWebClient(
+        token="xoxb-test", base_url=stub_slack.url, tier_limits={2: 60}, paced_seconds=60,
+        clock=lambda: now[0], sleep=sleeps.append,
+    )
+    stub_slack.n_rate_limited = 1
+    stub_slack.retry_after = 2
+    client.users_list(cursor="0")
+    # The retry waited out the Retry-After; by then one call's worth of the tier's rate had accrued
+    assert sleeps == [pytest.approx(2)]
+    now[0] = 2.0
+    client.users_list(cursor="1")
+    client.users_list(cursor="2")
+    assert sleeps[1:] == [pytest.approx(1)]
+    # A minute without a 429 and calls go out unpaced again
+    now[0] = 70.0
+    for cursor in range(3, 10):
+        client.users_list(cursor=str(cursor))
+    assert len(sleeps) == 2
+    assert stub_slack.calls.total() == 11
+
+
+@pytest.mark.parametrize("pool_size, n_connections", [(0, 5), (2, 1)])
+def test_pooled_client_reuses_connections(stub_slack, pool_size, n_connections):
+    client = PooledWebClient(token="xoxb-test", base_url=stub_slack.url, pool_size=pool_size)
+    for i in range(5):
+        assert client.users_info(user=f"U{i}")["user"]["name"] == f"u{i}"
+    assert stub_slack.calls.total() == 5
+    assert len(stub_slack.client_ports) == n_connections
+
+
+def test_slack_sdk_still_has_the_transport_hook_the_pool_overrides():
+    # PooledWebClient overrides this private method; if a slack_sdk upgrade renames or reshapes it,
+    # calls would quietly go back to a connection each
+    hook = getattr(WebClient, "_perform_urllib_http_request_internal", None)
+    assert hook is not None
+    assert list(inspect.signature(hook).parameters) == ["self", "url", "req"]
+
+
+def test_pooled_client_calls_go_through_the_pool(stub_slack):
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stub_slack.url)
+    with patch.object(client.http_pool, "request", wraps=client.http_pool.request) as request:
+        assert client.users_info(user="U1")["user"]["name"] == "u1"
+    assert request.call_count == 1
+
+
+def test_pooled_client_drops_idle_connections(stub_slack):
+    client = PooledWebClient(token="xoxb-test", base_url=stub_slack.url, idle_timeout=0.1)
+    client.users_info(user="U1")
+    time.sleep(0.2)
+    client.users_info(user="U2")
+    assert len(stub_slack.client_ports) == 2
+
+
+def test_pooled_client_reconnects_when_server_closed_connection(stub_slack):
+    client = PooledWebClient(token="xoxb-test", base_url=stub_slack.url)
+    client.users_info(user="U1")
+    for connections in client.http_pool._idle.values():
+        for connection, _ in connections:
+            # As if the server timed the connection out
+            connection.sock.shutdown(socket.SHUT_RDWR)
+    assert client.users_info(user="U2")["user"]["name"] == "u2"
+    assert stub_slack.calls.total() == 2
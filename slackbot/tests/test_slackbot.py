@@ -1,314 +1,104 @@
+import copy
+import json
+import http.server
+import os
+import threading
+import time
+
 import pytest
 from unittest.mock import MagicMock, patch
 
-from slackbot.main import handle_backblast_submit, _parse_backblast_body
+from slack_bolt import BoltRequest
+from flask import Flask
+from slack_sdk.errors import SlackApiError
+from slack_sdk.signature import SignatureVerifier
+
+import slackbot.main
+from paxmate_common.directory import ChannelDirectory, TTLCache, UserDirectory
+from paxmate_common.slack_client import RateLimitedWebClient
+from paxmate_common.teams import TeamConfig, TeamRegistry
+from paxmate_common.tracing import FileExporter, SpanContext, tracer
+from standin_slack import StandInSlack
+from task_sinks import ThreadSink, call_request_handler
+from views import ViewUpdateCoalescer
+from slackbot.main import (
+    HttpLazyListenerRunner,
+    handle_backblast_submit,
+    handle_pax_select_interactive,
+    invalidate_channel,
+    open_backblast_form,
+    post_as_paxmate,
+    process_backblast_submit,
+    _get_backblast_id,
+    _parse_backblast_body,
+)
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), "payloads")
+
+
+@pytest.fixture(autouse=True)
+def fresh_user_directory():
+    # The directory is module state; don't let cached names leak between tests
+    directory = UserDirectory(lambda: slackbot.main.app.client)
+    with patch("slackbot.main.user_directory", directory):
+        yield directory
+
+
+@pytest.fixture(autouse=True)
+def fresh_channel_directory():
+    directory = ChannelDirectory(lambda: slackbot.main.app.client)
+    with patch("slackbot.main.channel_directory", directory):
+        yield directory
+
+
+@pytest.fixture(autouse=True)
+def fresh_recent_submissions():
+    with patch("slackbot.main.recent_submissions", TTLCache(max_size=1000, ttl=3600)) as recent_submissions:
+        yield recent_submissions
+
 
 @pytest.fixture
 def view_submission_no_ao():
-    body = {
-        "type": "view_submission",
-        "team": {"id": "Tisateamid", "domain": "f3paxmatedev"},
-        "user": {
-            "id": "Uisauserid",
-            "username": "jcampbelldev",
-            "name": "jcampbelldev",
-            "team_id": "Tisateamid",
-        },
-        "api_app_id": "Aappid9",
-        "token": "imatoken",
-        "trigger_id": "5378395399268.4742077510288.isnotevenarealtriggerid",
-        "view": {
-            "id": "Visaviewid",
-            "team_id": "Tisateamid",
-            "type": "modal",
-            "blocks": [
-                {
-                    "type": "actions",
-                    "block_id": "date-ao-q",
-                    "elements": [
-                        {
-                            "type": "datepicker",
-                            "action_id": "date-select",
-                            "initial_date": "2023-06-05",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Select date",
-                                "emoji": True,
-                            },
-                        },
-                        {
-                            "type": "channels_select",
-                            "action_id": "ao-select",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Select an AO by channel",
-                                "emoji": True,
-                            },
-                        },
-                        {
-                            "type": "users_select",
-                            "action_id": "q-select",
-                            "initial_user": "Uisauserid",
-                            "placeholder": {
-                                "type": "plain_text",
-                                "text": "Select Q",
-                                "emoji": True,
-                            },
-                        },
-                    ],
-                },
-                {
-                    "type": "input",
-                    "block_id": "pax-select",
-                    "label": {
-                        "type": "plain_text",
-                        "text": "Pax (1 selected)",
-                        "emoji": True,
-                    },
-                    "optional": False,
-                    "dispatch_action": True,
-                    "element": {
-                        "type": "multi_users_select",
-                        "action_id": "pax-select",
-                        "placeholder": {
-                            "type": "plain_text",
-                            "text": "1 selected",
-                            "emoji": True,
-                        },
-                    },
-                },
-                {
-                    "type": "input",
-                    "block_id": "summary",
-                    "label": {"type": "plain_text", "text": "Summary", "emoji": True},
-                    "optional": True,
-                    "dispatch_action": False,
-                    "element": {
-                        "type": "plain_text_input",
-                        "action_id": "summary",
-                        "placeholder": {
-                            "type": "plain_text",
-                            "text": "Workout summary",
-                            "emoji": True,
-                        },
-                        "multiline": True,
-                        "dispatch_action_config": {
-                            "trigger_actions_on": ["on_enter_pressed"]
-                        },
-                    },
-                },
-                {
-                    "type": "input",
-                    "block_id": "fng-select",
-                    "label": {"type": "plain_text", "text": "FNGs", "emoji": True},
-                    "optional": True,
-                    "dispatch_action": False,
-                    "element": {
-                        "type": "multi_users_select",
-                        "action_id": "fng-select",
-                        "placeholder": {
-                            "type": "plain_text",
-                            "text": "FNGs",
-                            "emoji": True,
-                        },
-                    },
-                },
-                {
-                    "type": "input",
-                    "block_id": "pax-no-slack",
-                    "label": {
-                        "type": "plain_text",
-                        "text": "Additional Pax?",
-                        "emoji": True,
-                    },
-                    "optional": True,
-                    "dispatch_action": False,
-                    "element": {
-                        "type": "plain_text_input",
-                        "action_id": "pax-no-slack",
-                        "placeholder": {
-                            "type": "plain_text",
-                            "text": "Pax Not Yet on Slack",
-                            "emoji": True,
-                        },
-                        "dispatch_action_config": {
-                            "trigger_actions_on": ["on_enter_pressed"]
-                        },
-                    },
-                },
-                {
-                    "type": "input",
-                    "block_id": "visiting-pax",
-                    "label": {
-                        "type": "plain_text",
-                        "text": "Visiting PAX",
-                        "emoji": True,
-                    },
-                    "optional": True,
-                    "dispatch_action": False,
-                    "element": {
-                        "type": "static_select",
-                        "action_id": "visiting-pax",
-                        "placeholder": {
-                            "type": "plain_text",
-                            "text": "How many PAX from another region?",
-                            "emoji": True,
-                        },
-                        "options": [
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "0",
-                                    "emoji": True,
-                                },
-                                "value": "0",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "1",
-                                    "emoji": True,
-                                },
-                                "value": "1",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "2",
-                                    "emoji": True,
-                                },
-                                "value": "2",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "3",
-                                    "emoji": True,
-                                },
-                                "value": "3",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "4",
-                                    "emoji": True,
-                                },
-                                "value": "4",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "5",
-                                    "emoji": True,
-                                },
-                                "value": "5",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "6",
-                                    "emoji": True,
-                                },
-                                "value": "6",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "7",
-                                    "emoji": True,
-                                },
-                                "value": "7",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "8",
-                                    "emoji": True,
-                                },
-                                "value": "8",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "9",
-                                    "emoji": True,
-                                },
-                                "value": "9",
-                            },
-                            {
-                                "text": {
-                                    "type": "plain_text",
-                                    "text": "10+",
-                                    "emoji": True,
-                                },
-                                "value": "10+",
-                            },
-                        ],
-                    },
-                },
-            ],
-            "private_metadata": '{"initial_channel": "Cisachannelid", "team": "Tisateamid"}',
-            "callback_id": "backblast_modal",
-            "state": {
-                "values": {
-                    "date-ao-q": {
-                        "date-select": {
-                            "type": "datepicker",
-                            "selected_date": "2023-06-05",
-                        },
-                        "ao-select": {
-                            "type": "channels_select",
-                            "selected_channel": None,
-                        },
-                        "q-select": {
-                            "type": "users_select",
-                            "selected_user": "Uisauserid",
-                        },
-                    },
-                    "pax-select": {
-                        "pax-select": {
-                            "type": "multi_users_select",
-                            "selected_users": ["Uisauserid"],
-                        }
-                    },
-                    "summary": {
-                        "summary": {"type": "plain_text_input", "value": "asdfsad"}
-                    },
-                    "fng-select": {
-                        "fng-select": {
-                            "type": "multi_users_select",
-                            "selected_users": [],
-                        }
-                    },
-                    "pax-no-slack": {
-                        "pax-no-slack": {"type": "plain_text_input", "value": None}
-                    },
-                    "visiting-pax": {
-                        "visiting-pax": {
-                            "type": "static_select",
-                            "selected_option": None,
-                        }
-                    },
-                }
-            },
-            "hash": "1685991526.FGKdT3jB",
-            "title": {"type": "plain_text", "text": "F3 PaxMate", "emoji": True},
-            "clear_on_close": False,
-            "notify_on_close": False,
-            "close": {"type": "plain_text", "text": "Cancel", "emoji": True},
-            "submit": {"type": "plain_text", "text": "Submit", "emoji": True},
-            "previous_view_id": None,
-            "root_view_id": "Visaviewid",
-            "app_id": "Aappid9",
-            "external_id": "",
-            "app_installed_team_id": "Tisateamid",
-            "bot_id": "Bisabotid",
-        },
-        "response_urls": [],
-        "is_enterprise_install": False,
-        "enterprise": None,
-    }
-    return body
+    # Also replayed by the load test (loadtest/run.py)
+    with open(os.path.join(PAYLOADS, "view_submission_no_ao.json")) as f:
+        return json.load(f)
+
+@pytest.fixture
+def view_submission_factory(view_submission_no_ao):
+    def _build(n_pax):
+        body = copy.deepcopy(view_submission_no_ao)
+        values = body["view"]["state"]["values"]
+        values["date-ao-q"]["ao-select"]["selected_channel"] = "Cisachannelid"
+        values["pax-select"]["pax-select"]["selected_users"] = [f"Upax{i}" for i in range(n_pax)]
+        return body
+    return _build
+
+
+def _slow_users_info(**kwargs):
+    time.sleep(0.02)
+    return {"user": {"name": kwargs.get("user")}}
+
+
+@pytest.fixture
+def latency_injecting_client():
+    """A slack client whose every lookup takes 100ms; users.list has no members so names come from users.info."""
+    def _users_info(**kwargs):
+        time.sleep(0.1)
+        user = kwargs.get("user")
+        if user == "Ubroken":
+            raise RuntimeError("user_not_found")
+        return {"user": {"name": user}}
+
+    def _conversations_info(**kwargs):
+        time.sleep(0.1)
+        return {"channel": {"name": "ao-the-grid"}}
+
+    client = MagicMock()
+    client.users_list.return_value = {"members": [], "response_metadata": {"next_cursor": ""}}
+    client.users_info.side_effect = _users_info
+    client.conversations_info.side_effect = _conversations_info
+    return client
+
 
 @patch("slackbot.main.app")
 @patch("slackbot.main.json")
@@ -328,8 +118,517 @@ def test_handle_backblast_submission(view_submission_no_ao):
     ack = MagicMock()
     body = view_submission_no_ao
     logger = MagicMock()
-    with patch("slackbot.main.client") as mock_task_queue_client:
+    with patch("slackbot.main.task_sink") as mock_task_sink:
         handle_backblast_submit(ack, body, logger)
     assert ack.call_count == 1
     ack.assert_called_once_with(response_action="errors", errors={"pax-select": "Please select an AO above for your backblast."})
 
+
+def test_parse_backblast_body_lookups_run_concurrently(latency_injecting_client, view_submission_factory):
+    # 5 pax + q + submitter + ao = 8 lookups of 100ms each, 800ms if run one after another
+    body = view_submission_factory(5)
+    mock_logger = MagicMock()
+    with patch("slackbot.main.app") as mock_app:
+        mock_app.client = latency_injecting_client
+        start = time.time()
+        backblast_data = _parse_backblast_body(body, mock_logger)
+        elapsed = time.time() - start
+    assert elapsed < 0.3
+    assert latency_injecting_client.users_info.call_count == 7
+    assert backblast_data["ao"] == "ao-the-grid"
+    assert backblast_data["pax"] == [f"Upax{i}" for i in range(5)]
+    assert backblast_data["q"] == "Uisauserid"
+    assert mock_logger.error.call_count == 0
+
+
+def test_parse_backblast_body_failed_lookup_blanks_only_its_field(latency_injecting_client, view_submission_factory):
+    body = view_submission_factory(2)
+    body["view"]["state"]["values"]["pax-select"]["pax-select"]["selected_users"].append("Ubroken")
+    mock_logger = MagicMock()
+    with patch("slackbot.main.app") as mock_app:
+        mock_app.client = latency_injecting_client
+        backblast_data = _parse_backblast_body(body, mock_logger)
+    assert backblast_data["pax_ids"] == ["Upax0", "Upax1", "Ubroken"]
+    assert backblast_data["pax"] == []
+    assert backblast_data["q"] == "Uisauserid"
+    assert backblast_data["submitter"] == "Uisauserid"
+    assert backblast_data["ao"] == "ao-the-grid"
+    assert mock_logger.error.call_count == 1
+
+
+def test_cold_parse_of_a_large_backblast_is_not_paced(view_submission_factory):
+    # 32 pax + q + submitter, none of them cached: more users.info calls than a tier's steady rate allows
+    stand_in = StandInSlack(latency=0.01).start()
+    sleeps = []
+    client = RateLimitedWebClient(token="xoxb-test", base_url=stand_in.url, sleep=sleeps.append)
+    try:
+        with patch("slackbot.main.app") as mock_app:
+            mock_app.client = client
+            backblast_data = _parse_backblast_body(view_submission_factory(32), MagicMock())
+    finally:
+        stand_in.stop()
+    assert backblast_data["pax"] == [f"Upax{i}" for i in range(32)]
+    assert stand_in.calls.snapshot()["users.info"] == 33
+    assert sleeps == []
+
+
+@pytest.mark.parametrize("n_pax", [1, 30])
+def test_handle_backblast_submission_acks_without_lookups(n_pax, view_submission_factory):
+    ack = MagicMock()
+    logger = MagicMock()
+    body = view_submission_factory(n_pax)
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.task_sink") as mock_task_sink:
+        mock_app.client.users_info.side_effect = _slow_users_info
+        start = time.time()
+        handle_backblast_submit(ack, body, logger)
+        elapsed = time.time() - start
+    ack.assert_called_once_with()
+    # A single lookup takes 20ms, so the ack can't have waited on any of them
+    assert elapsed < 0.02
+    assert mock_app.client.users_info.call_count == 0
+    assert mock_task_sink.submit.call_count == 0
+
+
+def test_process_backblast_submit(view_submission_factory):
+    logger = MagicMock()
+    body = view_submission_factory(3)
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main._add_data_to_queue") as mock_add:
+        mock_app.client.users_info.side_effect = _slow_users_info
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        process_backblast_submit(body, logger)
+    assert mock_add.call_count == 1
+    backblast_data = mock_add.call_args[0][0]
+    assert backblast_data["pax"] == ["Upax0", "Upax1", "Upax2"]
+    assert backblast_data["ao"] == "ao-the-grid"
+
+
+def test_backblast_trace_reaches_the_task_handler(view_submission_factory, tmp_path):
+    received = []
+
+    def f3_sheets_handler(request):
+        received.append(dict(request.headers))
+        return {"status": "ok"}
+
+    sink = ThreadSink(call_request_handler(f3_sheets_handler))
+    exporter = FileExporter(str(tmp_path / "spans.jsonl"))
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.task_sink", sink), \
+            patch.object(tracer, "exporter", exporter):
+        mock_app.client.users_info.side_effect = _slow_users_info
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        with tracer.span("slackbot.request") as request_span:
+            process_backblast_submit(view_submission_factory(3), MagicMock())
+        sink.join()
+
+    spans = {span["name"]: span for span in map(json.loads, (tmp_path / "spans.jsonl").read_text().splitlines())}
+    assert {span["trace_id"] for span in spans.values()} == {request_span.context.trace_id}
+    assert spans["backblast.process"]["parent_span_id"] == request_span.context.span_id
+    assert spans["backblast.parse"]["parent_span_id"] == spans["backblast.process"]["span_id"]
+    assert spans["backblast.enqueue"]["parent_span_id"] == spans["backblast.process"]["span_id"]
+    # The task's request carries the enqueue span, for the sheets handler to continue the trace from
+    upstream = SpanContext.from_traceparent(received[0]["Traceparent"])
+    assert (upstream.trace_id, upstream.span_id) == (request_span.context.trace_id, spans["backblast.enqueue"]["span_id"])
+
+
+def test_process_backblast_submit_skips_rejected_submission(view_submission_no_ao):
+    with patch("slackbot.main._add_data_to_queue") as mock_add:
+        process_backblast_submit(view_submission_no_ao, MagicMock())
+    assert mock_add.call_count == 0
+
+
+def test_http_lazy_listener_runner_hands_off_without_waiting():
+    received = []
+
+    class SlowContinuation(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((dict(self.headers), self.rfile.read(int(self.headers["Content-Length"]))))
+            time.sleep(1)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), SlowContinuation)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        runner = HttpLazyListenerRunner(f"http://127.0.0.1:{server.server_port}/slackbot", MagicMock())
+        request = BoltRequest(
+            body="payload=%7B%7D",
+            headers={
+                "content-type": "application/x-www-form-urlencoded",
+                "x-slack-signature": "v0=abc",
+                "x-slack-request-timestamp": "1685991526",
+                "x-forwarded-for": "10.0.0.1",
+            },
+        )
+        request.lazy_function_name = "process_backblast_submit"
+        function = MagicMock()
+        start = time.time()
+        with tracer.span("slackbot.request") as span:
+            runner.start(function=function, request=request)
+        elapsed = time.time() - start
+    finally:
+        server.shutdown()
+
+    assert elapsed < 0.5
+    assert function.call_count == 0
+    headers, body = received[0]
+    assert body == b"payload=%7B%7D"
+    assert headers["x-slack-bolt-lazy-only"] == "1"
+    assert headers["x-slack-bolt-lazy-function-name"] == "process_backblast_submit"
+    assert headers["x-slack-signature"] == "v0=abc"
+    assert headers["traceparent"] == span.context.to_traceparent()
+    assert "x-forwarded-for" not in headers
+
+
+def _users_list_pages(n_users, page_size):
+    pages = []
+    for start in range(0, n_users, page_size):
+        members = [
+            {"id": f"Upax{i}", "name": f"pax{i}", "profile": {"display_name": f"Pax {i}"}}
+            for i in range(start, min(start + page_size, n_users))
+        ]
+        cursor = "next" if start + page_size < n_users else ""
+        pages.append({"members": members, "response_metadata": {"next_cursor": cursor}})
+    return pages
+
+
+def test_user_directory_prefetch_then_zero_api_calls():
+    client = MagicMock()
+    client.users_list.side_effect = _users_list_pages(450, 200)
+    directory = UserDirectory(lambda: client)
+
+    directory.prefetch()
+    assert directory.get_names(["Upax0", "Upax449"]) == ["Pax 0", "Pax 449"]
+    assert client.users_list.call_count == 3
+    assert client.users_info.call_count == 0
+
+    # a warm directory resolves a whole backblast without touching the api
+    api_calls = directory.stats()["api_calls"]
+    hits = directory.stats()["hits"]
+    assert directory.get_names([f"Upax{i}" for i in range(25)]) == [f"Pax {i}" for i in range(25)]
+    assert directory.stats()["api_calls"] == api_calls
+    assert directory.stats()["hits"] == hits + 25
+
+
+def test_user_directory_miss_is_one_users_info_call_not_a_sweep():
+    client = MagicMock()
+    client.users_info.return_value = {"user": {"name": "newguy", "profile": {"real_name": "New Guy"}}}
+    directory = UserDirectory(lambda: client)
+
+    # A cold directory doesn't make the lookup wait for a users.list sweep
+    assert directory.get_name("Unew") == "New Guy"
+    assert directory.get_name("Unew") == "New Guy"
+    assert client.users_list.call_count == 0
+    assert client.users_info.call_count == 1
+    assert not directory.is_warm
+
+
+def test_ttl_cache_expiry_and_lru_eviction():
+    now = [0.0]
+    cache = TTLCache(max_size=2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts b, the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.hits == 2
+    assert cache.misses == 2
+
+
+def test_version_2_payload_skips_lookups(view_submission_factory):
+    body = view_submission_factory(3)
+    with patch("slackbot.main.app") as mock_app, \
+            patch("slackbot.main.task_sink") as mock_task_sink, \
+            patch("slackbot.main.slackbot_config.backblast_payload_version", 2):
+        process_backblast_submit(body, MagicMock())
+    assert mock_app.client.users_info.call_count == 0
+    assert mock_app.client.users_list.call_count == 0
+    assert mock_app.client.conversations_info.call_count == 0
+
+    payload, task_id = mock_task_sink.submit_async.call_args[0]
+    assert task_id == payload["body"]["id"]
+    assert payload["version"] == 2
+    assert payload["body"]["pax_ids"] == ["Upax0", "Upax1", "Upax2"]
+    assert payload["body"]["ao_id"] == "Cisachannelid"
+    assert "pax" not in payload["body"]
+    assert payload["body"]["view_state"] == body["view"]["state"]["values"]
+
+
+def _pax_select_action(view, selected_users, action_ts):
+    return {
+        "type": "block_actions",
+        "view": view,
+        "actions": [{"action_id": "pax-select", "selected_users": selected_users, "action_ts": action_ts}],
+    }
+
+
+class _SlackViews:
+    """views.update as slack answers it: each update changes the view's hash, and one made with an older hash fails."""
+
+    def __init__(self, view_hash):
+        self.hash = view_hash
+        self.updates = []
+
+    def views_update(self, view_id, view, hash=None):
+        if hash is not None and hash != self.hash:
+            raise SlackApiError("hash_conflict", {"ok": False, "error": "hash_conflict"})
+        self.updates.append(view)
+        self.hash = f"{self.hash}+"
+        return {"ok": True, "view": {"id": view_id, "hash": self.hash}}
+
+
+def test_pax_select_burst_makes_one_trailing_views_update(view_submission_no_ao):
+    view = view_submission_no_ao["view"]
+    bodies = [_pax_select_action(view, [f"Upax{i}" for i in range(n)], f"1685991526.{n:06d}") for n in range(1, 6)]
+    sleeps = []
+    slack_views = _SlackViews(view["hash"])
+
+    def _sleep(seconds):
+        # The rest of the burst arrives while the second pick waits
+        sleeps.append(seconds)
+        while len(bodies) > 0:
+            handle_pax_select_interactive(MagicMock(), bodies.pop(0), MagicMock())
+
+    coalescer = ViewUpdateCoalescer(window=0.25, clock=lambda: 0.0, sleep=_sleep)
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.pax_select_coalescer", coalescer):
+        mock_app.client.views_update.side_effect = slack_views.views_update
+        # The first pick of the burst has nothing to wait for
+        handle_pax_select_interactive(MagicMock(), bodies.pop(0), MagicMock())
+        assert len(slack_views.updates) == 1
+        assert sleeps == []
+        handle_pax_select_interactive(MagicMock(), bodies.pop(0), MagicMock())
+
+    # The trailing update's hash is from before the first update, so it's made again without one
+    assert [call[1].get("hash") for call in mock_app.client.views_update.call_args_list] == [
+        "1685991526.FGKdT3jB", "1685991526.FGKdT3jB", None,
+    ]
+    assert len(slack_views.updates) == 2
+    kwargs = mock_app.client.views_update.call_args[1]
+    assert kwargs["view_id"] == "Visaviewid"
+    assert kwargs["view"]["blocks"][1]["label"]["text"] == "Pax (5 selected)"
+    assert "state" not in kwargs["view"]
+
+
+def test_pax_select_hash_conflict_of_a_superseded_selection_is_skipped(view_submission_no_ao):
+    view = view_submission_no_ao["view"]
+    body = _pax_select_action(view, ["Upax0"], "1685991526.000001")
+    logger = MagicMock()
+    coalescer = ViewUpdateCoalescer(window=0)
+
+    def _views_update(**kwargs):
+        # A newer pick arrives while this update is in flight, and its update lands first
+        coalescer.wait_for_latest(view["id"], 1685991526.000002)
+        raise SlackApiError("hash_conflict", {"ok": False, "error": "hash_conflict"})
+
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.pax_select_coalescer", coalescer):
+        mock_app.client.views_update.side_effect = _views_update
+        handle_pax_select_interactive(MagicMock(), body, logger)
+    assert mock_app.client.views_update.call_count == 1
+    assert logger.info.call_count == 1
+
+
+def test_backblast_command_opens_the_modal_with_the_team_client():
+    command = {"trigger_id": "1.2.abc", "user_id": "Uisauserid", "channel_id": "Cisachannelid", "team_id": "Tisateamid"}
+    with patch("slackbot.main.app") as mock_app:
+        open_backblast_form(MagicMock(), command, MagicMock())
+    # The team's client is the rate limited, pooled one
+    assert mock_app.client.views_open.call_count == 1
+    assert mock_app.client.views_open.call_args[1]["trigger_id"] == "1.2.abc"
+
+
+@pytest.mark.parametrize("user, method", [("Uauthorized", "chat_postMessage"), ("Uisauserid", "chat_postEphemeral")])
+def test_paxmate_say_posts_with_the_team_client(user, method):
+    command = {"user_id": user, "channel_id": "Cisachannelid", "team_id": "Tisateamid", "text": "say I like Banjo"}
+    with patch("slackbot.main.app") as mock_app, \
+            patch.object(slackbot.main.slackbot_config, "paxmate_say_authorized_slack_ids", ["Uauthorized"]):
+        post_as_paxmate(MagicMock(), command, MagicMock())
+    assert getattr(mock_app.client, method).call_count == 1
+
+
+def test_backblast_id_is_derived_from_the_view(view_submission_factory):
+    body = view_submission_factory(3)
+    assert _get_backblast_id(body) == _get_backblast_id(copy.deepcopy(body))
+    assert len(_get_backblast_id(body)) == 32
+
+    another_modal = copy.deepcopy(body)
+    another_modal["view"]["id"] = "Vanotherviewid"
+    assert _get_backblast_id(another_modal) != _get_backblast_id(body)
+
+
+def test_repeated_delivery_is_processed_once(view_submission_factory):
+    body = view_submission_factory(3)
+    logger = MagicMock()
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.task_sink") as mock_task_sink:
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        mock_app.client.users_list.return_value = {"members": [], "response_metadata": {"next_cursor": ""}}
+        mock_app.client.users_info.side_effect = _slow_users_info
+        process_backblast_submit(body, logger)
+        lookups = mock_app.client.users_info.call_count + mock_app.client.users_list.call_count
+        process_backblast_submit(copy.deepcopy(body), logger)
+
+    assert mock_task_sink.submit_async.call_count == 1
+    assert mock_app.client.users_info.call_count + mock_app.client.users_list.call_count == lookups
+    assert mock_app.client.conversations_info.call_count == 1
+    payload, task_id = mock_task_sink.submit_async.call_args[0]
+    assert task_id == payload["body"]["id"] == _get_backblast_id(body)
+
+
+def test_failed_enqueue_allows_redelivery(view_submission_factory):
+    body = view_submission_factory(1)
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.task_sink") as mock_task_sink:
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        mock_app.client.users_list.return_value = {"members": [], "response_metadata": {"next_cursor": ""}}
+        mock_app.client.users_info.side_effect = _slow_users_info
+        mock_task_sink.submit_async.return_value.result.side_effect = [RuntimeError("unavailable"), "created"]
+        process_backblast_submit(body, MagicMock())
+        process_backblast_submit(body, MagicMock())
+    assert mock_task_sink.submit_async.call_count == 2
+
+
+def test_channel_info_is_cached_across_submissions(view_submission_factory):
+    with patch("slackbot.main.app") as mock_app:
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid", "is_member": True}}
+        mock_app.client.users_info.side_effect = _slow_users_info
+        first = _parse_backblast_body(view_submission_factory(1), MagicMock())
+        second = _parse_backblast_body(view_submission_factory(2), MagicMock())
+    assert mock_app.client.conversations_info.call_count == 1
+    assert first["ao"] == second["ao"] == "ao-the-grid"
+    assert second["ao_channel"] == {"id": "Cisachannelid", "name": "ao-the-grid", "is_member": True, "is_archived": False}
+
+
+@pytest.mark.parametrize("event", [
+    {"type": "channel_rename", "channel": {"id": "Cisachannelid", "name": "ao-the-new-grid", "created": 1}},
+    {"type": "channel_archive", "channel": "Cisachannelid", "user": "Uisauserid"},
+    {"type": "member_joined_channel", "channel": "Cisachannelid", "user": "Ubotuserid"},
+    {"type": "channel_left", "channel": "Cisachannelid", "actor_id": "Uisauserid"},
+])
+def test_channel_events_invalidate_cached_channel(event, fresh_channel_directory):
+    with patch("slackbot.main.app") as mock_app:
+        mock_app.client.conversations_info.return_value = {"channel": {"name": "ao-the-grid"}}
+        fresh_channel_directory.get("Cisachannelid")
+        fresh_channel_directory.get("Cotherchannelid")
+        invalidate_channel({"team_id": "Tisateamid", "event": event}, event, MagicMock())
+        fresh_channel_directory.get("Cisachannelid")
+        fresh_channel_directory.get("Cotherchannelid")
+    assert [c.kwargs["channel"] for c in mock_app.client.conversations_info.call_args_list] == [
+        "Cisachannelid", "Cotherchannelid", "Cisachannelid",
+    ]
+
+
+@pytest.fixture
+def two_teams():
+    """Makes this a multi-workspace deployment serving T1 and T2, with a mock client per team."""
+    configs = {
+        "T1": TeamConfig("T1", bot_token="xoxb-one", signing_secret="one"),
+        "T2": TeamConfig("T2", bot_token="xoxb-two", signing_secret="two"),
+    }
+
+    def build(config):
+        team = slackbot.main.Team(config)
+        team.client = MagicMock()
+        team.client.users_list.return_value = {"members": [], "response_metadata": {"next_cursor": ""}}
+        team.client.users_info.side_effect = _slow_users_info
+        team.client.conversations_info.return_value = {"channel": {"name": f"ao-{config.team_id}"}}
+        return team
+
+    teams = TeamRegistry(configs, build)
+    with patch("slackbot.main.team_configs", configs), patch("slackbot.main.teams", teams):
+        yield teams
+
+
+def test_backblast_is_parsed_with_its_teams_client(two_teams, view_submission_factory):
+    body = view_submission_factory(2)
+    body["team"]["id"] = "T2"
+    backblast_data = _parse_backblast_body(body, MagicMock())
+    assert backblast_data["team_id"] == "T2"
+    assert backblast_data["ao"] == "ao-T2"
+    assert backblast_data["pax"] == ["Upax0", "Upax1"]
+    assert two_teams.get("T2").client.conversations_info.call_count == 1
+    assert two_teams.get("T1").client.conversations_info.call_count == 0
+
+
+def _signed_command(team_id, signing_secret):
+    body = f"team_id={team_id}&command=%2Fbackblast&user_id=Uisauserid&channel_id=Cisachannelid"
+    timestamp = str(int(time.time()))
+    return body, {
+        "content-type": "application/x-www-form-urlencoded",
+        "x-slack-request-timestamp": timestamp,
+        "x-slack-signature": SignatureVerifier(signing_secret).generate_signature(timestamp=timestamp, body=body),
+    }
+
+
+@pytest.mark.parametrize("team_id, signing_secret, status", [
+    ("T1", "one", None),
+    ("T2", "two", None),
+    # signed by another team's app
+    ("T2", "one", 401),
+    ("T9", "nine", 404),
+])
+def test_requests_are_verified_with_their_teams_signing_secret(two_teams, team_id, signing_secret, status):
+    body, headers = _signed_command(team_id, signing_secret)
+    with Flask(__name__).test_request_context("/slackbot", method="POST", data=body, headers=headers):
+        from flask import request
+        with patch("slackbot.main.handler") as mock_handler:
+            response = slackbot.main.slackbot(request)
+    if status is None:
+        assert response is mock_handler.handle.return_value
+    else:
+        assert response.status_code == status
+        assert mock_handler.handle.call_count == 0
+
+
+@pytest.mark.parametrize("signing_secret, configured_secret, status", [
+    ("secret", "secret", None),
+    ("another", "secret", 401),
+    # a deployment missing SLACK_SIGNING_SECRET rejects everything
+    ("", None, 401),
+])
+def test_requests_are_verified_with_the_deployments_signing_secret(signing_secret, configured_secret, status):
+    body, headers = _signed_command("Tisateamid", signing_secret or "unset")
+    with Flask(__name__).test_request_context("/slackbot", method="POST", data=body, headers=headers):
+        from flask import request
+        with patch("slackbot.main.handler") as mock_handler, \
+                patch.object(slackbot.main.slackbot_config, "signing_secret", configured_secret):
+            response = slackbot.main.slackbot(request)
+    if status is None:
+        assert response is mock_handler.handle.return_value
+    else:
+        assert response.status_code == status
+        assert mock_handler.handle.call_count == 0
+
+
+def test_channel_directory_prefetch_then_zero_api_calls():
+    client = MagicMock()
+    client.conversations_list.side_effect = [
+        {"channels": [{"id": "C1", "name": "ao-the-grid", "is_member": True}], "response_metadata": {"next_cursor": "c2"}},
+        {"channels": [{"id": "C2", "name": "3rdf"}], "response_metadata": {"next_cursor": ""}},
+    ]
+    directory = ChannelDirectory(lambda: client)
+    directory.prefetch()
+    directory.prefetch()
+    assert directory.get_name("C1") == "ao-the-grid"
+    assert directory.get("C2") == {"id": "C2", "name": "3rdf", "is_member": False, "is_archived": False}
+    assert client.conversations_list.call_count == 2
+    assert client.conversations_info.call_count == 0
+
+
+def test_healthz_warm_primes_clients_and_caches():
+    with patch("slackbot.main.app") as mock_app, patch("slackbot.main.task_sink") as mock_task_sink:
+        mock_app.client.users_list.return_value = {"members": [{"id": "U1", "name": "torpedo"}], "response_metadata": {}}
+        mock_app.client.conversations_list.side_effect = RuntimeError("missing_scope")
+        with Flask(__name__).test_request_context("/slackbot/healthz?warm=1", method="GET"):
+            from flask import request
+            response = slackbot.main.slackbot(request)
+        assert slackbot.main.user_directory.get_name("U1") == "torpedo"
+
+    warm = json.loads(response.get_data())["warm"]
+    assert response.status_code == 200
+    assert sorted(warm) == ["channel_directory", "task_sink", "user_directory"]
+    assert warm["user_directory"]["status"] == warm["task_sink"]["status"] == "ok"
+    assert warm["channel_directory"]["status"] == "error: missing_scope"
+    assert mock_task_sink.warm.return_value.result.call_count == 1
+    assert mock_app.client.users_info.call_count == 0
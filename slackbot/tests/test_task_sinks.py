@@ -0,0 +1,202 @@
+import json
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core import exceptions
+
+from paxmate_common import tracing
+from paxmate_common.metrics import registry
+from paxmate_common.tracing import Tracer
+from task_sinks import (
+    CloudTasksSink,
+    SpoolingSink,
+    SqliteSink,
+    ThreadSink,
+    build_task_sink,
+    call_request_handler,
+)
+
+
+def _payload(id_):
+    return {"body": {"id": id_, "date": "2023-06-05"}}
+
+
+def test_cloud_tasks_sink_creates_named_http_task():
+    sink = CloudTasksSink("f3-carpex", "us-east1", "sheets-append-develop", "https://example.com/handler")
+    sink._client = MagicMock()
+    sink._client.task_path.return_value = "projects/f3-carpex/locations/us-east1/queues/q/tasks/abc"
+    sink._client.create_task.return_value.name = "created"
+
+    assert sink.submit(_payload("abc"), "abc") == "created"
+    request = sink._client.create_task.call_args[1]["request"]
+    assert request["task"]["name"] == "projects/f3-carpex/locations/us-east1/queues/q/tasks/abc"
+    assert request["task"]["http_request"]["url"] == "https://example.com/handler"
+    assert json.loads(request["task"]["http_request"]["body"]) == _payload("abc")
+
+
+def test_cloud_tasks_sink_task_carries_the_callers_trace():
+    sink = CloudTasksSink("f3-carpex", "us-east1", "sheets-append-develop", "https://example.com/handler")
+    sink._client = MagicMock()
+    with Tracer().span("backblast.enqueue") as span:
+        sink.submit_async(_payload("abc"), "abc").result()
+    headers = sink._client.create_task.call_args[1]["request"]["task"]["http_request"]["headers"]
+    assert headers["traceparent"] == span.context.to_traceparent()
+
+
+def _cloud_tasks_sink(create_task_side_effect):
+    sink = CloudTasksSink(
+        "f3-carpex", "us-east1", "sheets-append-develop", "https://example.com/handler",
+        deadline=1.0, max_attempts=3, base_backoff=0.01,
+    )
+    sink._client = MagicMock()
+    sink._client.task_path.return_value = "projects/f3-carpex/locations/us-east1/queues/q/tasks/abc"
+    sink._client.create_task.side_effect = create_task_side_effect
+    return sink
+
+
+def _outcome_count(outcome):
+    return registry.histogram("cloud_tasks_create_task_seconds", outcome=outcome).count
+
+
+def test_cloud_tasks_sink_retries_transient_errors_with_deadline():
+    created = MagicMock()
+    created.name = "created"
+    sink = _cloud_tasks_sink([exceptions.DeadlineExceeded("slow"), exceptions.ServiceUnavailable("down"), created])
+    n_retryable, n_ok = _outcome_count("retryable_error"), _outcome_count("ok")
+
+    assert sink.submit_async(_payload("abc"), "abc").result() == "created"
+    assert sink._client.create_task.call_count == 3
+    assert all(call[1]["timeout"] == 1.0 and call[1]["retry"] is None for call in sink._client.create_task.call_args_list)
+    assert _outcome_count("retryable_error") == n_retryable + 2
+    assert _outcome_count("ok") == n_ok + 1
+
+
+def test_cloud_tasks_sink_gives_up_after_max_attempts():
+    sink = _cloud_tasks_sink(exceptions.ServiceUnavailable("down"))
+    with pytest.raises(exceptions.ServiceUnavailable):
+        sink.submit(_payload("abc"), "abc")
+    assert sink._client.create_task.call_count == 3
+
+
+def test_cloud_tasks_sink_does_not_retry_permanent_errors():
+    sink = _cloud_tasks_sink(exceptions.PermissionDenied("no"))
+    with pytest.raises(exceptions.PermissionDenied):
+        sink.submit(_payload("abc"), "abc")
+    assert sink._client.create_task.call_count == 1
+
+
+def test_cloud_tasks_sink_treats_already_exists_as_created():
+    sink = _cloud_tasks_sink(exceptions.AlreadyExists("dupe"))
+    assert sink.submit(_payload("abc"), "abc") == "projects/f3-carpex/locations/us-east1/queues/q/tasks/abc"
+
+
+def test_thread_sink_runs_handler_in_background():
+    handled = []
+    sink = ThreadSink(handled.append)
+    sink.submit(_payload("a"), "a")
+    sink.submit(_payload("b"), "b")
+    sink.join()
+    assert handled == [_payload("a"), _payload("b")]
+
+
+def test_sqlite_sink_is_durable_and_deduplicates(tmp_path):
+    path = str(tmp_path / "tasks.sqlite3")
+    first = SqliteSink(path, handler=MagicMock(), start_worker=False)
+    first.submit(_payload("a"), "a")
+    first.submit(_payload("a"), "a")
+    first.submit(_payload("b"), "b")
+
+    # a new process picks up what the old one queued
+    handled = []
+    second = SqliteSink(path, handler=handled.append, start_worker=False)
+    assert second.pending_count() == 2
+    assert second.process_due_tasks() == 2
+    assert handled == [_payload("a"), _payload("b")]
+    assert second.pending_count() == 0
+
+
+def test_sqlite_sink_restores_the_submitters_trace(tmp_path):
+    seen = []
+    sink = SqliteSink(str(tmp_path / "tasks.sqlite3"), handler=lambda payload: seen.append(tracing.inject()),
+                      start_worker=False)
+    with Tracer().span("backblast.enqueue") as span:
+        sink.submit(_payload("a"), "a")
+    sink.process_due_tasks()
+    assert seen == [{"traceparent": span.context.to_traceparent()}]
+
+
+def test_sqlite_sink_retries_with_backoff(tmp_path):
+    handler = MagicMock(side_effect=[RuntimeError("sheets handler down"), None])
+    sink = SqliteSink(str(tmp_path / "tasks.sqlite3"), handler=handler, base_backoff=0.05, start_worker=False)
+    sink.submit(_payload("a"), "a")
+
+    assert sink.process_due_tasks() == 0
+    assert sink.pending_count() == 1
+    # not due again until the backoff passes
+    assert sink.process_due_tasks() == 0
+    assert handler.call_count == 1
+    time.sleep(0.06)
+    assert sink.process_due_tasks() == 1
+    assert sink.pending_count() == 0
+
+
+def test_sqlite_sink_worker_drains_queue(tmp_path):
+    handled = []
+    sink = SqliteSink(str(tmp_path / "tasks.sqlite3"), handler=handled.append, poll_interval=0.01)
+    sink.submit(_payload("a"), "a")
+    deadline = time.time() + 2
+    while not handled and time.time() < deadline:
+        time.sleep(0.01)
+    assert handled == [_payload("a")]
+
+
+def test_spooling_sink_spools_when_primary_fails(tmp_path):
+    primary = MagicMock()
+    primary.submit.side_effect = RuntimeError("deadline exceeded")
+    spool = SqliteSink(str(tmp_path / "tasks.sqlite3"), handler=MagicMock(), start_worker=False)
+    sink = SpoolingSink(primary, spool)
+
+    assert sink.submit(_payload("a"), "a") == "a"
+    assert spool.pending_count() == 1
+
+
+def _sink_config(tmp_path, task_sink="cloud_tasks"):
+    return SimpleNamespace(
+        task_sink=task_sink, task_sink_handler=None, handler_url="https://example.com/handler",
+        task_spool_path=str(tmp_path / "tasks.sqlite3"), gcp_project="f3-carpex", gcp_location="us-east1",
+        gcp_queue_name="sheets-append-develop", enqueue_deadline=5.0, enqueue_max_attempts=3,
+    )
+
+
+def test_tasks_are_spooled_in_a_long_running_process(tmp_path):
+    sink = build_task_sink(_sink_config(tmp_path), environ={})
+    assert isinstance(sink, SpoolingSink)
+
+
+@pytest.mark.parametrize("environ", [{"K_SERVICE": "slackbot-peakcity"}, {"FUNCTION_TARGET": "slackbot"}])
+def test_tasks_are_not_spooled_on_cloud_functions(tmp_path, environ):
+    assert isinstance(build_task_sink(_sink_config(tmp_path), environ=environ), CloudTasksSink)
+    with pytest.raises(ValueError):
+        build_task_sink(_sink_config(tmp_path, task_sink="sqlite"), environ=environ)
+    assert not (tmp_path / "tasks.sqlite3").exists()
+
+
+def test_call_request_handler_passes_payload_as_json_request():
+    def f3_sheets_handler(request):
+        assert request.method == "POST"
+        return {"status": "ok", "id": request.get_json()["body"]["id"]}
+
+    assert call_request_handler(f3_sheets_handler)(_payload("a")) == {"status": "ok", "id": "a"}
+
+
+def test_call_request_handler_raises_on_error_response():
+    from flask import Flask, make_response
+
+    def f3_sheets_handler(request):
+        return make_response('{"status": "incomplete"}', 500)
+
+    with Flask(__name__).app_context():
+        with pytest.raises(RuntimeError):
+            call_request_handler(f3_sheets_handler)(_payload("a"))
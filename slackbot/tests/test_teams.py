@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from paxmate_common.teams import TeamConfig, TeamRegistry, UnknownTeamError, load_team_configs
+
+
+def test_no_teams_config_means_single_workspace():
+    assert load_team_configs({"SLACK_TEAM_ID": "T1", "SLACK_BOT_TOKEN": "xoxb-one"}) == {}
+
+
+def test_load_team_configs_from_json_with_secrets_from_env():
+    environ = {
+        "TEAMS_CONFIG": json.dumps({
+            "T2": {
+                "name": "greenlevel",
+                "bot_token_env": "SLACK_BOT_TOKEN_GREENLEVEL",
+                "signing_secret_env": "SLACK_SIGNING_SECRET_GREENLEVEL",
+                "first_f_channel": "C2",
+                "paxmate_say_authorized_slack_ids": "U1, U2",
+            },
+        }),
+        "SLACK_BOT_TOKEN_GREENLEVEL": "xoxb-two",
+        "SLACK_SIGNING_SECRET_GREENLEVEL": "two",
+        # The deployment's own workspace is served too
+        "SLACK_TEAM_ID": "T1",
+        "SLACK_BOT_TOKEN": "xoxb-one",
+        "FIRST_F_CHANNEL": "C1",
+    }
+    configs = load_team_configs(environ)
+    assert sorted(configs) == ["T1", "T2"]
+    assert configs["T2"].name == "greenlevel"
+    assert configs["T2"].bot_token == "xoxb-two"
+    assert configs["T2"].signing_secret == "two"
+    assert configs["T2"].paxmate_say_authorized_slack_ids == ["U1", "U2"]
+    assert configs["T1"].bot_token == "xoxb-one"
+    assert configs["T1"].first_f_channel == "C1"
+
+
+def test_load_team_configs_from_file(tmp_path):
+    path = tmp_path / "teams.json"
+    path.write_text(json.dumps([{"team_id": "T3", "bot_token": "xoxb-three", "spreadsheet_id": "S3"}]))
+    configs = load_team_configs({"TEAMS_CONFIG_PATH": str(path)})
+    assert list(configs) == ["T3"]
+    assert configs["T3"].spreadsheet_id == "S3"
+
+
+def test_team_registry_builds_each_team_once():
+    built = []
+
+    def build(config):
+        built.append(config.team_id)
+        return object()
+
+    registry = TeamRegistry({"T1": TeamConfig("T1")}, build)
+    assert registry.get("T1") is registry.get("T1")
+    assert built == ["T1"]
+    assert "T1" in registry and "T2" not in registry
+    with pytest.raises(UnknownTeamError):
+        registry.get("T2")
@@ -0,0 +1,81 @@
+import io
+import json
+import threading
+
+import pytest
+
+from paxmate_common import tracing
+from paxmate_common.tracing import FileExporter, SpanContext, StdoutExporter, Tracer, build_exporter
+
+
+def test_traceparent_round_trip():
+    context = SpanContext("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7")
+    assert context.to_traceparent() == "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+    parsed = tracing.extract({"Traceparent": context.to_traceparent()})
+    assert (parsed.trace_id, parsed.span_id) == (context.trace_id, context.span_id)
+
+
+@pytest.mark.parametrize("value", [
+    None,
+    "",
+    "garbage",
+    "00-00000000000000000000000000000000-00f067aa0ba902b7-01",
+    "00-4bf92f3577b34da6a3ce929d0e0e4736-0000000000000000-01",
+])
+def test_invalid_traceparent_is_ignored(value):
+    assert SpanContext.from_traceparent(value) is None
+
+
+def test_spans_nest_and_are_exported(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(FileExporter(str(path)))
+    upstream = SpanContext("4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7")
+    with tracer.span("sheets.handler", parent=upstream) as handler_span:
+        with pytest.raises(RuntimeError):
+            with tracer.span("sheets.append", try_count=1):
+                raise RuntimeError("sheets down")
+        assert tracing.current_context() is handler_span.context
+    assert tracing.current_context() is None
+
+    append, handler = [json.loads(line) for line in path.read_text().splitlines()]
+    assert handler["trace_id"] == append["trace_id"] == upstream.trace_id
+    assert handler["parent_span_id"] == upstream.span_id
+    assert append["parent_span_id"] == handler["span_id"]
+    assert append["status"] == "error"
+    assert append["attributes"] == {"try_count": 1}
+    assert handler["status"] == "ok"
+    assert handler["duration_seconds"] >= append["duration_seconds"]
+
+
+def test_stdout_exporter_writes_structured_log_lines():
+    stream = io.StringIO()
+    with Tracer(StdoutExporter(stream)).span("backblast.enqueue"):
+        pass
+    line = json.loads(stream.getvalue())
+    assert line["severity"] == "INFO"
+    assert line["message"] == "span backblast.enqueue"
+    assert line["parent_span_id"] is None
+
+
+def test_context_can_be_carried_to_another_thread():
+    seen = []
+    with Tracer().span("backblast.enqueue") as span:
+        context = tracing.current_context()
+
+    def _work():
+        with tracing.use_context(context):
+            seen.append(tracing.inject())
+
+    worker = threading.Thread(target=_work)
+    worker.start()
+    worker.join()
+    assert seen == [{"traceparent": span.context.to_traceparent()}]
+
+
+def test_build_exporter():
+    assert build_exporter(None) is None
+    assert build_exporter("none") is None
+    assert isinstance(build_exporter("stdout"), StdoutExporter)
+    assert build_exporter("file:/tmp/spans.jsonl").path == "/tmp/spans.jsonl"
+    with pytest.raises(ValueError):
+        build_exporter("zipkin")
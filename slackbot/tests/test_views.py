@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+from views import (
+    BACKBLAST_MODAL_TEMPLATE,
+    VIEW_RESPONSE_ONLY_FIELDS,
+    ViewUpdateCoalescer,
+    _build_backblast_modal_template,
+    build_backblast_modal,
+    build_pax_count_update,
+)
+
+
+def test_build_backblast_modal_patches_only_per_call_fields():
+    view = build_backblast_modal("2023-06-05", "Uisauserid", "Cisachannelid", "Tisateamid")
+    expected = _build_backblast_modal_template()
+    expected["private_metadata"] = '{"initial_channel": "Cisachannelid", "team": "Tisateamid"}'
+    expected["blocks"][0]["elements"][0]["initial_date"] = "2023-06-05"
+    expected["blocks"][0]["elements"][2]["initial_user"] = "Uisauserid"
+    assert json.loads(json.dumps(view)) == expected
+
+    # unpatched blocks are shared with the template, not copied
+    assert view["blocks"][1] is BACKBLAST_MODAL_TEMPLATE["blocks"][1]
+
+
+def test_build_backblast_modal_leaves_template_untouched():
+    before = json.dumps(BACKBLAST_MODAL_TEMPLATE)
+    build_backblast_modal("2023-06-05", "Uisauserid", "Cisachannelid", "Tisateamid")
+    build_backblast_modal("2023-06-06", "Uanother", "Canother", "Tisateamid")
+    assert json.dumps(BACKBLAST_MODAL_TEMPLATE) == before
+
+
+def test_template_is_read_only():
+    with pytest.raises(TypeError):
+        BACKBLAST_MODAL_TEMPLATE["private_metadata"] = "{}"
+    with pytest.raises(TypeError):
+        BACKBLAST_MODAL_TEMPLATE["blocks"][0]["elements"][0]["initial_date"] = "2023-06-05"
+
+
+def test_private_metadata_is_valid_json():
+    view = build_backblast_modal("2023-06-05", "Uisauserid", 'C"quoted', None)
+    assert json.loads(view["private_metadata"]) == {"initial_channel": 'C"quoted', "team": None}
+
+
+def test_visiting_pax_options():
+    options = BACKBLAST_MODAL_TEMPLATE["blocks"][-1]["element"]["options"]
+    assert [option["value"] for option in options] == [str(n) for n in range(10)] + ["10+"]
+
+
+def _submitted_view(pax_label="Pax"):
+    view = json.loads(json.dumps(build_backblast_modal("2023-06-05", "Uisauserid", "Cisachannelid", "Tisateamid")))
+    view["blocks"][1]["label"]["text"] = pax_label
+    view.update({
+        "id": "Visaviewid", "team_id": "Tisateamid", "hash": "1685991526.FGKdT3jB", "previous_view_id": None,
+        "root_view_id": "Visaviewid", "app_id": "Aappid9", "app_installed_team_id": "Tisateamid", "bot_id": "Bisabotid",
+        "state": {"values": {"pax-select": {"pax-select": {"selected_users": ["Uisauserid"]}}}},
+    })
+    return view
+
+
+def test_build_pax_count_update():
+    view = _submitted_view()
+    before = json.dumps(view)
+    update = build_pax_count_update(view, 3)
+
+    assert json.dumps(view) == before
+    assert not VIEW_RESPONSE_ONLY_FIELDS & set(update)
+    assert update["callback_id"] == "backblast_modal"
+    pax_block = update["blocks"][1]
+    assert pax_block["label"]["text"] == "Pax (3 selected)"
+    assert pax_block["element"]["placeholder"]["text"] == "3 selected"
+    assert pax_block["element"]["action_id"] == "pax-select"
+    # only the pax-select block is rebuilt
+    assert all(update["blocks"][i] is view["blocks"][i] for i in range(len(view["blocks"])) if i != 1)
+
+
+class _FakeClock:
+    """A clock whose sleep advances it, and first delivers the actions due during the wait."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+        self.during_sleep = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        while self.during_sleep:
+            self.now += 0.05
+            self.during_sleep.pop(0)()
+        self.now += seconds
+
+
+def test_coalescer_lets_a_lone_action_through_without_waiting():
+    clock = _FakeClock()
+    coalescer = ViewUpdateCoalescer(window=0.25, clock=clock, sleep=clock.sleep)
+
+    assert coalescer.wait_for_latest("Visaviewid", 1.0) is True
+    clock.now += 10
+    assert coalescer.wait_for_latest("Visaviewid", 11.0) is True
+    # other views are independent
+    assert coalescer.wait_for_latest("Vanother", 11.0) is True
+    assert clock.slept == []
+
+
+def test_coalescer_lets_only_newest_action_of_a_burst_through():
+    clock = _FakeClock()
+    coalescer = ViewUpdateCoalescer(window=0.25, clock=clock, sleep=clock.sleep)
+    results = {}
+
+    def _select(action_ts):
+        results[action_ts] = coalescer.wait_for_latest("Visaviewid", action_ts)
+
+    _select(1.0)
+    clock.now += 0.1
+    # 1.02 and 1.03 arrive while 1.01 waits
+    clock.during_sleep = [lambda: _select(1.02), lambda: _select(1.03)]
+    _select(1.01)
+    assert results == {1.0: True, 1.01: False, 1.02: False, 1.03: True}
+    assert clock.slept == [0.25, 0.25, 0.25]
+
+    # a late delivery of an older action is dropped straight away
+    assert coalescer.wait_for_latest("Visaviewid", 1.01) is False
+    assert len(clock.slept) == 3